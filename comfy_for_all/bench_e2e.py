@@ -0,0 +1,257 @@
+# end-to-end benchmark: job server, workers and fake ComfyUI instances on one machine
+#
+# usage: python bench_e2e.py --jobs 200 --workers 4 --delay 0.5 --size 512x512
+#
+# Everything runs in a temporary folder: the queue is filled with --jobs jobs,
+# then the job server, one fake ComfyUI per worker and the worker processes
+# (with NVML stubbed out) are started, and the run ends when every job has
+# been uploaded. Reports jobs per second, queue-to-done latency percentiles
+# and the CPU time used by the job server.
+
+import argparse
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import requests
+
+import config
+from bench_jobs import write_jobs
+from hashes import hash_directory
+from upload_store import UploadStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STARTUP_TIMEOUT = 30  # seconds
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def process_cpu(pid: int) -> float:
+    # User and system time from /proc, in seconds
+    with open(f"/proc/{pid}/stat", "r") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def write_config(folder: str, **overrides):
+    # The server reads config.py from its working directory, so give it one
+    # that points at the benchmark folders
+    overrides = {
+        "queue_folder": "../jobs",
+        "upload_folder": "../uploads",
+        "lease_journal": "../leases.jsonl",
+        "job_database": "../jobs.sqlite3",
+        **overrides,
+    }
+    with open(os.path.join(folder, "config.py"), "w") as f:
+        for name in dir(config):
+            if not name.startswith("_"):
+                value = overrides.get(name, getattr(config, name))
+                f.write(f"{name} = {value!r}\n")
+
+
+def make_checkpoint(folder: str) -> str:
+    os.makedirs(folder, exist_ok=True)
+    data = os.urandom(2**20)
+    with open(os.path.join(folder, "bench.safetensors"), "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def wait_for(url: str):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {STARTUP_TIMEOUT}s")
+
+
+def start(command: list[str], cwd: str, log: str) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=HERE, PYTHONUNBUFFERED="1")
+    with open(log, "w") as f:
+        return subprocess.Popen(
+            command, cwd=cwd, env=env, stdout=f, stderr=subprocess.STDOUT
+        )
+
+
+def run(args, root: str):
+    for folder in ("jobs", "uploads", "server", "loras"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    write_config(os.path.join(root, "server"))
+    model = make_checkpoint(os.path.join(root, "checkpoints"))
+
+    # Hash the checkpoint up front, so the workers know it from the start
+    checkpoint_db = os.path.join(root, "checkpoint_db.json")
+    hash_directory(os.path.join(root, "checkpoints"), checkpoint_db, 1)
+
+    job_ids = write_jobs(
+        os.path.join(root, "jobs"), args.jobs, [model], args.size, args.batch_size
+    )
+    requested_at = time.time()
+    print(f"Queued {len(job_ids)} jobs in {root}")
+
+    processes = []
+    try:
+        server_url = f"http://127.0.0.1:{args.port}"
+        server = start(
+            [
+                sys.executable,
+                "-c",
+                "import server_file; "
+                f"server_file.app.run(host='127.0.0.1', port={args.port}, threaded=True)",
+            ],
+            os.path.join(root, "server"),
+            os.path.join(root, "server.log"),
+        )
+        processes.append(server)
+        wait_for(server_url + "/metrics")
+
+        for i in range(args.workers):
+            port = args.comfy_port + i
+            processes.append(
+                start(
+                    [
+                        sys.executable,
+                        os.path.join(HERE, "fake_comfy.py"),
+                        "--port",
+                        str(port),
+                        "--delay",
+                        str(args.delay),
+                        "--size",
+                        args.size,
+                    ],
+                    root,
+                    os.path.join(root, f"comfy_{i}.log"),
+                )
+            )
+            wait_for(f"http://127.0.0.1:{port}/history/none")
+
+        server_cpu = process_cpu(server.pid)
+        started = time.time()
+        for i in range(args.workers):
+            folder = os.path.join(root, f"worker_{i}")
+            os.makedirs(folder, exist_ok=True)
+            shutil.copy(checkpoint_db, os.path.join(folder, "checkpoint_db.json"))
+            command = [
+                sys.executable,
+                os.path.join(HERE, "worker_comfy.py"),
+                "--fake_gpu",
+                "--idle_threshold",
+                "0",
+                "--polling_interval",
+                "1",
+                "--job_server",
+                server_url,
+                "--comfy_server",
+                f"127.0.0.1:{args.comfy_port + i}",
+                "--checkpoint_dir",
+                os.path.join(root, "checkpoints"),
+                "--lora_dir",
+                os.path.join(root, "loras"),
+                "--client_file",
+                os.path.join(folder, "client.json"),
+                *shlex.split(args.worker_args),
+            ]
+            processes.append(start(command, folder, os.path.join(folder, "worker.log")))
+
+        # Jobs are done once their manifest is in the upload store
+        store = UploadStore(os.path.join(root, "uploads"))
+        remaining = set(job_ids)
+        done_at = {}
+        deadline = time.monotonic() + args.timeout
+        while remaining and time.monotonic() < deadline:
+            for job_id in list(remaining):
+                manifest = store.manifest(job_id)
+                if manifest is not None:
+                    done_at[job_id] = manifest["uploaded_at"]
+                    remaining.discard(job_id)
+
+            if remaining:
+                print(f"{len(done_at)}/{len(job_ids)} jobs done", end="\r")
+                time.sleep(0.5)
+
+        elapsed = max(done_at.values(), default=started) - started
+        server_cpu = process_cpu(server.pid) - server_cpu
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print()
+    if remaining:
+        print(f"Timed out with {len(remaining)} jobs not done")
+    if not done_at:
+        return
+
+    latencies = [done - requested_at for done in done_at.values()]
+    print(f"Started {datetime.fromtimestamp(started).isoformat()}")
+    print(f"{len(done_at)} jobs in {elapsed:0.2f}s: {len(done_at) / elapsed:0.2f} jobs/s")
+    print(
+        "Queue to done latency: "
+        + ", ".join(
+            f"p{p} {percentile(latencies, p):0.2f}s" for p in (50, 90, 99)
+        )
+        + f", max {max(latencies):0.2f}s"
+    )
+    print(
+        f"Server CPU: {server_cpu:0.2f}s, {100 * server_cpu / max(elapsed, 1e-9):0.1f}% of one core"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end job server benchmark")
+    parser.add_argument("--jobs", type=int, default=200, help="Number of jobs")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes")
+    parser.add_argument(
+        "--delay", type=float, default=0.5, help="Seconds the fake ComfyUI takes per prompt"
+    )
+    parser.add_argument("--size", type=str, default="512x512", help="Image size")
+    parser.add_argument("--batch_size", type=int, default=1, help="Images per job")
+    parser.add_argument("--port", type=int, default=5077, help="Job server port")
+    parser.add_argument(
+        "--comfy_port", type=int, default=8288, help="Port of the first fake ComfyUI"
+    )
+    parser.add_argument(
+        "--worker_args",
+        type=str,
+        default="--long_poll 10",
+        help="Extra arguments for every worker, e.g. '--prefetch 1 --queue_depth 2'",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="Give up after this many seconds"
+    )
+    parser.add_argument(
+        "--folder",
+        type=str,
+        default=None,
+        help="Keep the run in this folder instead of a temporary one",
+    )
+    args = parser.parse_args()
+
+    if args.folder:
+        os.makedirs(args.folder, exist_ok=True)
+        run(args, args.folder)
+        return
+
+    root = tempfile.mkdtemp(prefix="cfa_bench_")
+    try:
+        run(args, root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# benchmark checkpoint hashing throughput on synthetic files
+#
+# usage: python bench_hashes.py --files 4 --size_mb 2048 --workers 1 4
+
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+from hashes import hash_files
+
+
+def make_files(folder, count, size_mb):
+    chunk = os.urandom(2**20)
+    filepaths = []
+    for i in range(count):
+        filepath = os.path.join(folder, f"model_{i}.safetensors")
+        with open(filepath, "wb") as f:
+            for _ in range(size_mb):
+                f.write(chunk)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def legacy_hash(filepaths):
+    # The single-threaded 4 KiB reads hash_file used to do
+    results = {}
+    for filepath in filepaths:
+        sha256 = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                sha256.update(chunk)
+        results[filepath] = sha256.hexdigest()
+    return results
+
+
+def timed(label, total_mb, fn):
+    start = time.perf_counter()
+    results = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>24}: {elapsed:8.2f}s {total_mb / elapsed:10.1f} MiB/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark checkpoint hashing")
+    parser.add_argument("--files", type=int, default=4, help="Number of files")
+    parser.add_argument(
+        "--size_mb", type=int, default=2048, help="Size of each file in MiB"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Worker process counts to benchmark",
+    )
+    parser.add_argument(
+        "--folder",
+        type=str,
+        default=None,
+        help="Where to write the files, defaults to a temporary directory",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+        filepaths = make_files(folder, args.files, args.size_mb)
+        total_mb = args.files * args.size_mb
+        print(f"Hashing {args.files} files of {args.size_mb} MiB")
+
+        # Files written just now are likely in the page cache, so this
+        # measures hashing rather than the disk unless the cache is dropped
+        expected = timed("legacy 4 KiB, 1 thread", total_mb, lambda: legacy_hash(filepaths))
+        for workers in args.workers:
+            results = timed(
+                f"hash_files, {workers} workers",
+                total_mb,
+                lambda: hash_files(filepaths, workers),
+            )
+            assert results == expected, "hashes do not match"
+
+
+if __name__ == "__main__":
+    main()
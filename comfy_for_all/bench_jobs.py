@@ -0,0 +1,82 @@
+# fill a queue folder with synthetic jobs for benchmarks
+#
+# usage: python bench_jobs.py --folder ../jobs --count 1000 --model <sha256>
+
+import argparse
+import json
+import os
+import random
+from datetime import datetime
+
+SUBJECTS = ("a lighthouse", "a red fox", "a city street", "a mountain lake", "a robot")
+STYLES = ("at sunset", "in the rain", "watercolor", "oil painting", "photograph")
+
+
+def make_job(job_id: int, model: str, resolution: str, batch_size: int, steps: int) -> dict:
+    now = datetime.now().isoformat()
+    return {
+        "batch_size": batch_size,
+        "channel": f"bench_{job_id % 16}",
+        "config_scale": 7,
+        "image_link": None,
+        "job_id": job_id,
+        "model": model,
+        "negative_prompt": "blurry, low quality",
+        "request_type": "generate",
+        "requested_at": now,
+        "requested_prompt": f"{random.choice(SUBJECTS)}, {random.choice(STYLES)}",
+        "resolution": resolution,
+        "started_at": now,
+        "steps": steps,
+    }
+
+
+def write_jobs(
+    folder: str,
+    count: int,
+    models: list[str],
+    resolution: str = "512x512",
+    batch_size: int = 1,
+    steps: int = 20,
+    start: int = 0,
+) -> list[int]:
+    os.makedirs(folder, exist_ok=True)
+    job_ids = []
+    for job_id in range(start, start + count):
+        job = make_job(job_id, random.choice(models), resolution, batch_size, steps)
+        path = os.path.join(folder, f"bench_{job_id:08d}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(job, f)
+        # The queue may be scanned at any moment, so jobs appear fully written
+        os.replace(path + ".tmp", path)
+        job_ids.append(job_id)
+    return job_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic jobs to a queue folder")
+    parser.add_argument("--folder", type=str, default="../jobs", help="Queue folder")
+    parser.add_argument("--count", type=int, default=100, help="Number of jobs")
+    parser.add_argument(
+        "--model", type=str, nargs="+", required=True, help="Model hashes to pick from"
+    )
+    parser.add_argument("--resolution", type=str, default="512x512", help="Image size")
+    parser.add_argument("--batch_size", type=int, default=1, help="Images per job")
+    parser.add_argument("--steps", type=int, default=20, help="Sampler steps")
+    parser.add_argument("--start", type=int, default=0, help="First job ID")
+    args = parser.parse_args()
+
+    job_ids = write_jobs(
+        args.folder,
+        args.count,
+        args.model,
+        args.resolution,
+        args.batch_size,
+        args.steps,
+        args.start,
+    )
+    print(f"Wrote {len(job_ids)} jobs to {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# benchmark get-job dispatch latency against queue size
+#
+# usage: python bench_queue.py --sizes 1000 10000 50000 --dispatches 200
+
+import argparse
+import os
+import tempfile
+import time
+
+from job_queue import JobQueue
+
+
+def make_jobs(folder, count):
+    for i in range(count):
+        with open(os.path.join(folder, f"job_{i:08d}.json"), "w") as f:
+            f.write("{}")
+
+    # Backdate the folder so the index sees a settled directory, as it would
+    # between job submissions
+    settled = time.time() - 60
+    os.utime(folder, (settled, settled))
+
+
+def legacy_dispatch(folder, processed_jobs):
+    # The listdir + getmtime + sort scan that get_job used to do on every request
+    files = [f for f in os.listdir(folder) if f.endswith(".json")]
+    files.sort(key=lambda f: os.path.getmtime(os.path.join(folder, f)))
+    for file in files:
+        job_file = os.path.join(folder, file)
+        if job_file not in processed_jobs:
+            processed_jobs.add(job_file)
+            return job_file
+    return None
+
+
+def indexed_dispatch(queue):
+    queue.refresh()
+    return queue.pop()
+
+
+def time_dispatches(dispatch, count):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        dispatch()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark get-job dispatch")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="Queue sizes to benchmark",
+    )
+    parser.add_argument(
+        "--dispatches",
+        type=int,
+        default=200,
+        help="Number of jobs to dispatch for each size",
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'queue size':>10} {'legacy p50':>12} {'legacy p99':>12} "
+        f"{'index build':>12} {'index p50':>12} {'index p99':>12}"
+    )
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            make_jobs(folder, size)
+            dispatches = min(args.dispatches, size)
+
+            processed_jobs = set()
+            legacy_p50, legacy_p99 = time_dispatches(
+                lambda: legacy_dispatch(folder, processed_jobs), dispatches
+            )
+
+            start = time.perf_counter()
+            queue = JobQueue(folder)
+            queue.refresh(force=True)
+            build = time.perf_counter() - start
+
+            index_p50, index_p99 = time_dispatches(
+                lambda: indexed_dispatch(queue), dispatches
+            )
+
+        print(
+            f"{size:>10} {legacy_p50 * 1000:>10.3f}ms {legacy_p99 * 1000:>10.3f}ms "
+            f"{build * 1000:>10.1f}ms {index_p50 * 1000:>10.3f}ms {index_p99 * 1000:>10.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
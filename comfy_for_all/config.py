@@ -1,2 +1,14 @@
 queue_folder = "../jobs"
 upload_folder = "../uploads"
+lease_journal = "../leases.jsonl"
+lease_timeout = 30 * 60  # seconds
+affinity_window = 16  # older jobs a worker may skip to keep its loaded model
+long_poll_max = 60  # longest a get-job request may wait for a job, in seconds
+long_poll_interval = 0.25  # how often waiting requests look for new job files
+max_jobs_per_request = 8  # most jobs a worker can claim in one get-job request
+coalesce_max = 4  # most compatible jobs run as one prompt for workers that ask for it
+coalesce_scan = 32  # queued jobs for the same model checked for compatibility
+job_backend = "files"  # "files" for one server process, "sqlite" to share jobs between processes
+job_database = "../jobs.sqlite3"
+channel_weights = {}  # share of dispatches for each channel next to the default of 1, e.g. {"bulk": 0.25}
+job_log = "../jobs.jsonl"  # jobs appended one JSON object per line, queued along with the folder
@@ -0,0 +1,338 @@
+# a stand-in for ComfyUI that "renders" prompts by sleeping, for benchmarks
+#
+# usage: python fake_comfy.py --port 8188 --delay 2.0 --size 1024x1024
+#
+# Implements the parts of the ComfyUI API the worker uses: POST /prompt,
+# POST /interrupt, GET /queue, POST /queue (delete only), the /ws websocket,
+# GET /history/<prompt_id> and GET /view. Prompts are run
+# one at a time, like a single GPU, and every SaveImage node in the prompt
+# outputs as many images of the configured size as the batch_size of the
+# EmptyLatentImage it comes from.
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+HISTORY_LIMIT = 10000  # finished prompts kept for /history and /view
+INTERRUPT_CHECK = 0.05  # seconds between checks for an interrupt while rendering
+
+
+def make_png(width: int, height: int) -> bytes:
+    # Noise does not compress, so the PNG is about as large as a real render
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    data = io.BytesIO()
+    image.save(data, format="PNG", compress_level=1)
+    return data.getvalue()
+
+
+def tag_png(png: bytes, text: str) -> bytes:
+    # Add a text chunk before IEND so every output is a distinct file
+    # without encoding a new image
+    data = b"fake_comfy\x00" + text.encode("utf-8")
+    chunk = struct.pack(">I", len(data)) + b"tEXt" + data
+    chunk += struct.pack(">I", zlib.crc32(b"tEXt" + data))
+    return png[:-12] + chunk + png[-12:]
+
+
+def batch_size(prompt: dict, node_id: str) -> int:
+    """Size of the latent batch a node's inputs lead back to, 1 if there is none."""
+    node = prompt[node_id]
+    if node.get("class_type") == "EmptyLatentImage":
+        return node["inputs"].get("batch_size", 1)
+
+    for value in node.get("inputs", {}).values():
+        # Links to other nodes are [node_id, output_index]
+        if isinstance(value, list) and len(value) == 2 and value[0] in prompt:
+            size = batch_size(prompt, value[0])
+            if size != 1:
+                return size
+    return 1
+
+
+def websocket_frame(payload: bytes, opcode: int = 0x1) -> bytes:
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 2**16:
+        header += bytes([126]) + struct.pack(">H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack(">Q", len(payload))
+    return header + payload
+
+
+def read_frame(stream) -> tuple[int, bytes] | None:
+    header = stream.read(2)
+    if len(header) < 2:
+        return None
+
+    opcode = header[0] & 0x0F
+    masked = header[1] & 0x80
+    length = header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", stream.read(2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", stream.read(8))[0]
+
+    mask = stream.read(4) if masked else b"\x00" * 4
+    payload = bytearray(stream.read(length))
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return opcode, bytes(payload)
+
+
+class FakeComfy:
+    def __init__(self, delay: float, width: int, height: int):
+        self.delay = delay
+        self.png = make_png(width, height)
+        self.lock = threading.Lock()
+        self.prompts = queue.Queue()
+        self.history: dict[str, dict] = {}
+        self.images: dict[str, bytes] = {}
+        self.sockets: dict[str, tuple] = {}  # client ID to (wfile, lock)
+        self.counter = 0
+        self.deleted: set[str] = set()
+        self.running = None
+        self.interrupted = threading.Event()
+
+    def queue_prompt(self, prompt: dict, client_id: str) -> dict:
+        prompt_id = str(uuid.uuid4())
+        with self.lock:
+            number = self.counter
+            self.counter += 1
+        self.prompts.put((prompt_id, prompt, client_id))
+        return {"prompt_id": prompt_id, "number": number, "node_errors": {}}
+
+    def delete(self, prompt_ids: list[str]):
+        with self.lock:
+            self.deleted.update(prompt_ids)
+
+    def queue(self) -> dict:
+        with self.lock:
+            running = [[0, self.running, {}, {}, []]] if self.running else []
+            pending = [
+                [number, prompt_id, {}, {}, []]
+                for number, (prompt_id, _, _) in enumerate(list(self.prompts.queue), start=1)
+                if prompt_id not in self.deleted
+            ]
+        return {"queue_running": running, "queue_pending": pending}
+
+    def interrupt(self, prompt_id: str | None):
+        # Like ComfyUI, only interrupt the given prompt if it is the one running
+        with self.lock:
+            if self.running is not None and prompt_id in (None, self.running):
+                self.interrupted.set()
+
+    def send(self, client_id: str, message: dict):
+        with self.lock:
+            target = self.sockets.get(client_id)
+        if target is None:
+            return
+
+        wfile, lock = target
+        try:
+            with lock:
+                wfile.write(websocket_frame(json.dumps(message).encode("utf-8")))
+                wfile.flush()
+        except OSError:
+            pass
+
+    def render(self, prompt_id: str, prompt: dict) -> dict:
+        deadline = time.monotonic() + self.delay
+        while time.monotonic() < deadline:
+            if self.interrupted.wait(min(INTERRUPT_CHECK, deadline - time.monotonic())):
+                return None
+
+        outputs = {}
+        for node_id, node in prompt.items():
+            if node.get("class_type") != "SaveImage":
+                continue
+
+            images = []
+            for i in range(batch_size(prompt, node_id)):
+                filename = f"{prompt_id}_{node_id}_{i}.png"
+                with self.lock:
+                    self.images[filename] = tag_png(self.png, filename)
+                images.append({"filename": filename, "subfolder": "", "type": "output"})
+            outputs[node_id] = {"images": images}
+        return outputs
+
+    def run(self):
+        while True:
+            prompt_id, prompt, client_id = self.prompts.get()
+            with self.lock:
+                if prompt_id in self.deleted:
+                    self.deleted.discard(prompt_id)
+                    continue
+                self.running = prompt_id
+                self.interrupted.clear()
+
+            self.send(
+                client_id,
+                {"type": "execution_start", "data": {"prompt_id": prompt_id}},
+            )
+            outputs = self.render(prompt_id, prompt)
+            with self.lock:
+                self.running = None
+
+            if outputs is None:
+                self.send(
+                    client_id,
+                    {"type": "execution_interrupted", "data": {"prompt_id": prompt_id}},
+                )
+                continue
+
+            with self.lock:
+                self.history[prompt_id] = {
+                    "outputs": outputs,
+                    "status": {"status_str": "success", "completed": True},
+                }
+                while len(self.history) > HISTORY_LIMIT:
+                    old_id = next(iter(self.history))
+                    for output in self.history.pop(old_id)["outputs"].values():
+                        for image in output["images"]:
+                            self.images.pop(image["filename"], None)
+
+            self.send(
+                client_id,
+                {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}},
+            )
+
+
+def make_handler(comfy: FakeComfy):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/prompt":
+                self.send_json(comfy.queue_prompt(body["prompt"], body.get("client_id")))
+            elif self.path == "/interrupt":
+                comfy.interrupt(body.get("prompt_id"))
+                self.send_json({})
+            elif self.path == "/queue":
+                comfy.delete(body.get("delete", []))
+                self.send_json({})
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/ws":
+                self.websocket(query.get("clientId", [""])[0])
+            elif url.path == "/queue":
+                self.send_json(comfy.queue())
+            elif url.path.startswith("/history/"):
+                prompt_id = url.path[len("/history/") :]
+                with comfy.lock:
+                    entry = comfy.history.get(prompt_id)
+                self.send_json({prompt_id: entry} if entry else {})
+            elif url.path == "/view":
+                with comfy.lock:
+                    data = comfy.images.get(query.get("filename", [""])[0])
+                if data is None:
+                    self.send_json({"error": "not found"}, 404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+        def websocket(self, client_id: str):
+            key = self.headers.get("Sec-WebSocket-Key", "")
+            accept = base64.b64encode(
+                hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()
+            ).decode("ascii")
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", accept)
+            self.end_headers()
+            self.wfile.flush()
+
+            lock = threading.Lock()
+            with comfy.lock:
+                comfy.sockets[client_id] = (self.wfile, lock)
+            comfy.send(client_id, {"type": "status", "data": {"sid": client_id}})
+
+            try:
+                while True:
+                    frame = read_frame(self.rfile)
+                    if frame is None or frame[0] == 0x8:
+                        break
+                    if frame[0] == 0x9:
+                        with lock:
+                            self.wfile.write(websocket_frame(frame[1], 0xA))
+                            self.wfile.flush()
+            except OSError:
+                pass
+            finally:
+                with comfy.lock:
+                    if comfy.sockets.get(client_id, (None,))[0] is self.wfile:
+                        del comfy.sockets[client_id]
+                self.close_connection = True
+
+    return Handler
+
+
+def serve(port: int, delay: float, width: int, height: int) -> ThreadingHTTPServer:
+    comfy = FakeComfy(delay, width, height)
+    threading.Thread(target=comfy.run, daemon=True).start()
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(comfy))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ComfyUI server for benchmarks")
+    parser.add_argument("--port", type=int, default=8188, help="Port to listen on")
+    parser.add_argument(
+        "--delay", type=float, default=2.0, help="Seconds each prompt takes to render"
+    )
+    parser.add_argument(
+        "--size", type=str, default="1024x1024", help="Size of the output images"
+    )
+    args = parser.parse_args()
+
+    width, height = (int(n) for n in args.size.split("x"))
+    server = serve(args.port, args.delay, width, height)
+    print(f"Fake ComfyUI listening on 127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
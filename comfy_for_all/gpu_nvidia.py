@@ -1,85 +1,278 @@
 import time
 import threading
-from pynvml import (
-    nvmlInit,
-    nvmlShutdown,
-    nvmlDeviceGetHandleByIndex,
-    nvmlDeviceGetUtilizationRates,
-    nvmlDeviceGetCount,
-)
+from collections import deque
 
 IDLE_TIMEOUT = 15 * 60  # 15 minutes
+IDLE_UTILIZATION = 10  # percent
+SAMPLE_INTERVAL = 1.0  # seconds
+SAMPLE_WINDOW = 60.0  # seconds
 
 
-class GPUIdleTimer:
-    def __init__(
-        self, gpu_index=0, idle_threshold=IDLE_TIMEOUT, start_time=None, last_time=None
-    ):
+class NvmlBackend:
+    """The parts of NVML the monitor uses, so a fake can stand in for it."""
+
+    def init(self):
+        # Imported here so the fake backend works without pynvml installed
+        import pynvml
+
+        self.nvml = pynvml
+        self.nvml.nvmlInit()
+
+    def shutdown(self):
+        self.nvml.nvmlShutdown()
+
+    def device_count(self) -> int:
+        return self.nvml.nvmlDeviceGetCount()
+
+    def handle(self, index):
+        return self.nvml.nvmlDeviceGetHandleByIndex(index)
+
+    def utilization(self, handle) -> int:
+        return self.nvml.nvmlDeviceGetUtilizationRates(handle).gpu
+
+    def memory(self, handle) -> tuple[int, int]:
+        info = self.nvml.nvmlDeviceGetMemoryInfo(handle)
+        return info.used, info.total
+
+
+class FakeNvml:
+    """An NVML stand-in with settable readings, for running without a GPU."""
+
+    def __init__(self, count=1, utilization=0, memory_total=24 * 2**30):
+        self.count = count
+        self.utilizations = [utilization] * count
+        self.memory_used = [0] * count
+        self.memory_total = memory_total
+
+    def init(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def device_count(self) -> int:
+        return self.count
+
+    def handle(self, index):
+        return index
+
+    def utilization(self, handle) -> int:
+        return self.utilizations[handle]
+
+    def memory(self, handle) -> tuple[int, int]:
+        return self.memory_used[handle], self.memory_total
+
+    def set_utilization(self, index, utilization):
+        self.utilizations[index] = utilization
+
+
+class GPUMonitor:
+    """
+    Samples every GPU from a background thread and keeps a sliding window of
+    utilization and memory readings for each one.
+
+    Listeners are called with (gpu_index, now, utilization) after every sample.
+    """
+
+    def __init__(self, backend=None, interval=SAMPLE_INTERVAL, window=SAMPLE_WINDOW):
+        self.backend = backend or NvmlBackend()
+        self.interval = interval
+        self.window = window
         self.loaded = False
-        self.gpu_index = gpu_index
-        self.idle_threshold = idle_threshold  # percent
-        self.idle_time = 0
-        self.start_time = start_time if start_time is not None else time.time()
-        self.last_time = last_time if last_time is not None else time.time()
+        self.lock = threading.Lock()
+        self.samples: dict[int, deque] = {}
+        self.listeners = []
+        self._handles = []
         self._stop_event = threading.Event()
         self._thread = None
 
-    def load_nvml(self):
+    def load(self) -> bool:
+        """Initialize the backend without sampling, returns whether it worked."""
         try:
-            nvmlInit()
+            self.backend.init()
+            # Handles are looked up once, not on every sample
+            self._handles = [
+                self.backend.handle(i) for i in range(self.backend.device_count())
+            ]
             self.loaded = True
-            print(f"Number of GPUs: {nvmlDeviceGetCount()}")
+            print(f"Number of GPUs: {len(self._handles)}")
         except Exception as e:
             print(f"Failed to initialize NVML: {e}")
+            return False
 
-    def unload_nvml(self):
-        if not self.loaded:
-            return
+        self.samples = {i: deque() for i in range(len(self._handles))}
+        return True
 
-        nvmlShutdown()
+    def start(self):
+        if self._thread is not None:
+            return self
+        if not self.loaded and not self.load():
+            return self
 
-    def reset(self, start_time=None, last_time=None):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self.loaded:
+            self.backend.shutdown()
+            self.loaded = False
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def sample(self, now=None):
+        now = now if now is not None else time.time()
+        for index, handle in enumerate(self._handles):
+            utilization = self.backend.utilization(handle)
+            memory_used, memory_total = self.backend.memory(handle)
+            with self.lock:
+                window = self.samples[index]
+                window.append((now, utilization, memory_used, memory_total))
+                while window and window[0][0] < now - self.window:
+                    window.popleft()
+
+            for listener in self.listeners:
+                listener(index, now, utilization)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Failed to sample GPUs: {e}")
+            self._stop_event.wait(self.interval)
+
+    def stats(self, index) -> dict | None:
+        """Windowed utilization and memory use for one GPU, None before the first sample."""
+        with self.lock:
+            window = list(self.samples.get(index, ()))
+        if not window:
+            return None
+
+        utilizations = [sample[1] for sample in window]
+        memory_used = [sample[2] for sample in window]
+        return {
+            "samples": len(window),
+            "utilization_mean": sum(utilizations) / len(window),
+            "utilization_max": max(utilizations),
+            "memory_used_mean": sum(memory_used) / len(window),
+            "memory_used_max": max(memory_used),
+            "memory_total": window[-1][3],
+        }
+
+
+class GPUIdleTimer:
+    def __init__(
+        self,
+        gpu_index=0,
+        idle_threshold=IDLE_TIMEOUT,
+        start_time=None,
+        last_time=None,
+        idle_utilization=IDLE_UTILIZATION,
+        monitor: GPUMonitor | None = None,
+        on_idle=None,
+    ):
+        self.gpu_index = gpu_index
+        self.idle_threshold = idle_threshold  # seconds
+        self.idle_utilization = idle_utilization  # percent
         self.idle_time = 0
         self.start_time = start_time if start_time is not None else time.time()
         self.last_time = last_time if last_time is not None else time.time()
+        self.monitor = monitor
+        self.on_idle = on_idle
+        self.own_work = False
+        self.idle_event = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.monitor is not None and self.monitor.loaded
+
+    def load_nvml(self):
+        if self.monitor is None:
+            self.monitor = GPUMonitor()
+        self.monitor.add_listener(self._on_sample)
+        self.monitor.start()
+
+    def unload_nvml(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+
+    def reset(self, start_time=None, last_time=None):
+        with self.lock:
+            self.idle_time = 0
+            self.start_time = start_time if start_time is not None else time.time()
+            self.last_time = last_time if last_time is not None else time.time()
+            self.idle_event.clear()
+
+    def set_own_work(self, own_work: bool):
+        """While our own jobs are running the GPU counts as idle, it is busy because of us."""
+        self.own_work = own_work
+
+    def _advance(self, now, idle):
+        with self.lock:
+            elapsed = max(0, now - self.last_time)
+            self.last_time = now
+            was_idle = self.has_reached_idle_threshold()
+            if idle or self.own_work:
+                self.idle_time += elapsed
+            else:
+                self.idle_time = 0
+
+            if self.has_reached_idle_threshold():
+                self.idle_event.set()
+            else:
+                self.idle_event.clear()
+
+        if self.has_reached_idle_threshold() and not was_idle and self.on_idle:
+            self.on_idle(self)
+
+    def _on_sample(self, index, now, utilization):
+        if index == self.gpu_index:
+            self._advance(now, utilization <= self.idle_utilization)
 
     def increment_timer(self, now=None):
+        # The monitor updates the timer after every sample while it runs
+        if self.loaded:
+            return
+
+        print("NVML not loaded, cannot check GPU utilization.")
         now = now if now is not None else time.time()
-        elapsed = now - self.last_time
-        self.last_time = now
-        if self.is_gpu_idle():
-            self.idle_time += elapsed
-        else:
-            self.idle_time = 0
+        self._advance(now, True)
 
     def has_reached_idle_threshold(self):
         return self.idle_time >= self.idle_threshold
 
-    def is_gpu_idle(self):
-        if not self.loaded:
-            print("NVML not loaded, cannot check GPU utilization.")
-            return True
-
-        handle = nvmlDeviceGetHandleByIndex(self.gpu_index)
-        util = nvmlDeviceGetUtilizationRates(handle)
-        return util.gpu <= self.idle_threshold
+    def wait_until_idle(self, timeout=None) -> bool:
+        return self.idle_event.wait(timeout)
 
 
 # Example usage:
 if __name__ == "__main__":
-    gpu_timer = GPUIdleTimer(gpu_index=0)
+    import sys
+
+    backend = FakeNvml() if "--fake" in sys.argv else None
+    monitor = GPUMonitor(backend)
+    gpu_timer = GPUIdleTimer(
+        gpu_index=0,
+        idle_threshold=10,
+        monitor=monitor,
+        on_idle=lambda timer: print(
+            f"GPU {timer.gpu_index} has been idle for {timer.idle_time:0.2f} seconds."
+        ),
+    )
     gpu_timer.load_nvml()
 
     try:
         while True:
-            gpu_timer.increment_timer()
-            if gpu_timer.has_reached_idle_threshold():
-                print(
-                    f"GPU {gpu_timer.gpu_index} has been idle for {gpu_timer.idle_time:0.2f} seconds."
-                )
-                # Perform any action needed when the GPU is idle
-                gpu_timer.reset()  # Reset the timer after action
-            time.sleep(1)  # Check every second
+            time.sleep(5)
+            for index in monitor.samples:
+                print(f"GPU {index}: {monitor.stats(index)}")
     except KeyboardInterrupt:
         print("Exiting...")
     finally:
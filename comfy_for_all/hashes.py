@@ -2,82 +2,525 @@ import os
 import hashlib
 import json
 import glob
+import multiprocessing
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from pydantic import BaseModel
 
-def load_hashes(checkpoint_db="checkpoint_db.json"):
-    if os.path.exists(checkpoint_db):
-        with open(checkpoint_db, "r") as file:
-            return json.load(file).get("hashes", [])
-    return []
+DEFAULT_HASH_WORKERS = 4
+HASH_BUFFER_SIZE = 8 * 2**20  # bytes read per chunk
+HASH_DB_VERSION = 3
+DEFAULT_WATCH_INTERVAL = 30  # seconds
+WATCH_SETTLE_TIME = 10  # seconds a new file must be unchanged before it is hashed
 
+FINGERPRINT_SAMPLES = 8  # blocks sampled across the file
+FINGERPRINT_BLOCK_SIZE = 64 * 2**10
+FINGERPRINT_MAX_HEADER = 100 * 2**20  # larger headers are sampled like the rest
 
-def hash_to_model_name(hash, hashes=None):
-    hashes = hashes or load_hashes()
-    for file_hash in hashes:
-        if file_hash[0] == hash:
-            print(file_hash[1])
-            return file_hash[1]
 
+class HashEntry(BaseModel):
+    sha256: str | None = None  # None until the full hash is known
+    fingerprint: str | None = None
+    verified: bool = True  # False while sha256 is only a fingerprint match
+    path: str  # relative to the hashed directory
+    size: int | None = None
+    mtime: float | None = None
 
-def save_hashes(hashes, checkpoint_db="checkpoint_db.json"):
-    with open(checkpoint_db, "w") as file:
-        json.dump({"hashes": hashes}, file, indent=4)
+
+class HashStore:
+    """
+    Known file hashes, indexed by hash, fingerprint and path.
+
+    Iterating yields (sha256, path) pairs for every file with a known hash,
+    like the list the JSON database used to hold.
+    """
+
+    def __init__(self, checkpoint_db="checkpoint_db.json"):
+        self.checkpoint_db = checkpoint_db
+        self.lock = threading.Lock()
+        self.by_path: dict[str, HashEntry] = {}
+        self.by_hash: dict[str, HashEntry] = {}
+        self.by_fingerprint: dict[str, HashEntry] = {}
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def __iter__(self):
+        with self.lock:
+            entries = list(self.by_path.values())
+        return iter([(entry.sha256, entry.path) for entry in entries if entry.sha256])
+
+    def load(self):
+        if not os.path.exists(self.checkpoint_db):
+            return self
+
+        with open(self.checkpoint_db, "r") as file:
+            data = json.load(file)
+
+        if data.get("version") in (2, HASH_DB_VERSION):
+            entries = [HashEntry(**entry) for entry in data.get("entries", [])]
+        else:
+            # Version 1 was a list of [hash, path] pairs. Without a size and
+            # mtime the first scan trusts the hash and records them.
+            print(f"Migrating {self.checkpoint_db} to version {HASH_DB_VERSION}")
+            entries = [
+                HashEntry(sha256=file_hash, path=path)
+                for file_hash, path in data.get("hashes", [])
+            ]
+
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def save(self):
+        with self.lock:
+            entries = [entry.model_dump() for entry in self.by_path.values()]
+
+        # Write the whole database once and swap it in, so a crash never
+        # leaves a half-written file behind
+        temp_db = f"{self.checkpoint_db}.tmp"
+        with open(temp_db, "w") as file:
+            json.dump({"version": HASH_DB_VERSION, "entries": entries}, file, indent=4)
+        os.replace(temp_db, self.checkpoint_db)
+
+    def _unindex(self, entry: HashEntry):
+        for index, key in (
+            (self.by_hash, entry.sha256),
+            (self.by_fingerprint, entry.fingerprint),
+        ):
+            if key is None or index.get(key) is not entry:
+                continue
+
+            del index[key]
+            # Another copy of the same file may still be around
+            for other in self.by_path.values():
+                if key in (other.sha256, other.fingerprint):
+                    index[key] = other
+                    break
+
+    def add(self, entry: HashEntry):
+        with self.lock:
+            old = self.by_path.pop(entry.path, None)
+            if old is not None:
+                self._unindex(old)
+            self.by_path[entry.path] = entry
+            if entry.sha256:
+                self.by_hash[entry.sha256] = entry
+            if entry.fingerprint:
+                self.by_fingerprint[entry.fingerprint] = entry
+
+    def remove(self, path: str):
+        with self.lock:
+            entry = self.by_path.pop(path, None)
+            if entry is not None:
+                self._unindex(entry)
+
+    def get(self, path: str) -> HashEntry | None:
+        return self.by_path.get(path)
+
+    def path_for(self, hash: str) -> str | None:
+        entry = self.by_hash.get(hash)
+        return entry.path if entry else None
+
+    def path_for_fingerprint(self, fingerprint: str) -> str | None:
+        entry = self.by_fingerprint.get(fingerprint)
+        return entry.path if entry else None
+
+    def hash_for_fingerprint(self, fingerprint: str) -> str | None:
+        entry = self.by_fingerprint.get(fingerprint)
+        return entry.sha256 if entry and entry.verified else None
+
+    def fingerprints(self) -> dict[str, str | None]:
+        """Fingerprints of every file, with the full hash of the verified ones."""
+        with self.lock:
+            entries = list(self.by_path.values())
+        return {
+            entry.fingerprint: entry.sha256 if entry.verified else None
+            for entry in entries
+            if entry.fingerprint
+        }
+
+    def unverified(self) -> list[str]:
+        with self.lock:
+            return [path for path, entry in self.by_path.items() if not entry.verified]
+
+
+def hash_to_model_name(hash, hashes: HashStore | None = None, fingerprint=None):
+    if hashes is None:
+        hashes = HashStore().load()
+    model_name = hashes.path_for(hash)
+    if model_name is None and fingerprint:
+        # The server matched our fingerprint to a hash we have not verified yet
+        model_name = hashes.path_for_fingerprint(fingerprint)
+    if model_name:
+        print(model_name)
+    return model_name
+
+
+def read_metadata(filepath) -> dict:
+    json_filepath = filepath.replace(".safetensors", ".metadata.json")
+    if not os.path.exists(json_filepath):
+        return {}
+
+    try:
+        with open(json_filepath, "r") as json_file:
+            return json.load(json_file)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Failed to read metadata JSON for {filepath}: {e}")
+        return {}
+
+
+def write_metadata(filepath, **values):
+    """Merge values into the file's .metadata.json, creating it if needed."""
+    json_filepath = filepath.replace(".safetensors", ".metadata.json")
+    data = read_metadata(filepath)
+    data.update(values)
+    try:
+        with open(f"{json_filepath}.tmp", "w") as json_file:
+            json.dump(data, json_file, indent=4)
+        os.replace(f"{json_filepath}.tmp", json_filepath)
+    except OSError as e:
+        # Model directories are often read-only mounts
+        print(f"Failed to write metadata JSON for {filepath}: {e}")
+
+
+def fingerprint_file(filepath) -> str:
+    """
+    A cheap identity for a model file: its size, safetensors header and a few
+    blocks sampled across the file, so it only reads around a megabyte.
+    """
+    fingerprint = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        fingerprint.update(struct.pack("<Q", size))
+
+        # Safetensors files start with the header length and a JSON header
+        # listing every tensor's name, shape and offsets
+        prefix = f.read(8)
+        fingerprint.update(prefix)
+        if len(prefix) == 8:
+            (header_size,) = struct.unpack("<Q", prefix)
+            if header_size <= FINGERPRINT_MAX_HEADER:
+                fingerprint.update(f.read(header_size))
+
+        for i in range(FINGERPRINT_SAMPLES):
+            f.seek(size * i // FINGERPRINT_SAMPLES)
+            fingerprint.update(f.read(FINGERPRINT_BLOCK_SIZE))
+
+        f.seek(max(0, size - FINGERPRINT_BLOCK_SIZE))
+        fingerprint.update(f.read(FINGERPRINT_BLOCK_SIZE))
+
+    return fingerprint.hexdigest()
 
 
 def hash_file(filepath):
     print(f"Hashing file: {filepath}")
 
     # check if JSON file exists and contains sha256 key
-    json_filepath = filepath.replace(".safetensors", ".metadata.json")
-    if os.path.exists(json_filepath):
-        print(
-            f"Found metadata JSON for {filepath}, using existing sha256 if available."
-        )
-        with open(json_filepath, "r") as json_file:
-            data = json.load(json_file)
-            if "sha256" in data:
-                return data["sha256"]
+    data = read_metadata(filepath)
+    if "sha256" in data:
+        print(f"Found metadata JSON for {filepath}, using existing sha256.")
+        return data["sha256"]
 
-    # otherwise, compute the hash of the file
+    # otherwise, compute the hash of the file, reading into one reused buffer
     print(f"Computing SHA256 for {filepath}")
     sha256 = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha256.update(chunk)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(filepath, "rb", buffering=0) as f:
+        while size := f.readinto(buffer):
+            sha256.update(view[:size])
     return sha256.hexdigest()
 
 
-def add_file_hash_if_new(root, filepath):
-    hashes = load_hashes()
+def lower_priority():
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass  # not supported on this platform
 
-    hash_name = os.path.relpath(filepath, start=root)
 
-    # Check if hash already exists in any [hash, filename] entry
-    if not any(entry[1] == hash_name for entry in hashes):
-        file_hash = hash_file(filepath)
-        hashes.append([file_hash, hash_name])
-        save_hashes(hashes)
-        print(f":white_check_mark: Added new hash for {hash_name}")
-    else:
-        print(f":warning: Hash for {hash_name} already exists.")
+def pool_context():
+    # HashWatcher hashes from a background thread, and forking a process that
+    # has other threads can hand the children locks that are never released
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
 
-    return hashes
 
+def hash_files(
+    filepaths: list[str], workers=DEFAULT_HASH_WORKERS, low_priority=False
+) -> dict[str, str]:
+    """Hash files in parallel worker processes, returns their hashes by path."""
+    if not filepaths:
+        return {}
 
-def hash_directory(root):
-    if not os.path.exists(root):
-        print(f"Directory {root} does not exist.")
-        return []
+    total_bytes = sum(os.path.getsize(filepath) for filepath in filepaths)
+    done_bytes = 0
+    start = time.monotonic()
+
+    def report(i, filepath):
+        nonlocal done_bytes
+        done_bytes += os.path.getsize(filepath)
+        elapsed = max(time.monotonic() - start, 1e-6)
+        print(
+            f"[{i}/{len(filepaths)}] Hashed {filepath}, "
+            f"{done_bytes / 2**20:0.0f}/{total_bytes / 2**20:0.0f} MiB "
+            f"at {done_bytes / 2**20 / elapsed:0.1f} MiB/s"
+        )
+
+    results = {}
+    workers = max(1, min(workers, len(filepaths)))
+    if workers == 1 and not low_priority:
+        for i, filepath in enumerate(filepaths, start=1):
+            results[filepath] = hash_file(filepath)
+            report(i, filepath)
+        return results
+
+    initializer = lower_priority if low_priority else None
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=pool_context(), initializer=initializer
+    ) as pool:
+        futures = {pool.submit(hash_file, filepath): filepath for filepath in filepaths}
+        for i, future in enumerate(as_completed(futures), start=1):
+            filepath = futures[future]
+            results[filepath] = future.result()
+            report(i, filepath)
+
+    return results
+
+
+def needs_hash(hashes: HashStore, hash_name, stat) -> bool:
+    """Check a file against its stored entry, returns True if it has to be hashed."""
+    entry = hashes.get(hash_name)
+    if entry is None:
+        return True
+
+    if entry.size is None:
+        # Migrated entry, keep its hash and start tracking the file
+        entry.size = stat.st_size
+        entry.mtime = stat.st_mtime
+        return False
+
+    if entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+        return False
+
+    print(f":warning: {hash_name} changed since it was hashed.")
+    return True
+
+
+def check_directory(hashes: HashStore, root, settle=0) -> tuple[list[str], bool]:
+    """
+    Compare a directory against the store without hashing anything.
+
+    Entries for removed or changed files are dropped so they are not
+    advertised, returns the files that need hashing and whether the store
+    changed. Files modified in the last settle seconds are left for later,
+    they may still be copying.
+    """
+    now = time.time()
 
     # Find all .safetensors files in the directory using globs
     files = glob.glob(os.path.join(root, "**", "*.safetensors"), recursive=True)
-    if not files:
-        print(f"No .safetensors files found in {root}.")
-        return []
 
-    print(f"Found {len(files)} .safetensors files in {root}.")
+    changed = False
+    found = set()
+    to_hash = []
     for filepath in files:
-        hashes = add_file_hash_if_new(root, filepath)
+        hash_name = os.path.relpath(filepath, start=root)
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            continue
+        found.add(hash_name)
+
+        entry = hashes.get(hash_name)
+        if entry is not None and entry.size is None:
+            changed = True  # migrated entry picks up its size and mtime
+        if needs_hash(hashes, hash_name, stat):
+            if entry is not None:
+                hashes.remove(hash_name)
+                changed = True
+            if now - stat.st_mtime >= settle:
+                to_hash.append(filepath)
+
+    # Forget files that are gone, so they are not advertised to the server
+    for path in list(hashes.by_path):
+        if path not in found:
+            print(f"{path} was removed, dropping its hash.")
+            hashes.remove(path)
+            changed = True
+
+    return to_hash, changed
+
+
+def identify_files(hashes: HashStore, root, to_hash: list[str]) -> bool:
+    """
+    Add new files to the store using only cheap checks, returns True if any were added.
+
+    A sha256 in the file's .metadata.json is trusted as before. Otherwise a
+    file whose fingerprint matches a verified entry, such as a renamed or
+    copied model, takes that entry's hash until its own full hash is checked.
+    Anything else is added without a hash and waits for verify_files.
+    """
+    added = False
+    for filepath in to_hash:
+        try:
+            stat = os.stat(filepath)
+            fingerprint = fingerprint_file(filepath)
+        except FileNotFoundError:
+            continue  # removed since the directory was checked
+
+        hash_name = os.path.relpath(filepath, start=root)
+        metadata_hash = read_metadata(filepath).get("sha256")
+        if metadata_hash:
+            sha256, verified = metadata_hash, True
+        else:
+            sha256, verified = hashes.hash_for_fingerprint(fingerprint), False
+
+        hashes.add(
+            HashEntry(
+                sha256=sha256,
+                fingerprint=fingerprint,
+                verified=verified,
+                path=hash_name,
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+            )
+        )
+        added = True
+        if sha256:
+            print(f":white_check_mark: Identified {hash_name}")
+
+    return added
+
+
+def verify_files(hashes: HashStore, root, workers, low_priority=False) -> bool:
+    """
+    Compute the full hash of every unverified file and write it back into the
+    file's .metadata.json, returns True if any were verified.
+    """
+    filepaths = [os.path.join(root, path) for path in hashes.unverified()]
+    verified = False
+    for filepath, file_hash in hash_files(filepaths, workers, low_priority).items():
+        hash_name = os.path.relpath(filepath, start=root)
+        entry = hashes.get(hash_name)
+        if entry is None:
+            continue  # removed while it was being hashed
+
+        if entry.sha256 and entry.sha256 != file_hash:
+            print(f":warning: {hash_name} matched a fingerprint but not its hash.")
+
+        hashes.add(entry.model_copy(update={"sha256": file_hash, "verified": True}))
+        write_metadata(filepath, sha256=file_hash, fingerprint=entry.fingerprint)
+        verified = True
+        print(f":white_check_mark: Added new hash for {hash_name}")
+
+    return verified
+
+
+def hash_directory(
+    root, checkpoint_db="checkpoint_db.json", workers=DEFAULT_HASH_WORKERS
+) -> HashStore:
+    if not os.path.exists(root):
+        print(f"Directory {root} does not exist.")
+        return HashStore(checkpoint_db)
+
+    hashes = HashStore(checkpoint_db).load()
+    to_hash, changed = check_directory(hashes, root)
+    print(f"Found {len(hashes) + len(to_hash)} .safetensors files in {root}.")
+
+    changed |= identify_files(hashes, root, to_hash)
+    changed |= verify_files(hashes, root, workers)
+    if changed:
+        hashes.save()
 
     print(f"Total hashes saved: {len(hashes)}")
     return hashes
+
+
+class HashWatcher:
+    """
+    Keeps a HashStore in step with a directory from a background thread.
+
+    Files whose size and mtime match the database are available as soon as
+    the watcher is created, and new files are fingerprinted so they can be
+    matched right away. Full hashes are computed in the background at low
+    priority, and the directory is checked again every interval seconds.
+    """
+
+    def __init__(
+        self,
+        root,
+        checkpoint_db="checkpoint_db.json",
+        workers=DEFAULT_HASH_WORKERS,
+        interval=DEFAULT_WATCH_INTERVAL,
+    ):
+        self.root = root
+        self.workers = workers
+        self.interval = interval
+        self.hashes = HashStore(checkpoint_db).load()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._exists = None
+
+        # Stat and fingerprint pass, so stale entries are never advertised
+        if os.path.exists(root):
+            self._exists = True
+            to_hash, changed = check_directory(self.hashes, root)
+            changed |= identify_files(self.hashes, root, to_hash)
+            if changed:
+                self.hashes.save()
+            print(
+                f"{len(self.hashes)} files in {root}, "
+                f"{len(self.hashes.unverified())} waiting for a full hash"
+            )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+    def scan(self):
+        exists = os.path.exists(self.root)
+        if exists != self._exists:
+            self._exists = exists
+            if not exists:
+                print(f"Directory {self.root} does not exist.")
+        if not exists:
+            if len(self.hashes):
+                for path in list(self.hashes.by_path):
+                    self.hashes.remove(path)
+                self.hashes.save()
+            return
+
+        to_hash, changed = check_directory(self.hashes, self.root, WATCH_SETTLE_TIME)
+        changed |= identify_files(self.hashes, self.root, to_hash)
+        if changed:
+            self.hashes.save()
+
+        unverified = self.hashes.unverified()
+        if unverified:
+            print(f"Hashing {len(unverified)} new or changed files in {self.root}")
+            if verify_files(self.hashes, self.root, self.workers, low_priority=True):
+                changed = True
+                self.hashes.save()
+
+        if changed:
+            print(f"Total hashes for {self.root}: {len(self.hashes)}")
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                print(f"Failed to scan {self.root}: {e}")
+            self._stop_event.wait(self.interval)
@@ -0,0 +1,85 @@
+# pooled HTTP sessions shared by everything that talks to the job server or ComfyUI
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_HTTP_POOL_SIZE = 8
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_HTTP_TIMEOUT = 30  # seconds
+
+
+def make_session(retries: int, pool_size: int) -> requests.Session:
+    # Connection failures and gateway errors are retried with backoff. Read
+    # errors are not, since get-job and /prompt are not safe to repeat once
+    # the server has seen them.
+    retry = Retry(
+        total=retries,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HttpClient:
+    """
+    Requests against one base URL over a keep-alive connection pool.
+
+    The transport is anything with a requests-style request(method, url,
+    **kwargs) method, so a local stand-in can replace the real session.
+    """
+
+    def __init__(self, base_url: str, timeout: float, transport):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.transport = transport
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.transport.request(method, self.base_url + path, **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+
+_clients: dict[str, HttpClient] = {}
+_clients_lock = threading.Lock()
+_transport = None
+
+
+def set_transport(transport):
+    """Send every request through transport instead of a pooled session, None to reset."""
+    global _transport
+    with _clients_lock:
+        _transport = transport
+        _clients.clear()
+
+
+def get_client(
+    base_url: str,
+    timeout: float = DEFAULT_HTTP_TIMEOUT,
+    retries: int = DEFAULT_HTTP_RETRIES,
+    pool_size: int = DEFAULT_HTTP_POOL_SIZE,
+) -> HttpClient:
+    """Return the shared client for base_url, creating its pool on first use."""
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            transport = _transport or make_session(retries, pool_size)
+            client = HttpClient(base_url, timeout, transport)
+            _clients[base_url] = client
+
+    return client
@@ -0,0 +1,745 @@
+# where the job server keeps its dispatch state: job files with a lease journal, or SQLite
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from job_log import JobLog
+from job_queue import RESCAN_GRACE, JobQueue, queue_key
+from leases import LeaseTable
+
+# A claimed job: its ID, the job data and the lease deadline
+Claim = tuple[str, dict, float]
+
+
+def new_worker_id() -> str:
+    # Random rather than counted, so IDs are unique across server processes
+    # and restarts without any coordination
+    return f"worker_{uuid.uuid4().hex[:12]}"
+
+
+def read_job(job_file: str) -> dict:
+    with open(job_file, "r") as f:
+        return json.load(f)
+
+
+class FileJobBackend:
+    """
+    Jobs indexed in memory from the queue folder and job log, with leases in a journal.
+
+    The state lives in this process, so it is only safe to serve from one
+    process, with any number of threads.
+    """
+
+    def __init__(
+        self,
+        queue_folder: str,
+        lease_journal: str,
+        lease_timeout: float,
+        job_log: str | None = None,
+        channel_weights: dict[str, float] | None = None,
+    ):
+        # Dispatched jobs are leased until they are uploaded or the lease
+        # expires, the journal keeps leased and completed jobs from being
+        # dispatched after a restart
+        self.lease_table = LeaseTable(lease_journal, lease_timeout)
+
+        # Index of queued jobs, leased and completed jobs are left out
+        self.job_queue = JobQueue(queue_folder, weights=channel_weights)
+        self.job_log = JobLog(job_log) if job_log else None
+        self.worker_models = {}  # the model each worker was last given
+        self.model_fingerprints = {}  # model hashes by file fingerprint
+
+    def open(self):
+        self.lease_table.load()
+        self.job_queue.ignore(self.lease_table.held())
+        self.job_queue.refresh(force=True)
+        self._refresh_log()
+        return self
+
+    def exists(self) -> bool:
+        return self.job_queue.exists() or self.job_log is not None
+
+    def register_worker(self) -> str:
+        return new_worker_id()
+
+    def refresh(self):
+        self.job_queue.refresh()
+        self._refresh_log()
+
+    def _refresh_log(self) -> int:
+        if self.job_log is None:
+            return 0
+
+        # Log records have no modification time, they queue in order of arrival
+        now = time.time()
+        added = 0
+        for job_name, job_data in self.job_log.refresh():
+            job_id = str(job_data.get("job_id", job_name))
+            if self.job_queue.add(job_name, now, queue_key(job_data), job_id):
+                added += 1
+
+        if added:
+            print(f"Indexed {added} new jobs from {self.job_log.path}, {len(self.job_queue)} queued")
+        return added
+
+    def _read(self, job_name: str) -> dict:
+        if self.job_log is not None and self.job_log.owns(job_name):
+            return self.job_log.read(job_name)
+        return read_job(os.path.join(self.job_queue.folder, job_name))
+
+    def expire(self) -> int:
+        """Return expired leases to the queue and return how many were requeued."""
+        requeued = 0
+        for lease in self.lease_table.expire():
+            print(f"Lease on job {lease.job_id} held by {lease.worker_id} expired, requeueing")
+            if self.job_queue.requeue(lease.job):
+                requeued += 1
+        return requeued
+
+    def release(self, job_ids: list[str], worker_id: str) -> int:
+        """Requeue jobs a worker gave back unrun and return how many were requeued."""
+        requeued = 0
+        for job_id in job_ids:
+            lease = self.lease_table.release(job_id, worker_id)
+            if lease is not None and self.job_queue.requeue(lease.job):
+                requeued += 1
+        return requeued
+
+    def _lease(self, worker_id: str, job_name: str, job_data: dict) -> Claim:
+        job_id = str(job_data.get("job_id", job_name))
+        lease = self.lease_table.grant(job_name, job_id, worker_id)
+        return job_id, job_data, lease.deadline
+
+    def claim(self, worker_id: str, models: list[str] | None, window: int) -> Claim | None:
+        # Take the next job for a model the worker has, by priority and
+        # channel, preferring its current model unless that would skip over
+        # too many older jobs. Jobs completed since they were requeued are
+        # dropped, ones that cannot be read right now are put back.
+        skipped = []
+        try:
+            while True:
+                job_name = self.job_queue.pop(
+                    models=models, prefer=self.worker_models.get(worker_id), window=window
+                )
+                if job_name is None:
+                    return None
+
+                if self.lease_table.is_completed(job_name):
+                    continue
+
+                try:
+                    job_data = self._read(job_name)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    skipped.append(job_name)
+                    continue
+
+                if not self._is_cancelled(job_name, job_data):
+                    break
+        finally:
+            for job_name in skipped:
+                self.job_queue.requeue(job_name)
+
+        self.worker_models[worker_id] = job_data.get("model")
+        return self._lease(worker_id, job_name, job_data)
+
+    def _is_cancelled(self, job_name: str, job_data: dict) -> bool:
+        # Cancelled jobs are only known by ID, so they are found as they are popped
+        return self.lease_table.is_cancelled(str(job_data.get("job_id", job_name)))
+
+    def claim_matching(
+        self, worker_id: str, model: str, match, limit: int, scan: int
+    ) -> list[Claim]:
+        # Lease queued jobs for model that match, looking at no more than
+        # scan of them. The ones that do not match are put back, and only
+        # the leased ones count against their channel.
+        claims = []
+        skipped = []
+        for _ in range(scan):
+            if len(claims) >= limit:
+                break
+
+            job_name = self.job_queue.pop(models=[model], charge=False)
+            if job_name is None:
+                break
+
+            if self.lease_table.is_completed(job_name):
+                continue
+
+            try:
+                job_data = self._read(job_name)
+            except (FileNotFoundError, json.JSONDecodeError):
+                skipped.append(job_name)
+                continue
+
+            if self._is_cancelled(job_name, job_data):
+                continue
+
+            if not match(job_data):
+                skipped.append(job_name)
+                continue
+
+            self.job_queue.charge(job_name)
+            claims.append(self._lease(worker_id, job_name, job_data))
+
+        for job_name in skipped:
+            self.job_queue.requeue(job_name, returning=False)
+
+        return claims
+
+    def settle(self, job_id: str, worker_id: str) -> dict | None:
+        """Mark a job as completed and return its data, or None if it was never leased."""
+        job_name = self.lease_table.settle(job_id, worker_id)
+        if job_name is None:
+            return None
+
+        try:
+            return self._read(job_name)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def submit(self, jobs: list[dict]):
+        """Append jobs to the job log and queue them."""
+        self.job_log.append(jobs)
+        self._refresh_log()
+
+    def cancel(self, job_id: str) -> tuple[str | None, str | None]:
+        """
+        Cancel a queued or leased job.
+
+        Returns the state the job was in, None for a job that was never
+        queued, and the worker it was leased to, if any. Only queued and
+        leased jobs are cancelled.
+        """
+        if self.lease_table.is_cancelled(job_id):
+            return "cancelled", None
+        if job_id not in self.lease_table.leases:
+            if self.lease_table.is_settled(job_id):
+                return "completed", None
+            if job_id not in self.lease_table.released and self.job_queue.find(job_id) is None:
+                return None, None
+
+        lease = self.lease_table.cancel(job_id)
+        if lease is None:
+            return "queued", None
+        return "leased", lease.worker_id
+
+    def cancelled(self, job_ids: list[str]) -> list[str]:
+        return [job_id for job_id in job_ids if self.lease_table.is_cancelled(job_id)]
+
+    def learn_fingerprint(self, fingerprint: str, model: str):
+        self.model_fingerprints[fingerprint] = model
+
+    def fingerprint_model(self, fingerprint: str) -> str | None:
+        return self.model_fingerprints.get(fingerprint)
+
+    def queue_depth(self) -> int:
+        return len(self.job_queue)
+
+    def outstanding(self) -> int:
+        return len(self.lease_table.leases)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    model TEXT,
+    mtime REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    worker_id TEXT,
+    deadline REAL,
+    data TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    channel TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, model, mtime, name);
+CREATE INDEX IF NOT EXISTS jobs_fair ON jobs (state, priority, channel, mtime, name);
+CREATE INDEX IF NOT EXISTS jobs_deadline ON jobs (state, deadline);
+CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    model TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    fingerprint TEXT PRIMARY KEY,
+    model TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_logs (
+    path TEXT PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    priority INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    pass REAL NOT NULL,
+    queued INTEGER NOT NULL,
+    PRIMARY KEY (priority, channel)
+);
+CREATE TRIGGER IF NOT EXISTS jobs_queued_insert AFTER INSERT ON jobs
+WHEN new.state = 'queued'
+BEGIN
+    INSERT INTO channels (priority, channel, pass, queued)
+    VALUES (
+        new.priority,
+        new.channel,
+        (SELECT COALESCE(MIN(pass), 0) FROM channels WHERE priority = new.priority AND queued > 0),
+        1
+    )
+    ON CONFLICT (priority, channel) DO UPDATE SET
+        pass = CASE WHEN queued = 0 THEN MAX(pass, excluded.pass) ELSE pass END,
+        queued = queued + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS jobs_queued_update AFTER UPDATE OF state ON jobs
+WHEN old.state != new.state
+BEGIN
+    UPDATE channels SET queued = queued - 1
+    WHERE old.state = 'queued' AND priority = old.priority AND channel = old.channel;
+    INSERT INTO channels (priority, channel, pass, queued)
+    SELECT
+        new.priority,
+        new.channel,
+        (SELECT COALESCE(MIN(pass), 0) FROM channels WHERE priority = new.priority AND queued > 0),
+        1
+    WHERE new.state = 'queued'
+    ON CONFLICT (priority, channel) DO UPDATE SET
+        pass = CASE WHEN queued = 0 THEN MAX(pass, excluded.pass) ELSE pass END,
+        queued = queued + 1;
+END;
+"""
+
+INSERT_JOB = (
+    "INSERT OR IGNORE INTO jobs (name, job_id, model, mtime, data, priority, channel) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def job_row(name: str, job_data: dict, mtime: float) -> tuple:
+    priority, channel, model = queue_key(job_data)
+    job_id = str(job_data.get("job_id", name))
+    return name, job_id, model, mtime, json.dumps(job_data), priority, channel
+
+
+class SqliteJobBackend:
+    """
+    Jobs and leases in a SQLite database in WAL mode.
+
+    Every claim runs in a write transaction, so any number of server
+    processes and threads can share the database without handing out the
+    same job twice. Queued jobs are shared between channels the same way as
+    in JobQueue, with the pass of each channel and a count of its queued jobs,
+    kept up to date by triggers, in the channels table. Job files and job log
+    records are copied into the
+    database when they are first seen, and how far the log has been read is
+    kept with them, so each record is read once by whichever process gets
+    to it first.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        queue_folder: str,
+        lease_timeout: float,
+        job_log: str | None = None,
+        channel_weights: dict[str, float] | None = None,
+    ):
+        self.database = database
+        self.queue_folder = queue_folder
+        self.lease_timeout = lease_timeout
+        self.job_log = JobLog(job_log) if job_log else None
+        self.weights = channel_weights or {}  # share of each channel, 1 if not listed
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._known: set[str] | None = None  # job files already in the database
+        self._folder_mtime = None
+        self._pid = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # One connection per thread, and new ones after a fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two claims can
+        # never read the same queued job
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def open(self):
+        self._migrate()
+        self.db.executescript(SCHEMA)
+        with self.transaction() as db:
+            # Count the queued jobs in each channel again, in case the database
+            # was written without the triggers
+            db.execute("UPDATE channels SET queued = 0")
+            db.execute(
+                "INSERT INTO channels (priority, channel, pass, queued) "
+                "SELECT priority, channel, 0, COUNT(*) FROM jobs WHERE state = 'queued' "
+                "GROUP BY priority, channel "
+                "ON CONFLICT (priority, channel) DO UPDATE SET queued = excluded.queued"
+            )
+        self.refresh(force=True)
+        return self
+
+    def _migrate(self):
+        # Databases from before priorities and channels were scheduled
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        if not columns or "priority" in columns:
+            return
+
+        with self.transaction() as db:
+            db.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+            db.execute("ALTER TABLE jobs ADD COLUMN channel TEXT NOT NULL DEFAULT ''")
+            db.execute(
+                "UPDATE jobs SET "
+                "priority = COALESCE(CAST(json_extract(data, '$.priority') AS INTEGER), 0), "
+                "channel = COALESCE(json_extract(data, '$.channel'), '')"
+            )
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.queue_folder) or self.job_log is not None
+
+    def register_worker(self) -> str:
+        worker_id = new_worker_id()
+        with self.transaction() as db:
+            db.execute(
+                "INSERT INTO workers (worker_id, created) VALUES (?, ?)",
+                (worker_id, time.time()),
+            )
+        return worker_id
+
+    def refresh(self, force=False) -> int:
+        """Copy job files and log records added since the last look into the database."""
+        return self._refresh_folder(force) + self._refresh_log()
+
+    def _refresh_folder(self, force=False) -> int:
+        try:
+            folder_mtime = os.stat(self.queue_folder).st_mtime
+        except FileNotFoundError:
+            return 0
+
+        with self.lock:
+            # Forked processes share the parent's view until they look again
+            if self._known is None or self._pid != os.getpid():
+                self._known = {row[0] for row in self.db.execute("SELECT name FROM jobs")}
+                self._pid = os.getpid()
+                force = True
+
+            if (
+                not force
+                and folder_mtime == self._folder_mtime
+                and time.time() - folder_mtime > RESCAN_GRACE
+            ):
+                return 0
+            self._folder_mtime = folder_mtime
+
+            rows = []
+            with os.scandir(self.queue_folder) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".json") or entry.name in self._known:
+                        continue
+
+                    try:
+                        mtime = entry.stat().st_mtime
+                        job_data = read_job(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    except json.JSONDecodeError:
+                        # Probably still being written, look again next time
+                        self._folder_mtime = None
+                        continue
+
+                    rows.append(job_row(entry.name, job_data, mtime))
+                    self._known.add(entry.name)
+
+            if rows:
+                with self.transaction() as db:
+                    db.executemany(INSERT_JOB, rows)
+                print(f"Indexed {len(rows)} new jobs")
+
+        return len(rows)
+
+    def _refresh_log(self) -> int:
+        if self.job_log is None or not self.job_log.pending():
+            return 0
+
+        with self.lock:
+            # Skip what other processes have already copied in
+            row = self.db.execute(
+                "SELECT position FROM job_logs WHERE path = ?", (self.job_log.path,)
+            ).fetchone()
+            if row is not None and row[0] > self.job_log.position:
+                self.job_log.position = row[0]
+
+            now = time.time()
+            rows = [
+                job_row(job_name, job_data, now)
+                for job_name, job_data in self.job_log.refresh()
+            ]
+            with self.transaction() as db:
+                db.executemany(INSERT_JOB, rows)
+                db.execute(
+                    "INSERT INTO job_logs (path, position) VALUES (?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET position = MAX(position, excluded.position)",
+                    (self.job_log.path, self.job_log.position),
+                )
+            if rows:
+                print(f"Indexed {len(rows)} new jobs from {self.job_log.path}")
+
+        return len(rows)
+
+    def submit(self, jobs: list[dict]):
+        """Append jobs to the job log and queue them."""
+        self.job_log.append(jobs)
+        self._refresh_log()
+
+    def expire(self, now=None) -> int:
+        now = now if now is not None else time.time()
+        # Check before taking the write lock, expired leases are rare
+        if self.db.execute(
+            "SELECT 1 FROM jobs WHERE state = 'leased' AND deadline < ? LIMIT 1", (now,)
+        ).fetchone() is None:
+            return 0
+
+        with self.transaction() as db:
+            # The worker is kept, so an upload that arrives late still counts
+            cursor = db.execute(
+                "UPDATE jobs SET state = 'queued', deadline = NULL "
+                "WHERE state = 'leased' AND deadline < ?",
+                (now,),
+            )
+        if cursor.rowcount:
+            print(f"Requeued {cursor.rowcount} jobs with expired leases")
+        return cursor.rowcount
+
+    def release(self, job_ids: list[str], worker_id: str) -> int:
+        if not job_ids:
+            return 0
+
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET state = 'queued', deadline = NULL "
+                "WHERE state = 'leased' AND worker_id = ? "
+                f"AND job_id IN ({','.join('?' * len(job_ids))})",
+                [worker_id] + list(job_ids),
+            )
+        return cursor.rowcount
+
+    def _model_filter(self, models: list[str] | None) -> tuple[str, list]:
+        if models is None:
+            return "", []
+        return f" AND model IN ({','.join('?' * len(models))})", list(models)
+
+    def _lease(self, db, worker_id: str, name: str, job_id: str, data: str) -> Claim:
+        deadline = time.time() + self.lease_timeout
+        db.execute(
+            "UPDATE jobs SET state = 'leased', worker_id = ?, deadline = ? WHERE name = ?",
+            (worker_id, deadline, name),
+        )
+        return job_id, json.loads(data), deadline
+
+    def _charge(self, db, priority: int, channel: str):
+        # Move the channel along by one job, less for channels with more weight
+        db.execute(
+            "UPDATE channels SET pass = pass + ? WHERE priority = ? AND channel = ?",
+            (1 / self.weights.get(channel, 1), priority, channel),
+        )
+
+    def claim(self, worker_id: str, models: list[str] | None, window: int) -> Claim | None:
+        if models is not None and not models:
+            return None
+
+        model_filter, params = self._model_filter(models)
+        oldest = (
+            "SELECT name, job_id, model, mtime, data FROM jobs "
+            "WHERE state = 'queued' AND priority = ? AND channel = ?{} "
+            "ORDER BY mtime, name LIMIT 1"
+        )
+        with self.transaction() as db:
+            # The highest priority first, then the channel with the lowest
+            # pass, or with the oldest job on a tie, that has a job the worker
+            # can run
+            turns = db.execute(
+                "SELECT priority, channel FROM channels WHERE queued > 0 "
+                "ORDER BY priority DESC, pass, (SELECT MIN(mtime) FROM jobs "
+                "WHERE state = 'queued' AND jobs.priority = channels.priority "
+                "AND jobs.channel = channels.channel)"
+            ).fetchall()
+            for priority, channel in turns:
+                row = db.execute(
+                    oldest.format(model_filter), [priority, channel] + params
+                ).fetchone()
+                if row is not None:
+                    break
+            else:
+                return None
+
+            # Prefer the worker's current model unless that would skip over
+            # window or more older jobs in the channel
+            prefer = db.execute(
+                "SELECT model FROM workers WHERE worker_id = ?", (worker_id,)
+            ).fetchone()
+            prefer = prefer[0] if prefer else None
+            if (
+                prefer is not None
+                and prefer != row[2]
+                and window > 0
+                and (models is None or prefer in models)
+            ):
+                preferred = db.execute(
+                    oldest.format(" AND model = ?"), [priority, channel, prefer]
+                ).fetchone()
+                if preferred is not None:
+                    older = db.execute(
+                        "SELECT COUNT(*) FROM (SELECT 1 FROM jobs WHERE state = 'queued' "
+                        f"AND priority = ? AND channel = ?{model_filter} "
+                        "AND model != ? AND mtime < ? LIMIT ?)",
+                        [priority, channel] + params + [prefer, preferred[3], window],
+                    ).fetchone()[0]
+                    if older < window:
+                        row = preferred
+
+            name, job_id, model, _, data = row
+            db.execute(
+                "INSERT INTO workers (worker_id, model, created) VALUES (?, ?, ?) "
+                "ON CONFLICT (worker_id) DO UPDATE SET model = excluded.model",
+                (worker_id, model, time.time()),
+            )
+            self._charge(db, priority, channel)
+            return self._lease(db, worker_id, name, job_id, data)
+
+    def claim_matching(
+        self, worker_id: str, model: str, match, limit: int, scan: int
+    ) -> list[Claim]:
+        claims = []
+        with self.transaction() as db:
+            rows = db.execute(
+                "SELECT name, job_id, data, priority, channel FROM jobs "
+                "WHERE state = 'queued' AND model = ? "
+                "ORDER BY priority DESC, mtime, name LIMIT ?",
+                (model, scan),
+            ).fetchall()
+            for name, job_id, data, priority, channel in rows:
+                if len(claims) >= limit:
+                    break
+                if match(json.loads(data)):
+                    self._charge(db, priority, channel)
+                    claims.append(self._lease(db, worker_id, name, job_id, data))
+
+        return claims
+
+    def settle(self, job_id: str, worker_id: str) -> dict | None:
+        with self.transaction() as db:
+            # Leased, or requeued after its lease expired but not yet
+            # dispatched again, either way the work is done
+            row = db.execute(
+                "SELECT name, worker_id, data FROM jobs WHERE job_id = ? "
+                "AND state IN ('leased', 'queued') AND worker_id IS NOT NULL LIMIT 1",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            name, leased_to, data = row
+            if leased_to != worker_id:
+                print(f"Job {job_id} completed by {worker_id} but leased to {leased_to}")
+            db.execute(
+                "UPDATE jobs SET state = 'completed', deadline = NULL WHERE name = ?", (name,)
+            )
+        return json.loads(data)
+
+    def cancel(self, job_id: str) -> tuple[str | None, str | None]:
+        with self.transaction() as db:
+            # A job that is still queued or leased under this ID comes first
+            row = db.execute(
+                "SELECT state, worker_id FROM jobs WHERE job_id = ? "
+                "ORDER BY state IN ('leased', 'queued') DESC LIMIT 1",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None, None
+
+            state, worker_id = row
+            if state not in ("leased", "queued"):
+                return state, None
+            db.execute(
+                "UPDATE jobs SET state = 'cancelled', deadline = NULL "
+                "WHERE job_id = ? AND state IN ('leased', 'queued')",
+                (job_id,),
+            )
+        return state, worker_id if state == "leased" else None
+
+    def cancelled(self, job_ids: list[str]) -> list[str]:
+        if not job_ids:
+            return []
+
+        rows = self.db.execute(
+            f"SELECT job_id FROM jobs WHERE state = 'cancelled' "
+            f"AND job_id IN ({','.join('?' * len(job_ids))})",
+            list(job_ids),
+        )
+        return [row[0] for row in rows]
+
+    def learn_fingerprint(self, fingerprint: str, model: str):
+        if self.fingerprint_model(fingerprint) == model:
+            return
+
+        with self.transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO fingerprints (fingerprint, model) VALUES (?, ?)",
+                (fingerprint, model),
+            )
+
+    def fingerprint_model(self, fingerprint: str) -> str | None:
+        row = self.db.execute(
+            "SELECT model FROM fingerprints WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def queue_depth(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def outstanding(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'leased'").fetchone()[0]
+
+
+def make_backend(config):
+    """The backend named by config.job_backend, opened."""
+    backend = getattr(config, "job_backend", "files")
+    job_log = getattr(config, "job_log", None)
+    channel_weights = getattr(config, "channel_weights", None)
+    if backend == "files":
+        return FileJobBackend(
+            config.queue_folder,
+            config.lease_journal,
+            config.lease_timeout,
+            job_log,
+            channel_weights,
+        ).open()
+    if backend == "sqlite":
+        return SqliteJobBackend(
+            config.job_database,
+            config.queue_folder,
+            config.lease_timeout,
+            job_log,
+            channel_weights,
+        ).open()
+    raise ValueError(f"Unknown job backend {backend!r}, expected 'files' or 'sqlite'")
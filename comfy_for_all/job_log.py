@@ -0,0 +1,95 @@
+# an append-only JSON lines file of jobs, read incrementally and by offset
+
+import fcntl
+import json
+import os
+import threading
+
+
+class JobLog:
+    """
+    Jobs stored one JSON object per line in a file that is only ever appended to.
+
+    Each record is named <log file name>@<byte offset>, so the name is all the
+    index needed to read it back: a claimed job costs one seek and one line,
+    and nothing is kept in memory for queued jobs beyond their names. Lines
+    appended since the last refresh are parsed as they show up, a last line
+    without a newline is still being written and is left for next time.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.prefix = os.path.basename(path) + "@"
+        self.position = 0  # bytes of the log already indexed
+        self.lock = threading.Lock()
+
+    def owns(self, name: str) -> bool:
+        return name.startswith(self.prefix)
+
+    def name(self, offset: int) -> str:
+        # Padded so names sort in log order, which breaks ties in arrival time
+        return f"{self.prefix}{offset:015d}"
+
+    def offset(self, name: str) -> int:
+        return int(name[len(self.prefix) :])
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def pending(self) -> bool:
+        """Whether there are lines after the ones already indexed."""
+        return self.size() > self.position
+
+    def refresh(self) -> list[tuple[str, dict]]:
+        """Parse the records appended since the last refresh, as (name, job data)."""
+        with self.lock:
+            size = self.size()
+            if size < self.position:
+                # Offsets name the jobs in leases and the database, so a log
+                # that was truncated or replaced cannot be followed
+                print(f"Job log {self.path} shrank to {size} bytes, it must only be appended to")
+                return []
+            if size == self.position:
+                return []
+
+            records = []
+            with open(self.path, "rb") as f:
+                f.seek(self.position)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # still being written
+
+                    offset = self.position
+                    self.position += len(line)
+                    if not line.strip():
+                        continue
+
+                    try:
+                        records.append((self.name(offset), json.loads(line)))
+                    except json.JSONDecodeError:
+                        print(f"Skipping unreadable job at {self.path}:{offset}")
+
+        return records
+
+    def read(self, name: str) -> dict:
+        """The job data for one record, read straight from its offset."""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset(name))
+            return json.loads(f.readline())
+
+    def append(self, jobs: list[dict]):
+        """Add jobs to the end of the log in one write."""
+        data = b"".join(
+            json.dumps(job, separators=(",", ":")).encode("utf-8") + b"\n" for job in jobs
+        )
+        with open(self.path, "ab") as f:
+            # Other server processes may be appending too
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(data)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,295 @@
+# index of queued jobs by priority, channel and model, shared fairly between channels
+
+import heapq
+import json
+import os
+import threading
+import time
+
+# Directory timestamps are coarse on most filesystems, so a folder that changed
+# this recently is rescanned even if its mtime matches the last scan.
+RESCAN_GRACE = 2.0  # seconds
+
+# Where a job sits in the queue: its priority, channel and model
+QueueKey = tuple[int, str, str | None]
+
+
+def queue_key(job_data: dict) -> QueueKey:
+    try:
+        priority = int(job_data.get("priority") or 0)
+    except (TypeError, ValueError):
+        priority = 0
+    return priority, str(job_data.get("channel") or ""), job_data.get("model")
+
+
+def count_below(heap: list, key, limit: int) -> int:
+    """Count heap entries smaller than key, stopping at limit, without popping."""
+    count = 0
+    stack = [0] if heap else []
+    while stack and count < limit:
+        i = stack.pop()
+        if heap[i] >= key:
+            continue  # nothing below this entry can be smaller either
+
+        count += 1
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < len(heap):
+                stack.append(child)
+
+    return min(count, limit)
+
+
+def pop_oldest(heaps: dict[str, list], models=None, prefer=None, window=0) -> str | None:
+    """
+    Remove the oldest job for one of the given models from heaps of jobs by model.
+
+    A job for the preferred model is taken instead, as long as fewer than
+    window older jobs would be passed over for it.
+    """
+    if models is None:
+        candidates = list(heaps)
+    else:
+        candidates = [model for model in models if model in heaps]
+
+    if not candidates:
+        return None
+
+    model = min(candidates, key=lambda m: heaps[m][0])
+    if prefer in candidates and prefer != model and window > 0:
+        key = heaps[prefer][0]
+        older = 0
+        for other in candidates:
+            if other != prefer and older < window:
+                older += count_below(heaps[other], key, window - older)
+        if older < window:
+            model = prefer
+
+    heap = heaps[model]
+    _, name = heapq.heappop(heap)
+    if not heap:
+        del heaps[model]
+    return name
+
+
+class JobQueue:
+    """
+    Queued jobs by priority, then channel, then model, oldest first in each.
+
+    Higher priorities are always dispatched first. Within a priority, channels
+    take turns by weighted fair queuing: every channel has a virtual pass that
+    advances by 1 / weight for each job it is given, and the channel with the
+    lowest pass goes next, so one channel with a large backlog cannot hold up
+    the others. A channel that comes back after running dry starts at the
+    lowest pass of the busy ones, rather than with credit for the time it
+    was idle.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        extension: str = ".json",
+        weights: dict[str, float] | None = None,
+    ):
+        self.folder = folder
+        self.extension = extension
+        self.weights = weights or {}  # share of each channel, 1 if not listed
+        self.lock = threading.Lock()
+        # Queued jobs as (mtime, name) heaps by priority, channel and model
+        self._levels: dict[int, dict[str, dict[str, list[tuple[float, str]]]]] = {}
+        self._passes: dict[tuple[int, str], float] = {}
+        self._keys: dict[str, QueueKey] = {}  # queue key of every indexed job by name
+        self._ids: dict[str, str] = {}  # name of every indexed job by job ID
+        self._known: set[str] = set()
+        self._external: dict[str, float] = {}  # arrival time of jobs kept outside the folder
+        self._size = 0
+        self._folder_mtime = None
+
+    def __len__(self):
+        return self._size
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.folder)
+
+    def _read_key(self, name: str) -> QueueKey:
+        with open(os.path.join(self.folder, name), "r") as f:
+            return queue_key(json.load(f))
+
+    def _push(self, name: str, mtime: float, key: QueueKey, returning=True):
+        priority, channel, model = key
+        channels = self._levels.setdefault(priority, {})
+        if returning and channel not in channels:
+            # Busy channels are not held back for one that was idle
+            busy = [self._passes[(priority, other)] for other in channels]
+            start = min(busy, default=self._passes.get((priority, channel), 0.0))
+            self._passes[(priority, channel)] = max(
+                self._passes.get((priority, channel), 0.0), start
+            )
+
+        heapq.heappush(channels.setdefault(channel, {}).setdefault(model, []), (mtime, name))
+        self._size += 1
+
+    def refresh(self, force=False) -> int:
+        """Index job files added since the last scan and return how many were found."""
+        try:
+            folder_mtime = os.stat(self.folder).st_mtime
+        except FileNotFoundError:
+            return 0
+
+        with self.lock:
+            if (
+                not force
+                and folder_mtime == self._folder_mtime
+                and time.time() - folder_mtime > RESCAN_GRACE
+            ):
+                return 0
+            self._folder_mtime = folder_mtime
+
+            added = 0
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(self.extension):
+                        continue
+                    if entry.name in self._known:
+                        continue
+
+                    try:
+                        mtime = entry.stat().st_mtime
+                        with open(entry.path, "r") as f:
+                            job_data = json.load(f)
+                    except FileNotFoundError:
+                        continue
+                    except json.JSONDecodeError:
+                        # Probably still being written, look again next time
+                        self._folder_mtime = None
+                        continue
+
+                    key = queue_key(job_data)
+                    self._known.add(entry.name)
+                    self._keys[entry.name] = key
+                    self._ids[str(job_data.get("job_id", entry.name))] = entry.name
+                    self._push(entry.name, mtime, key)
+                    added += 1
+
+        if added:
+            print(f"Indexed {added} new jobs, {self._size} queued")
+        return added
+
+    def add(self, name: str, mtime: float, key: QueueKey, job_id: str | None = None) -> bool:
+        """
+        Index a job that is not a file in the folder, e.g. a record in a job log.
+
+        Ignored jobs are remembered but not queued, so they can be requeued
+        if their lease expires.
+        """
+        with self.lock:
+            self._keys[name] = key
+            self._external[name] = mtime
+            if job_id is not None:
+                self._ids[job_id] = name
+            if name in self._known:
+                return False
+
+            self._known.add(name)
+            self._push(name, mtime, key)
+        return True
+
+    def find(self, job_id: str) -> str | None:
+        """Name of the indexed job with this job ID, whether or not it is still queued."""
+        with self.lock:
+            return self._ids.get(job_id)
+
+    def ignore(self, names):
+        """Never index these job files, e.g. ones that are leased or completed."""
+        with self.lock:
+            self._known.update(names)
+
+    def requeue(self, name: str, returning=True) -> bool:
+        """
+        Put a previously dispatched job back in the queue.
+
+        Jobs that were only looked at with pop(charge=False) are put back with
+        returning=False, so a channel they emptied keeps its pass instead of
+        being treated as one that was idle.
+        """
+        if name in self._external:
+            mtime = self._external[name]
+            key = self._keys[name]
+        else:
+            try:
+                mtime = os.path.getmtime(os.path.join(self.folder, name))
+                key = self._keys.get(name) or self._read_key(name)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return False
+
+        with self.lock:
+            self._known.add(name)
+            self._keys[name] = key
+            self._push(name, mtime, key, returning)
+        return True
+
+    def _next_channel(self, priority: int, models) -> str | None:
+        # The channel with the lowest pass that has a job for one of the
+        # models, the one with the oldest job on a tie
+        best = None
+        for channel, heaps in self._levels[priority].items():
+            if models is None:
+                oldest = min(heap[0] for heap in heaps.values())
+            else:
+                heads = [heaps[model][0] for model in models if model in heaps]
+                if not heads:
+                    continue
+                oldest = min(heads)
+
+            rank = (self._passes[(priority, channel)], oldest)
+            if best is None or rank < best[0]:
+                best = (rank, channel)
+
+        return best[1] if best else None
+
+    def charge(self, name: str):
+        """Count a dispatched job against its channel's share."""
+        priority, channel, _ = self._keys[name]
+        with self.lock:
+            self._passes[(priority, channel)] += 1 / self.weights.get(channel, 1)
+
+    def pop(self, models=None, prefer=None, window=0, charge=True) -> str | None:
+        """
+        Remove the next job for one of the given models and return its name.
+
+        The job comes from the highest priority that has one, and from the
+        channel whose turn it is there. Within the channel the oldest job is
+        taken, or a job for the preferred model as long as fewer than window
+        older jobs in the channel would be passed over for it.
+
+        Jobs taken with charge=False do not count against their channel until
+        they are passed to charge, so ones that are looked at and put back,
+        like coalescing candidates, do not cost the channel its turn.
+        """
+        with self.lock:
+            while True:
+                for priority in sorted(self._levels, reverse=True):
+                    channel = self._next_channel(priority, models)
+                    if channel is not None:
+                        break
+                else:
+                    return None
+
+                channels = self._levels[priority]
+                name = pop_oldest(channels[channel], models, prefer, window)
+                self._size -= 1
+                if charge:
+                    self._passes[(priority, channel)] += 1 / self.weights.get(channel, 1)
+                if not channels[channel]:
+                    del channels[channel]
+                    if not channels:
+                        del self._levels[priority]
+
+                if name in self._external:
+                    return name
+                if os.path.exists(os.path.join(self.folder, name)):
+                    return name
+
+                # The file was removed after it was indexed, forget it so it
+                # can be picked up again if it comes back
+                self._known.discard(name)
+                self._keys.pop(name, None)
@@ -0,0 +1,156 @@
+# job leases, persisted in an append-only journal that is replayed on startup
+
+import json
+import os
+import threading
+import time
+
+from pydantic import BaseModel
+
+
+class Lease(BaseModel):
+    job: str  # job file name in the queue folder
+    job_id: str
+    worker_id: str
+    deadline: float
+
+
+class LeaseTable:
+    def __init__(self, journal_path: str, timeout: float):
+        self.journal_path = journal_path
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.leases: dict[str, Lease] = {}  # outstanding leases by job ID
+        self.completed: set[str] = set()  # job file names
+        self.settled: set[str] = set()  # job IDs of uploaded jobs
+        self.released: dict[str, str] = {}  # job file names of expired leases by job ID
+        self.cancelled: set[str] = set()  # job IDs
+        self._journal = None
+
+    def load(self):
+        """Replay the journal and open it for appending."""
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as f:
+                for line_number, line in enumerate(f, start=1):
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write from a crash can only be the last line
+                        print(f"Skipping corrupt journal line {line_number}")
+                        continue
+
+                    self._apply(entry)
+
+            print(
+                f"Replayed lease journal: {len(self.leases)} outstanding, "
+                f"{len(self.completed)} completed"
+            )
+
+        self._journal = open(self.journal_path, "a")
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def _apply(self, entry: dict):
+        event = entry.get("event")
+        if event == "grant":
+            lease = Lease(**entry["lease"])
+            self.leases[lease.job_id] = lease
+            self.released.pop(lease.job_id, None)
+        elif event == "settle":
+            self.leases.pop(entry["job_id"], None)
+            self.released.pop(entry["job_id"], None)
+            self.completed.add(entry["job"])
+            self.settled.add(entry["job_id"])
+        elif event == "expire":
+            lease = self.leases.pop(entry["job_id"], None)
+            if lease:
+                self.released[lease.job_id] = lease.job
+        elif event == "cancel":
+            lease = self.leases.pop(entry["job_id"], None)
+            job = lease.job if lease else self.released.pop(entry["job_id"], None)
+            if job:
+                self.completed.add(job)
+            self.cancelled.add(entry["job_id"])
+
+    def _append(self, entry: dict):
+        self._apply(entry)
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def held(self) -> set[str]:
+        """Job file names that must not be dispatched: leased or completed."""
+        with self.lock:
+            return self.completed | {lease.job for lease in self.leases.values()}
+
+    def is_completed(self, job: str) -> bool:
+        return job in self.completed
+
+    def grant(self, job: str, job_id: str, worker_id: str, now=None) -> Lease:
+        now = now if now is not None else time.time()
+        lease = Lease(
+            job=job, job_id=job_id, worker_id=worker_id, deadline=now + self.timeout
+        )
+        with self.lock:
+            self._append({"event": "grant", "lease": lease.model_dump()})
+        return lease
+
+    def settle(self, job_id: str, worker_id: str) -> str | None:
+        """Mark a job as completed and return its file name, or None if it was never leased."""
+        with self.lock:
+            lease = self.leases.get(job_id)
+            if lease is not None:
+                job = lease.job
+                if lease.worker_id != worker_id:
+                    # The lease expired and was handed to someone else, the
+                    # work is done either way
+                    print(
+                        f"Job {job_id} completed by {worker_id} but leased to {lease.worker_id}"
+                    )
+            elif job_id in self.released:
+                # Finished after the lease expired, but before it was dispatched again
+                job = self.released[job_id]
+            else:
+                return None
+
+            self._append({"event": "settle", "job_id": job_id, "job": job})
+            return job
+
+    def release(self, job_id: str, worker_id: str) -> Lease | None:
+        """End a lease the worker gave back and return it so it can be requeued."""
+        with self.lock:
+            lease = self.leases.get(job_id)
+            if lease is None or lease.worker_id != worker_id:
+                return None
+            # Replays like an expired lease, a late upload still settles it
+            self._append({"event": "expire", "job_id": job_id})
+        return lease
+
+    def is_settled(self, job_id: str) -> bool:
+        return job_id in self.settled
+
+    def is_cancelled(self, job_id: str) -> bool:
+        return job_id in self.cancelled
+
+    def cancel(self, job_id: str) -> Lease | None:
+        """Cancel a job so it is never dispatched again, and return its lease if it had one."""
+        with self.lock:
+            lease = self.leases.get(job_id)
+            self._append({"event": "cancel", "job_id": job_id})
+        return lease
+
+    def expire(self, now=None) -> list[Lease]:
+        """Drop leases past their deadline and return them so they can be requeued."""
+        now = now if now is not None else time.time()
+        with self.lock:
+            expired = [lease for lease in self.leases.values() if lease.deadline < now]
+            for lease in expired:
+                self._append({"event": "expire", "job_id": lease.job_id})
+
+        return expired
@@ -10,9 +10,14 @@ class ImageJob(BaseModel):
     requested_prompt: str
     negative_prompt: str | None = None
     model: str
+    model_fingerprint: str | None = None
     steps: int
     channel: str
     image_link: str | None = None
     resolution: str
     batch_size: int
     config_scale: int
+    # Random for every run unless the request picked one
+    seed: int | None = None
+    # Compatible jobs the server handed out to run in the same prompt as this one
+    coalesced: list["ImageJob"] = []
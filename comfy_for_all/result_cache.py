@@ -0,0 +1,106 @@
+# images from finished prompts kept on disk, so repeated requests skip the GPU
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_EXTENSION = ".png"
+
+
+def graph_key(prompt: dict) -> str:
+    """Hash of a ComfyUI graph that does not depend on key order or formatting."""
+    canonical = json.dumps(prompt, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Output images by graph key, least recently used entries evicted past max_bytes.
+
+    Each entry is a folder entries/<key>/ holding 0.png, 1.png, ... in output
+    order. The folder's modification time is bumped on every hit, so the LRU
+    order survives a restart.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.entries = os.path.join(root, "entries")
+        self.tmp = os.path.join(root, "tmp")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index: OrderedDict[str, int] = OrderedDict()  # key to size, oldest first
+        self.size = 0
+
+    def open(self):
+        for folder in (self.entries, self.tmp):
+            os.makedirs(folder, exist_ok=True)
+
+        # Entries that were cut off by a restart never made it into the cache
+        with os.scandir(self.tmp) as entries:
+            for entry in entries:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        found = []
+        with os.scandir(self.entries) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    size = sum(image.stat().st_size for image in os.scandir(entry.path))
+                    found.append((entry.stat().st_mtime, entry.name, size))
+
+        with self.lock:
+            for _, key, size in sorted(found):
+                self.index[key] = size
+                self.size += size
+            self._evict()
+
+        print(f"Result cache has {len(self.index)} entries, {self.size / 2**20:0.1f} MiB")
+        return self
+
+    def get(self, key: str) -> list[bytes] | None:
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.index.move_to_end(key)
+
+        folder = os.path.join(self.entries, key)
+        try:
+            names = sorted(os.listdir(folder), key=lambda name: int(os.path.splitext(name)[0]))
+            images = []
+            for name in names:
+                with open(os.path.join(folder, name), "rb") as f:
+                    images.append(f.read())
+            os.utime(folder)
+        except OSError:
+            return None  # evicted while it was being read
+        return images
+
+    def put(self, key: str, images: list[bytes]):
+        size = sum(len(data) for data in images)
+        if not images or size > self.max_bytes:
+            return
+
+        # Write the entry next to the cache and move it in whole
+        folder = tempfile.mkdtemp(dir=self.tmp)
+        for index, data in enumerate(images):
+            with open(os.path.join(folder, f"{index}{DEFAULT_EXTENSION}"), "wb") as f:
+                f.write(data)
+
+        with self.lock:
+            if key in self.index:
+                shutil.rmtree(folder, ignore_errors=True)
+                return
+
+            os.rename(folder, os.path.join(self.entries, key))
+            self.index[key] = size
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.index:
+            key, size = self.index.popitem(last=False)
+            self.size -= size
+            shutil.rmtree(os.path.join(self.entries, key), ignore_errors=True)
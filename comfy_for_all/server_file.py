@@ -1,10 +1,17 @@
 # serve JSON files from a directory as jobs with the CFA API endpoints
 
-import json
+import argparse
 import os
+import signal
+import socket
 import sys
+import threading
+import time
+from datetime import datetime
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+from pydantic import ValidationError
+from werkzeug.serving import make_server
 
 app = Flask(__name__)
 if not os.path.isfile("config.py"):
@@ -12,11 +19,133 @@ if not os.path.isfile("config.py"):
 else:
     import config
 
-# Keep a list of processed jobs to avoid reprocessing
-processed_jobs = set()
+from job_backend import make_backend
+from models import ImageJob
+from metrics import CONTENT_TYPE, JOB_AGE_BUCKETS, Registry
+from upload_store import UploadStore, upload_request_class
 
-# Keep a list of client IDs to avoid duplicates
-worker_ids = set()
+# Queued, leased and completed jobs, kept in memory with a lease journal or in
+# a SQLite database that several server processes can share
+backend = make_backend(config)
+
+# Uploaded images are streamed into a content-addressed store as they arrive
+upload_store = UploadStore(config.upload_folder).open()
+app.request_class = upload_request_class(upload_store)
+
+metrics = Registry()
+metrics.gauge("cfa_queue_depth", "Jobs waiting to be dispatched", function=backend.queue_depth)
+metrics.gauge(
+    "cfa_leases_outstanding",
+    "Jobs dispatched and not yet completed",
+    function=backend.outstanding,
+)
+request_duration = metrics.histogram(
+    "cfa_request_duration_seconds", "Time spent handling API requests", ("endpoint",)
+)
+jobs_dispatched = metrics.counter(
+    "cfa_jobs_dispatched_total", "Jobs leased to each worker", ("worker",)
+)
+jobs_completed = metrics.counter(
+    "cfa_jobs_completed_total", "Jobs completed by each worker", ("worker",)
+)
+jobs_cancelled = metrics.counter("cfa_jobs_cancelled_total", "Jobs cancelled")
+jobs_released = metrics.counter(
+    "cfa_jobs_released_total", "Leased jobs given back by workers before they ran"
+)
+jobs_submitted = metrics.counter(
+    "cfa_jobs_submitted_total", "Jobs added to the job log through the API"
+)
+upload_bytes = metrics.counter(
+    "cfa_upload_bytes_total", "Bytes of images uploaded by each worker", ("worker",)
+)
+dispatch_age = metrics.histogram(
+    "cfa_job_dispatch_age_seconds",
+    "Time from a job being requested to it being dispatched",
+    buckets=JOB_AGE_BUCKETS,
+)
+completion_age = metrics.histogram(
+    "cfa_job_completion_age_seconds",
+    "Time from a job being requested to its images being uploaded",
+    buckets=JOB_AGE_BUCKETS,
+)
+
+# Fields workers read from every job
+JOB_FIELDS = (
+    "job_id",
+    "requested_at",
+    "started_at",
+    "request_type",
+    "requested_prompt",
+    "negative_prompt",
+    "model",
+    "steps",
+    "channel",
+    "image_link",
+    "resolution",
+    "batch_size",
+    "config_scale",
+)
+
+
+def job_error(job) -> str | None:
+    """Why a submitted job could not be run by a worker, or None if it can."""
+    if not isinstance(job, dict):
+        return "job must be an object"
+
+    missing = [field for field in JOB_FIELDS if field not in job]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    if not isinstance(job.get("priority", 0), int):
+        return "priority must be an integer"
+
+    # Checked the way workers parse jobs, so a bad one is turned away here
+    # instead of failing on every worker it is dispatched to
+    fields = {field: job[field] for field in JOB_FIELDS if field != "job_id"}
+    try:
+        ImageJob(
+            id=job["job_id"],
+            model_fingerprint=job.get("model_fingerprint"),
+            seed=job.get("seed"),
+            **fields,
+        )
+    except ValidationError as e:
+        errors = []
+        for error in e.errors():
+            field = ".".join(str(part) for part in error["loc"])
+            errors.append(f"{'job_id' if field == 'id' else field}: {error['msg']}")
+        return "; ".join(errors)
+    return None
+
+# Wakes long-polling get-job requests when jobs are put back in the queue, new
+# job files are found by rescanning every long_poll_interval
+job_available = threading.Condition()
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_duration(response):
+    if request.endpoint and "request_start" in g:
+        request_duration.observe(
+            time.perf_counter() - g.request_start, endpoint=request.endpoint
+        )
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+def parse_timestamp(value) -> float | None:
+    # Jobs carry ISO 8601 times, naive ones are taken to be local time
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
 
 
 @app.route("/api/init", methods=["GET"])
@@ -32,9 +161,8 @@ def init_worker():
     created_worker = False
     if worker_id == "N/A":
         # If worker_id is 'N/A', generate a new one
-        worker_id = f"worker_{len(worker_ids) + 1}"
+        worker_id = backend.register_worker()
         created_worker = True
-        worker_ids.add(worker_id)
         print(f"Generated new worker ID: {worker_id}")
     else:
         print(f"Using existing worker ID: {worker_id}")
@@ -49,56 +177,355 @@ def init_worker():
     ), 200
 
 
+def resolve_fingerprints(fingerprints: dict[str, str | None]) -> dict[str, str]:
+    # Record the hashes workers have verified, then return the hashes we know
+    # for the ones they have not, as a map of hash to fingerprint
+    matched = {}
+    for fingerprint, model in fingerprints.items():
+        if model:
+            backend.learn_fingerprint(fingerprint, model)
+        else:
+            known = backend.fingerprint_model(fingerprint)
+            if known:
+                matched[known] = fingerprint
+    return matched
+
+
+def lease_job(worker_id: str, claim, matched: dict[str, str]) -> dict:
+    job_id, job_data, deadline = claim
+    print(f"Leased job {job_id} to {worker_id} until {deadline:0.0f}")
+
+    jobs_dispatched.inc(worker=worker_id)
+    requested_at = parse_timestamp(job_data.get("requested_at"))
+    if requested_at is not None:
+        dispatch_age.observe(time.time() - requested_at)
+
+    job_data["lease_deadline"] = deadline
+    if job_data.get("model") in matched:
+        # Tell the worker which of its files this is, it does not know the hash yet
+        job_data["model_fingerprint"] = matched[job_data["model"]]
+    return job_data
+
+
+def claim_job(
+    worker_id: str, checkpoints: list[str] | None, matched: dict[str, str]
+) -> dict | None:
+    # Take the oldest job for a model the worker has, preferring its current
+    # model unless that would skip over too many older jobs
+    claim = backend.claim(worker_id, checkpoints, config.affinity_window)
+    if claim is None:
+        return None
+    return lease_job(worker_id, claim, matched)
+
+
+def coalesce_key(job_data: dict) -> tuple:
+    # Jobs with the same key can share a checkpoint, negative prompt and latent
+    # in one prompt, they only differ in positive prompt and seed
+    return (
+        job_data.get("request_type"),
+        job_data.get("model"),
+        job_data.get("resolution"),
+        job_data.get("steps"),
+        job_data.get("config_scale"),
+        job_data.get("negative_prompt"),
+        job_data.get("batch_size"),
+    )
+
+
+def coalesce_jobs(
+    worker_id: str, lead: dict, matched: dict[str, str], limit: int
+) -> list[dict]:
+    # Lease queued jobs that can run in the same prompt as the lead job
+    key = coalesce_key(lead)
+    claims = backend.claim_matching(
+        worker_id,
+        lead.get("model"),
+        lambda job_data: coalesce_key(job_data) == key,
+        limit,
+        config.coalesce_scan,
+    )
+    return [lease_job(worker_id, claim, matched) for claim in claims]
+
+
+def dispatch_jobs(
+    worker_id: str,
+    checkpoints: list[str] | None,
+    matched: dict[str, str],
+    max_jobs: int,
+    coalesce: int = 1,
+) -> list[dict]:
+    # Return expired leases to the queue
+    if backend.expire():
+        with job_available:
+            job_available.notify_all()
+
+    # Pick up any new job files before claiming
+    backend.refresh()
+    jobs = []
+    while len(jobs) < max_jobs:
+        job_data = claim_job(worker_id, checkpoints, matched)
+        if job_data is None:
+            break
+
+        if coalesce > 1:
+            coalesced = coalesce_jobs(worker_id, job_data, matched, coalesce - 1)
+            if coalesced:
+                print(f"Coalesced {len(coalesced)} jobs with job {job_data.get('job_id')}")
+                job_data["coalesced"] = coalesced
+        jobs.append(job_data)
+
+    return jobs
+
+
 @app.route("/api/get-job", methods=["GET"])
 def get_job():
     # Get a job from the queue folder
-    queue_folder = config.queue_folder
-    if not os.path.exists(queue_folder):
+    if not backend.exists():
         print("Queue folder does not exist")
         return jsonify({"error": "Queue folder does not exist"}), 404
 
-    files = [f for f in os.listdir(queue_folder) if f.endswith(".json")]
-    if not files:
-        print("No jobs available")
+    data = request.get_json(silent=True) or {}
+    worker_id = data.get("worker_id", "N/A")
+    checkpoints = data.get("checkpoints")  # older workers do not send this
+    matched = resolve_fingerprints(data.get("fingerprints") or {})
+    if checkpoints is not None and matched:
+        checkpoints = checkpoints + list(matched)
+
+    # Workers that ask for max_jobs get a list of up to that many jobs, older
+    # workers get a single job object. Workers that can run several
+    # compatible jobs as one prompt say how many, and long-polling workers
+    # how long to wait for a job.
+    max_jobs = data.get("max_jobs")
+    try:
+        count = max(1, min(int(max_jobs or 1), config.max_jobs_per_request))
+        coalesce = max(1, min(int(data.get("coalesce", 1)), config.coalesce_max))
+        wait = max(0.0, min(float(data.get("wait", 0)), config.long_poll_max))
+    except (TypeError, ValueError):
+        return jsonify({"error": "max_jobs, coalesce and wait must be numbers"}), 400
+
+    # Long-poll: hold the request open until a job shows up or the wait runs out
+    deadline = time.monotonic() + wait
+
+    jobs = dispatch_jobs(worker_id, checkpoints, matched, count, coalesce)
+    while not jobs and time.monotonic() < deadline:
+        with job_available:
+            job_available.wait(
+                min(config.long_poll_interval, deadline - time.monotonic())
+            )
+        jobs = dispatch_jobs(worker_id, checkpoints, matched, count, coalesce)
+
+    if not jobs:
+        print(f"No jobs available for {worker_id}")
         return jsonify({"error": "No jobs available"}), 404
 
-    # Sort files by modification time to get the oldest job first
-    files.sort(key=lambda f: os.path.getmtime(os.path.join(queue_folder, f)))
+    if max_jobs is None:
+        return jsonify(jobs[0])
 
-    # Find the first unprocessed job
-    for file in files:
-        job_file = os.path.join(queue_folder, file)
-        if job_file not in processed_jobs:
-            break
-    else:
-        return jsonify({"error": "All jobs have been processed"}), 404
+    return jsonify({"jobs": jobs})
+
+
+@app.route("/api/submit", methods=["POST"])
+def submit_jobs():
+    # Queue many jobs with one append to the job log, instead of a file each
+    if backend.job_log is None:
+        return jsonify({"error": "No job log configured"}), 404
+
+    data = request.get_json(silent=True) or {}
+    jobs = data.get("jobs")
+    if not isinstance(jobs, list) or not jobs:
+        return jsonify({"error": "jobs must be a non-empty list"}), 400
+
+    invalid = []
+    for index, job in enumerate(jobs):
+        error = job_error(job)
+        if error is not None:
+            invalid.append({"index": index, "error": error})
+    if invalid:
+        return jsonify({"error": "Some jobs are invalid, none were submitted", "invalid": invalid}), 400
+
+    backend.submit(jobs)
+    jobs_submitted.inc(len(jobs))
+    with job_available:
+        job_available.notify_all()
+
+    print(f"Submitted {len(jobs)} jobs")
+    return jsonify({"submitted": len(jobs), "job_ids": [job["job_id"] for job in jobs]})
+
+
+@app.route("/api/cancel", methods=["POST"])
+def cancel_job():
+    # Withdraw a job: it is never dispatched again, and a worker running it
+    # finds out the next time it checks its jobs
+    data = request.get_json(silent=True) or {}
+    if "job_id" not in data:
+        return jsonify({"error": "job_id is required"}), 400
+
+    job_id = str(data["job_id"])
+    # Pick up a job file written just before it was cancelled
+    backend.refresh()
+    state, leased_to = backend.cancel(job_id)
+    if state is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if state == "completed":
+        return jsonify({"error": "Job already completed"}), 409
+
+    if state != "cancelled":
+        jobs_cancelled.inc()
+        if leased_to:
+            print(f"Cancelled job {job_id}, leased to {leased_to}")
+        else:
+            print(f"Cancelled job {job_id}")
+
+    return jsonify({"job_id": job_id, "cancelled": True, "leased_to": leased_to})
+
+
+@app.route("/api/release", methods=["POST"])
+def release_jobs():
+    # Requeue jobs a worker claimed but will not run, without waiting for
+    # their leases to expire
+    data = request.get_json(silent=True) or {}
+    if "worker_id" not in data:
+        return jsonify({"error": "worker_id is required"}), 400
 
-    with open(job_file, "r") as f:
-        job_data = json.load(f)
+    worker_id = data["worker_id"]
+    job_ids = [str(job_id) for job_id in data.get("job_ids", [])]
+    released = backend.release(job_ids, worker_id)
+    if released:
+        jobs_released.inc(released)
+        print(f"Requeued {released} jobs given back by {worker_id}")
+        with job_available:
+            job_available.notify_all()
+
+    return jsonify({"released": released})
 
-    # Record the job as processed
-    processed_jobs.add(job_file)
 
-    return jsonify(job_data)
+@app.route("/api/cancelled", methods=["POST"])
+def cancelled_jobs():
+    # Which of the jobs a worker is running have been cancelled
+    data = request.get_json(silent=True) or {}
+    job_ids = [str(job_id) for job_id in data.get("job_ids", [])]
+    return jsonify({"cancelled": backend.cancelled(job_ids)})
 
 
 @app.route("/api/upload", methods=["POST"])
 def upload_images():
-    channel = request.args.get("channel")
+    # Uploaded files have already been written to the store and hashed while
+    # the request was parsed, anything not committed here is discarded
+    try:
+        return store_upload()
+    finally:
+        for _, file in request.files.items(multi=True):
+            upload_store.discard(file.stream)
+
+
+def store_upload():
+    # Older workers sent the channel in the query string
+    channel = request.form.get("channel", request.args.get("channel"))
     if "images" not in request.files:
         return jsonify({"error": "No 'images' field in request"}), 400
 
+    job_id = request.form.get("job_id")
+    worker_id = request.form.get("worker_id")
+    if job_id is not None and backend.cancelled([job_id]):
+        # The prompt finished before the worker heard about the cancellation
+        print(f"Dropping upload for cancelled job {job_id} from {worker_id}")
+        return jsonify({"error": "Job was cancelled"}), 409
+
     files = request.files.getlist("images")
     saved_files = []
-    i = 0
+    stored = []
     for file in files:
         if file.filename:
-            file.save(f"{config.upload_folder}/{channel}_{i}.png")
+            stored.append(upload_store.commit(file.stream, file.filename, file.mimetype))
             saved_files.append(file.filename)
-            i += 1
 
+    if job_id is not None:
+        upload_store.write_manifest(
+            job_id,
+            {
+                "channel": channel,
+                "worker_id": worker_id,
+                "uploaded_at": time.time(),
+                "files": stored,
+            },
+        )
+
+        # Settle the lease so the job is not dispatched again
+        job_data = backend.settle(job_id, worker_id)
+        if job_data is None:
+            print(f"Upload for job {job_id} from {worker_id} did not match a lease")
+        else:
+            print(f"Job {job_id} completed by {worker_id}")
+            jobs_completed.inc(worker=worker_id)
+            requested_at = parse_timestamp(job_data.get("requested_at"))
+            if requested_at is not None:
+                completion_age.observe(time.time() - requested_at)
+
+    upload_bytes.inc(sum(entry["size"] for entry in stored), worker=worker_id)
+    deduplicated = sum(1 for entry in stored if entry["deduplicated"])
+    print(f"Stored {len(stored)} images for channel {channel}, {deduplicated} already stored")
     return jsonify({"message": "Images uploaded", "files": saved_files})
 
 
+@app.route("/api/upload/<job_id>", methods=["GET"])
+def get_upload(job_id):
+    manifest = upload_store.manifest(job_id)
+    if manifest is None:
+        return jsonify({"error": "No uploads for this job"}), 404
+
+    return jsonify(manifest)
+
+
+def serve(host: str, port: int, processes: int):
+    """
+    Serve with threads in each of several processes sharing one listening socket.
+
+    Dispatch state must live in the sqlite backend for more than one process,
+    the files backend only knows about the jobs its own process handed out.
+    """
+    if processes > 1 and getattr(config, "job_backend", "files") != "sqlite":
+        sys.exit("Serving from several processes needs job_backend = 'sqlite' in config.py")
+
+    listener = socket.create_server((host, port), backlog=128)
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+
+    print(f"Serving on {host}:{port} with {processes} processes: {children}")
+
+    # Take the children down with us when we are terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=5000)
+    parser = argparse.ArgumentParser(description="CFA job server")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Serve from this many processes, 0 for the Flask debug server",
+    )
+    args = parser.parse_args()
+
+    if args.processes:
+        serve(args.host, args.port, args.processes)
+    else:
+        app.run(debug=True, host=args.host, port=args.port)
@@ -0,0 +1,144 @@
+# hammer the job server with concurrent workers and check no job is dispatched twice
+#
+# usage: python stress_dispatch.py --jobs 2000 --clients 32 --processes 4 --backend sqlite
+#
+# Starts the job server on a temporary queue, registers --clients workers at
+# once and has them all claim jobs, some with coalescing, and upload about
+# half of them, until the queue is empty. Exits with status 1 if a worker ID
+# was handed out twice, a job was dispatched twice or a job was never
+# dispatched.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_e2e import start, wait_for, write_config
+from bench_jobs import write_jobs
+
+MODELS = [f"{i:064x}" for i in range(1, 4)]
+
+
+def register(url: str) -> str:
+    response = requests.get(url + "/api/init", json={"worker_id": "N/A"}, timeout=30)
+    response.raise_for_status()
+    return response.json()["worker_id"]
+
+
+def run_client(url: str, worker_id: str, dispatched: list, lock: threading.Lock):
+    session = requests.Session()
+    empty = 0
+    while empty < 3:
+        data = {
+            "worker_id": worker_id,
+            "checkpoints": random.sample(MODELS, random.randint(1, len(MODELS))),
+            "max_jobs": random.randint(1, 4),
+            "coalesce": random.choice((1, 1, 3)),
+        }
+        response = session.get(url + "/api/get-job", json=data, timeout=30)
+        if response.status_code == 404:
+            # This worker may not have every model, so try a few more times
+            empty += 1
+            continue
+        response.raise_for_status()
+        empty = 0
+
+        jobs = []
+        for job in response.json()["jobs"]:
+            jobs.append(job)
+            jobs.extend(job.get("coalesced", []))
+
+        with lock:
+            dispatched.extend((str(job["job_id"]), worker_id) for job in jobs)
+
+        for job in jobs:
+            if random.random() < 0.5:
+                session.post(
+                    url + "/api/upload",
+                    data={"job_id": str(job["job_id"]), "worker_id": worker_id},
+                    files={"images": ("image_0.png", os.urandom(64), "image/png")},
+                    timeout=30,
+                ).raise_for_status()
+
+
+def run(args, root: str) -> bool:
+    for folder in ("jobs", "uploads", "server"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    write_config(os.path.join(root, "server"), job_backend=args.backend)
+    job_ids = {str(job_id) for job_id in write_jobs(os.path.join(root, "jobs"), args.jobs, MODELS)}
+
+    url = f"http://127.0.0.1:{args.port}"
+    server = start(
+        [
+            sys.executable,
+            "-c",
+            f"import server_file; server_file.serve('127.0.0.1', {args.port}, {args.processes})",
+        ],
+        os.path.join(root, "server"),
+        os.path.join(root, "server.log"),
+    )
+    try:
+        wait_for(url + "/metrics")
+
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            worker_ids = list(pool.map(lambda _: register(url), range(args.clients)))
+
+        dispatched = []
+        lock = threading.Lock()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            for result in [
+                pool.submit(run_client, url, worker_id, dispatched, lock)
+                for worker_id in worker_ids
+            ]:
+                result.result()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    duplicate_workers = [worker for worker, n in Counter(worker_ids).items() if n > 1]
+    counts = Counter(job_id for job_id, _ in dispatched)
+    duplicate_jobs = [job_id for job_id, n in counts.items() if n > 1]
+    missing = job_ids - set(counts)
+
+    print(
+        f"{args.backend} backend, {args.processes} processes, {args.clients} clients: "
+        f"{len(dispatched)} dispatches in {elapsed:0.2f}s, {len(dispatched) / elapsed:0.1f}/s"
+    )
+    print(f"Duplicate worker IDs: {len(duplicate_workers)}")
+    print(f"Jobs dispatched more than once: {len(duplicate_jobs)} {duplicate_jobs[:10]}")
+    print(f"Jobs never dispatched: {len(missing)} {sorted(missing)[:10]}")
+    return not duplicate_workers and not duplicate_jobs and not missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Job server double-dispatch stress test")
+    parser.add_argument("--jobs", type=int, default=2000, help="Number of jobs")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent workers")
+    parser.add_argument("--processes", type=int, default=4, help="Server processes")
+    parser.add_argument(
+        "--backend", type=str, choices=("files", "sqlite"), default="sqlite", help="Job backend"
+    )
+    parser.add_argument("--port", type=int, default=5078, help="Job server port")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="cfa_stress_")
+    try:
+        ok = run(args, root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# lightweight spans around the stages of a job, with optional trace output and profiling
+
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_FORMATS = ("jsonl", "chrome")
+PROFILE_TOP = 25  # functions printed with each profile summary
+
+# The job the current thread or task is working on, picked up by spans
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+class Tracer:
+    """
+    Collects span timings by job and writes them out as they finish.
+
+    Spans can be written as JSON lines, or as Chrome trace events that load
+    in chrome://tracing or Perfetto. Each job's stage times are printed when
+    it finishes, and the average over the last summary_every jobs after that
+    many jobs.
+    """
+
+    def __init__(self, path=None, format="jsonl", summary_every=0, profile=None):
+        if format not in TRACE_FORMATS:
+            raise ValueError(f"Trace format must be one of {', '.join(TRACE_FORMATS)}")
+
+        self.path = path
+        self.format = format
+        self.summary_every = summary_every
+        self.enabled = bool(path or summary_every or profile)
+        self.lock = threading.Lock()
+        self.jobs: dict = {}  # stage times by job ID, until the job finishes
+        self.window: dict[str, list[float]] = {}  # stage times over the summary window
+        self.window_jobs = 0
+        self.window_start = time.time()
+        self.profiler = Profiler(profile) if profile else None
+        self._file = None
+
+        if path:
+            self._file = open(path, "w")
+            if format == "chrome":
+                # The viewer accepts an array without its closing bracket, so
+                # events can be streamed out as they finish
+                self._file.write("[\n")
+
+    def close(self):
+        if self.profiler:
+            self.profiler.dump(show=True)
+        with self.lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _write(self, name, start, duration, job_id, attrs):
+        if self.format == "chrome":
+            event = {
+                "name": name,
+                "cat": "job" if job_id is not None else "worker",
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {"job_id": job_id, **attrs},
+            }
+            self._file.write(json.dumps(event) + ",\n")
+        else:
+            event = {
+                "name": name,
+                "job_id": job_id,
+                "start": start,
+                "duration": duration,
+                "thread": threading.current_thread().name,
+                **attrs,
+            }
+            self._file.write(json.dumps(event) + "\n")
+
+    def record(self, name: str, start: float, end: float, job_id=None, **attrs):
+        """Add a span that has already ended, for stages timed across threads."""
+        if not self.enabled:
+            return
+
+        if job_id is None:
+            job_id = current_job.get()
+        duration = end - start
+
+        with self.lock:
+            if job_id is not None:
+                stages = self.jobs.setdefault(job_id, {})
+                stages[name] = stages.get(name, 0) + duration
+            else:
+                self.window.setdefault(name, []).append(duration)
+
+            if self._file:
+                self._write(name, start, duration, job_id, attrs)
+
+    @contextmanager
+    def span(self, name: str, job_id=None, **attrs):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time(), job_id, **attrs)
+
+    def finish_job(self, job_id):
+        """Print the stage times of a finished job, and the window summary when it is due."""
+        if not self.enabled:
+            return
+
+        with self.lock:
+            stages = self.jobs.pop(job_id, {})
+            for name, duration in stages.items():
+                self.window.setdefault(name, []).append(duration)
+            self.window_jobs += 1
+
+            summary = None
+            if self.summary_every and self.window_jobs >= self.summary_every:
+                summary = self._take_window()
+
+        if stages:
+            timings = ", ".join(f"{name} {duration:0.3f}s" for name, duration in stages.items())
+            print(f"Job {job_id} stages: {timings}")
+
+        if summary:
+            print(summary)
+            if self.profiler:
+                # Keep the stats on disk up to date while the worker runs
+                self.profiler.dump()
+
+    def _take_window(self) -> str:
+        now = time.time()
+        elapsed = max(now - self.window_start, 1e-9)
+        lines = [
+            f"Last {self.window_jobs} jobs in {elapsed:0.1f}s, {self.window_jobs / elapsed:0.3f} jobs/s:"
+        ]
+        for name, durations in sorted(
+            self.window.items(), key=lambda item: -sum(item[1])
+        ):
+            durations = sorted(durations)
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            lines.append(
+                f"  {name}: {len(durations)} calls, {sum(durations):0.3f}s total, "
+                f"{sum(durations) / len(durations):0.3f}s mean, {p95:0.3f}s p95"
+            )
+
+        self.window = {}
+        self.window_jobs = 0
+        self.window_start = now
+        return "\n".join(lines)
+
+
+class Profiler:
+    """
+    cProfile for functions run on worker threads.
+
+    cProfile only sees the thread it was enabled on, so each wrapped call
+    gets its own profile and the results are merged. Python 3.12 and later
+    only allow one active profiler per process, so a call that overlaps one
+    that is being profiled runs without, and is counted as skipped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.active = threading.Lock()  # held while a call is being profiled
+        self.stats = None
+        self.skipped = 0
+
+    def _skip(self, fn, *args, **kwargs):
+        with self.lock:
+            self.skipped += 1
+        return fn(*args, **kwargs)
+
+    def wrap(self, fn):
+        def profiled(*args, **kwargs):
+            if not self.active.acquire(blocking=False):
+                return self._skip(fn, *args, **kwargs)
+
+            try:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Another profiling tool is active in this process
+                    return self._skip(fn, *args, **kwargs)
+
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    with self.lock:
+                        if self.stats is None:
+                            self.stats = pstats.Stats(profile)
+                        else:
+                            self.stats.add(profile)
+            finally:
+                self.active.release()
+
+        return profiled
+
+    def dump(self, show=False):
+        with self.lock:
+            if self.stats is None:
+                return
+            self.stats.dump_stats(self.path)
+            if show:
+                print(
+                    f"Profile written to {self.path}, {self.skipped} overlapping calls "
+                    "not profiled, top functions by own time:"
+                )
+                self.stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+
+
+_tracer = Tracer()
+
+
+def configure(path=None, format="jsonl", summary_every=0, profile=None) -> Tracer:
+    """Replace the tracer used by span and friends, closing the previous one."""
+    global _tracer
+    _tracer.close()
+    _tracer = Tracer(path, format, summary_every, profile)
+    return _tracer
+
+
+def span(name: str, job_id=None, **attrs):
+    return _tracer.span(name, job_id, **attrs)
+
+
+def record(name: str, start: float, end: float, job_id=None, **attrs):
+    _tracer.record(name, start, end, job_id, **attrs)
+
+
+def finish_job(job_id):
+    _tracer.finish_job(job_id)
+
+
+@contextmanager
+def job(job_id):
+    """Attribute spans in this block to job_id."""
+    token = current_job.set(job_id)
+    try:
+        yield
+    finally:
+        current_job.reset(token)
+
+
+def profiled(fn):
+    """Wrap fn so its calls are profiled when profiling is on, at call time."""
+
+    def run(*args, **kwargs):
+        if _tracer.profiler is None:
+            return fn(*args, **kwargs)
+        return _tracer.profiler.wrap(fn)(*args, **kwargs)
+
+    return run
+
+
+def close():
+    _tracer.close()
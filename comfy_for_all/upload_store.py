@@ -0,0 +1,143 @@
+# content-addressed storage for uploaded images, hashed while they stream in
+
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+
+from flask import Request
+
+SHARD_DEPTH = 2  # levels of two hex digit directories above each file
+DEFAULT_EXTENSION = ".png"
+
+
+class HashingStream:
+    """A temporary file in the store that hashes everything written to it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def shard(root: str, name: str) -> str:
+    """Path to name under root, nested by the first hex digits of name."""
+    parts = [name[2 * i : 2 * i + 2] for i in range(SHARD_DEPTH)]
+    return os.path.join(root, *parts, name)
+
+
+def file_extension(filename: str | None, content_type: str | None) -> str:
+    extension = os.path.splitext(filename or "")[1].lower()
+    if not extension and content_type:
+        extension = mimetypes.guess_extension(content_type) or ""
+    return extension or DEFAULT_EXTENSION
+
+
+class UploadStore:
+    """
+    Uploaded files stored once by content hash, with a manifest for each job.
+
+    Files are written to objects/ab/cd/<sha256><ext> and the files uploaded
+    for a job are listed in manifests/ab/cd/<sha256 of job_id>.json. Nothing
+    here lists a directory, so lookups stay cheap however many files there are.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.manifests = os.path.join(root, "manifests")
+        self.tmp = os.path.join(root, "tmp")
+
+    def open(self):
+        for folder in (self.objects, self.manifests, self.tmp):
+            os.makedirs(folder, exist_ok=True)
+
+        # Uploads that were cut off by a restart never made it into the store
+        with os.scandir(self.tmp) as entries:
+            for entry in entries:
+                os.remove(entry.path)
+        return self
+
+    def stream(self) -> HashingStream:
+        """A new temporary file for one uploaded part."""
+        return HashingStream(tempfile.NamedTemporaryFile(dir=self.tmp, delete=False))
+
+    def discard(self, stream):
+        if not isinstance(stream, HashingStream) or stream.committed:
+            return
+
+        stream.close()
+        try:
+            os.remove(stream.name)
+        except FileNotFoundError:
+            pass
+
+    def object_path(self, sha256: str, extension: str) -> str:
+        return shard(self.objects, sha256 + extension)
+
+    def commit(self, stream: HashingStream, filename=None, content_type=None) -> dict:
+        """Move a finished upload into the store, keeping the copy already there if any."""
+        sha256 = stream.sha256.hexdigest()
+        path = self.object_path(sha256, file_extension(filename, content_type))
+        stream.close()
+
+        if os.path.exists(path):
+            os.remove(stream.name)
+            deduplicated = True
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(stream.name, path)
+            deduplicated = False
+        stream.committed = True
+
+        return {
+            "name": filename,
+            "sha256": sha256,
+            "size": stream.size,
+            "content_type": content_type,
+            "path": os.path.relpath(path, self.root),
+            "deduplicated": deduplicated,
+        }
+
+    def manifest_path(self, job_id: str) -> str:
+        key = hashlib.sha256(str(job_id).encode("utf-8")).hexdigest()
+        return shard(self.manifests, key + ".json")
+
+    def write_manifest(self, job_id: str, manifest: dict):
+        """Record the files for a job, replacing any earlier upload for it."""
+        path = self.manifest_path(job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"job_id": str(job_id), **manifest}, f, indent=4)
+        os.replace(tmp_path, path)
+
+    def manifest(self, job_id: str) -> dict | None:
+        try:
+            with open(self.manifest_path(job_id), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+
+def upload_request_class(store: UploadStore) -> type[Request]:
+    """A Flask request class that streams uploaded files into store."""
+
+    class UploadRequest(Request):
+        def _get_file_stream(
+            self, total_content_length, content_type, filename=None, content_length=None
+        ):
+            return store.stream()
+
+    return UploadRequest
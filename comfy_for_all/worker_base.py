@@ -1,52 +1,123 @@
-import requests
 import io
 import argparse
 import json
+import uuid
+from collections.abc import Iterable
+from PIL import Image
 from pydantic import BaseModel
 
+from hashes import DEFAULT_HASH_WORKERS, DEFAULT_WATCH_INTERVAL, HashStore
+from http_client import (
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_HTTP_RETRIES,
+    DEFAULT_HTTP_TIMEOUT,
+    HttpClient,
+    get_client,
+)
 from models import ImageJob
+import tracing
+from tracing import TRACE_FORMATS
 
+DEFAULT_CANCEL_INTERVAL = 5  # seconds
 DEFAULT_CHECKPOINT_DIR = "checkpoints"
 DEFAULT_CLIENT_FILE = "client.json"
+DEFAULT_COALESCE = 1
+DEFAULT_FAKE_GPU = False
 DEFAULT_GPU_INDEX = 0
 DEFAULT_IDLE_THRESHOLD = 900  # seconds
+DEFAULT_IDLE_UTILIZATION = 10  # percent
 DEFAULT_JOB_SERVER = "http://127.0.0.1:5000"
+DEFAULT_LONG_POLL = 0
 DEFAULT_LORA_DIR = "loras"
 DEFAULT_POLLING_INTERVAL = 30
+DEFAULT_PREFETCH = 0
+DEFAULT_PROFILE = None
+DEFAULT_REENCODE_IMAGES = False
 DEFAULT_SINGLE_JOB = False
+DEFAULT_TRACE = None
+DEFAULT_TRACE_FORMAT = "jsonl"
+DEFAULT_TRACE_SUMMARY = 0
 
 
 class BaseWorkerArgs(argparse.Namespace):
+    cancel_interval: int = DEFAULT_CANCEL_INTERVAL
     checkpoint_dir: str = DEFAULT_CHECKPOINT_DIR
     client_file: str = DEFAULT_CLIENT_FILE
+    coalesce: int = DEFAULT_COALESCE
+    fake_gpu: bool = DEFAULT_FAKE_GPU
     gpu_index: int = DEFAULT_GPU_INDEX
+    hash_workers: int = DEFAULT_HASH_WORKERS
+    http_pool_size: int = DEFAULT_HTTP_POOL_SIZE
+    http_retries: int = DEFAULT_HTTP_RETRIES
+    http_timeout: int = DEFAULT_HTTP_TIMEOUT
     idle_threshold: int = DEFAULT_IDLE_THRESHOLD
+    idle_utilization: int = DEFAULT_IDLE_UTILIZATION
     job_server: str = DEFAULT_JOB_SERVER
+    long_poll: int = DEFAULT_LONG_POLL
     lora_dir: str = DEFAULT_LORA_DIR
     polling_interval: int = DEFAULT_POLLING_INTERVAL
+    prefetch: int = DEFAULT_PREFETCH
+    profile: str | None = DEFAULT_PROFILE
+    reencode_images: bool = DEFAULT_REENCODE_IMAGES
     single_job: bool = DEFAULT_SINGLE_JOB
+    trace: str | None = DEFAULT_TRACE
+    trace_format: str = DEFAULT_TRACE_FORMAT
+    trace_summary: int = DEFAULT_TRACE_SUMMARY
+    watch_interval: int = DEFAULT_WATCH_INTERVAL
 
     def __init__(
         self,
+        cancel_interval: int,
         checkpoint_dir: str,
         client_file: str,
+        coalesce: int,
+        fake_gpu: bool,
         gpu_index: int,
+        hash_workers: int,
+        http_pool_size: int,
+        http_retries: int,
+        http_timeout: int,
         idle_threshold: int,
+        idle_utilization: int,
         job_server: str,
+        long_poll: int,
         lora_dir: str,
         polling_interval: int,
+        prefetch: int,
+        profile: str | None,
+        reencode_images: bool,
         single_job: bool,
+        trace: str | None,
+        trace_format: str,
+        trace_summary: int,
+        watch_interval: int,
         **kwargs,
     ):
         super().__init__(**kwargs)
+        self.cancel_interval = cancel_interval
         self.checkpoint_dir = checkpoint_dir
         self.client_file = client_file
+        self.coalesce = coalesce
+        self.fake_gpu = fake_gpu
         self.gpu_index = gpu_index
+        self.hash_workers = hash_workers
+        self.http_pool_size = http_pool_size
+        self.http_retries = http_retries
+        self.http_timeout = http_timeout
         self.idle_threshold = idle_threshold
+        self.idle_utilization = idle_utilization
         self.job_server = job_server
+        self.long_poll = long_poll
         self.lora_dir = lora_dir
         self.polling_interval = polling_interval
+        self.prefetch = prefetch
+        self.profile = profile
+        self.reencode_images = reencode_images
         self.single_job = single_job
+        self.trace = trace
+        self.trace_format = trace_format
+        self.trace_summary = trace_summary
+        self.watch_interval = watch_interval
 
 
 class BaseWorkerFile(BaseModel):
@@ -55,63 +126,189 @@ class BaseWorkerFile(BaseModel):
 
 DEFAULT_WORKER_CLIENT_FILE = BaseWorkerFile(worker_id="N/A")
 
-HashType = list[tuple[str, str]]
+HashType = Iterable[tuple[str, str]]  # (sha256, path) pairs, such as a HashStore
 
 
-def get_job(
-    args: BaseWorkerArgs, client: BaseWorkerFile, hashes: HashType
-) -> dict | None:
-    print("Fetching job from server as worker:", client.worker_id)
+def job_server(args: BaseWorkerArgs) -> HttpClient:
+    return get_client(
+        args.job_server, args.http_timeout, args.http_retries, args.http_pool_size
+    )
+
+
+def parse_job(job_data: dict) -> ImageJob:
+    return ImageJob(
+        id=job_data["job_id"],
+        requested_at=job_data["requested_at"],
+        started_at=job_data["started_at"],
+        request_type=job_data["request_type"],
+        # requester=None,
+        requested_prompt=job_data["requested_prompt"],
+        negative_prompt=job_data["negative_prompt"],
+        model=job_data["model"],
+        model_fingerprint=job_data.get("model_fingerprint"),
+        steps=job_data["steps"],
+        channel=job_data["channel"],
+        image_link=job_data["image_link"],
+        resolution=job_data["resolution"],
+        batch_size=job_data["batch_size"],
+        config_scale=job_data["config_scale"],
+        seed=job_data.get("seed"),
+        coalesced=[parse_job(other) for other in job_data.get("coalesced", [])],
+    )
+
+
+def get_jobs(
+    args: BaseWorkerArgs,
+    client: BaseWorkerFile,
+    hashes: HashType,
+    max_jobs: int = 1,
+    long_poll: bool = True,
+    loras: HashType = (),
+) -> list[ImageJob]:
+    print(f"Fetching up to {max_jobs} jobs from server as worker:", client.worker_id)
 
     data = {
         "checkpoints": [hash[0] for hash in hashes],
+        "loras": [hash[0] for hash in loras],
+        "max_jobs": max_jobs,
         "worker_id": client.worker_id,
     }
+    if args.coalesce > 1:
+        # Compatible jobs come back attached to the first one
+        data["coalesce"] = args.coalesce
+    if isinstance(hashes, HashStore):
+        # Lets the server match files we have not finished hashing
+        data["fingerprints"] = hashes.fingerprints()
+
+    timeout = args.http_timeout
+    if args.long_poll and long_poll:
+        # Ask the server to hold the request until a job is available
+        data["wait"] = args.long_poll
+        timeout += args.long_poll
 
-    response = requests.get(f"{args.job_server}/api/get-job", json=data)
+    with tracing.span("get_jobs", max_jobs=max_jobs):
+        response = job_server(args).get("/api/get-job", json=data, timeout=timeout)
     if response.status_code == 200:
-        job_data = response.json()
-        print("Received job data:", job_data)
-        job = ImageJob(
-            id=job_data["job_id"],
-            requested_at=job_data["requested_at"],
-            started_at=job_data["started_at"],
-            request_type=job_data["request_type"],
-            # requester=None,
-            requested_prompt=job_data["requested_prompt"],
-            negative_prompt=job_data["negative_prompt"],
-            model=job_data["model"],
-            steps=job_data["steps"],
-            channel=job_data["channel"],
-            image_link=job_data["image_link"],
-            resolution=job_data["resolution"],
-            batch_size=job_data["batch_size"],
-            config_scale=job_data["config_scale"],
-        )
-        return job
+        jobs_data = response.json()["jobs"]
+        print(f"Received {len(jobs_data)} jobs:", [job["job_id"] for job in jobs_data])
+        return [parse_job(job_data) for job_data in jobs_data]
     else:
         print("No jobs available or error fetching job.")
-        return None
+        return []
+
+
+def get_job(
+    args: BaseWorkerArgs, client: BaseWorkerFile, hashes: HashType
+) -> ImageJob | None:
+    jobs = get_jobs(args, client, hashes)
+    return jobs[0] if jobs else None
+
+
+def get_cancelled(
+    args: BaseWorkerArgs, client: BaseWorkerFile, job_ids
+) -> set[str]:
+    """Which of these jobs have been cancelled on the server."""
+    response = job_server(args).post(
+        "/api/cancelled",
+        json={"job_ids": [str(job_id) for job_id in job_ids], "worker_id": client.worker_id},
+    )
+    response.raise_for_status()
+    return set(response.json()["cancelled"])
+
+
+def release_jobs(args: BaseWorkerArgs, client: BaseWorkerFile, job_ids) -> int:
+    """Give claimed jobs back to the server, so they can run elsewhere right away."""
+    response = job_server(args).post(
+        "/api/release",
+        json={"job_ids": [str(job_id) for job_id in job_ids], "worker_id": client.worker_id},
+    )
+    response.raise_for_status()
+    return response.json()["released"]
+
+
+class OutputImage:
+    """Encoded image bytes as returned by ComfyUI, only decoded when pixels are needed."""
+
+    def __init__(self, data: bytes, content_type: str = "image/png"):
+        self.data = data
+        self.content_type = content_type
+        self._image = None
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+        return self._image
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body that yields the original buffers instead of
+    copying them into one, with a known length so it is sent with
+    Content-Length rather than chunked.
+    """
+
+    def __init__(self, fields: dict, files: list[tuple[str, str, str, bytes]]):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for name, value in fields.items():
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for name, filename, content_type, data in files:
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n".encode()
+            )
+            self.parts.append(data)
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        return iter(self.parts)
+
+
+def encode_image(args: BaseWorkerArgs, image) -> tuple[bytes, str]:
+    if isinstance(image, OutputImage) and not args.reencode_images:
+        return image.data, image.content_type
+
+    # PIL images, or ComfyUI output that should lose its embedded workflow
+    if isinstance(image, OutputImage):
+        image = image.image
+
+    image_bytes = io.BytesIO()
+    image.save(image_bytes, format="PNG")
+    return image_bytes.getvalue(), "image/png"
 
 
 def upload_images(args: BaseWorkerArgs, client: BaseWorkerFile, images, job: ImageJob):
-    url = f"{args.job_server}/api/upload"
     files = []
-    for i, image in enumerate(images):
-        image_bytes = io.BytesIO()
-        image.save(image_bytes, format="PNG")
-        image_bytes.seek(0)  # Reset the stream position to the beginning
-        files.append(("images", (f"image_{i}.png", image_bytes, "image/png")))
-
-    response = requests.post(
-        url,
-        data={
+    with tracing.span("encode_images", images=len(images)):
+        for i, image in enumerate(images):
+            data, content_type = encode_image(args, image)
+            files.append(("images", f"image_{i}.png", content_type, data))
+
+    body = MultipartStream(
+        {
             "channel": job.channel,
             "job_id": job.id,
             "worker_id": client.worker_id,
         },
-        files=files,
+        files,
     )
+    with tracing.span("upload_images", bytes=len(body)):
+        response = job_server(args).post(
+            "/api/upload",
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
     if response.status_code == 200:
         print("Images uploaded successfully.")
     else:
@@ -135,9 +332,7 @@ def login(args: BaseWorkerArgs) -> BaseWorkerFile:
         print("Error decoding JSON from client file.")
 
     # Login and update the client file
-    response = requests.get(
-        f"{args.job_server}/api/init", json=client_data.model_dump()
-    )
+    response = job_server(args).get("/api/init", json=client_data.model_dump())
     if response.status_code == 200:
         updated_data = response.json()
         client_data = BaseWorkerFile(**updated_data)
@@ -159,6 +354,12 @@ def login(args: BaseWorkerArgs) -> BaseWorkerFile:
 
 def base_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Base worker arguments")
+    parser.add_argument(
+        "--cancel_interval",
+        type=int,
+        default=DEFAULT_CANCEL_INTERVAL,
+        help="Seconds between checks for cancelled jobs while they run, 0 to disable",
+    )
     parser.add_argument(
         "--checkpoint_dir",
         type=str,
@@ -171,21 +372,68 @@ def base_parser() -> argparse.ArgumentParser:
         default=DEFAULT_CLIENT_FILE,
         help="File to store client data",
     )
+    parser.add_argument(
+        "--coalesce",
+        type=int,
+        default=DEFAULT_COALESCE,
+        help="Most compatible jobs to run as one prompt, 1 to run every job on its own",
+    )
+    parser.add_argument(
+        "--fake_gpu",
+        action="store_true",
+        help="Use a fake NVML that always reports idle GPUs, for running without a GPU",
+    )
     parser.add_argument(
         "--gpu_index",
         type=int,
         default=DEFAULT_GPU_INDEX,
         help="GPU index to monitor for idle state",
     )
+    parser.add_argument(
+        "--hash_workers",
+        type=int,
+        default=DEFAULT_HASH_WORKERS,
+        help="Number of processes hashing checkpoint files at once",
+    )
+    parser.add_argument(
+        "--http_pool_size",
+        type=int,
+        default=DEFAULT_HTTP_POOL_SIZE,
+        help="Connections kept open to each of the job server and ComfyUI",
+    )
+    parser.add_argument(
+        "--http_retries",
+        type=int,
+        default=DEFAULT_HTTP_RETRIES,
+        help="Retries for failed connections and gateway errors",
+    )
+    parser.add_argument(
+        "--http_timeout",
+        type=int,
+        default=DEFAULT_HTTP_TIMEOUT,
+        help="HTTP request timeout in seconds",
+    )
     parser.add_argument(
         "--idle_threshold",
         type=int,
         default=DEFAULT_IDLE_THRESHOLD,
         help="Idle threshold in seconds for GPU",
     )
+    parser.add_argument(
+        "--idle_utilization",
+        type=int,
+        default=DEFAULT_IDLE_UTILIZATION,
+        help="GPU utilization in percent at or below which the GPU counts as idle",
+    )
     parser.add_argument(
         "--job_server", type=str, default=DEFAULT_JOB_SERVER, help="Job server address"
     )
+    parser.add_argument(
+        "--long_poll",
+        type=int,
+        default=DEFAULT_LONG_POLL,
+        help="Seconds the job server may hold a get-job request open waiting for a job, 0 to disable",
+    )
     parser.add_argument(
         "--lora_dir",
         type=str,
@@ -198,7 +446,49 @@ def base_parser() -> argparse.ArgumentParser:
         default=DEFAULT_POLLING_INTERVAL,
         help="Polling interval in seconds",
     )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=DEFAULT_PREFETCH,
+        help="Number of jobs to claim ahead of the one being run",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=DEFAULT_PROFILE,
+        help="Profile job handling with cProfile and write the stats to this file",
+    )
+    parser.add_argument(
+        "--reencode_images",
+        action="store_true",
+        help="Re-encode images before upload, dropping the workflow ComfyUI embeds in them",
+    )
     parser.add_argument(
         "--single_job", action="store_true", help="Process a single job and exit"
     )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=DEFAULT_TRACE,
+        help="Write the time spent in each stage of every job to this file",
+    )
+    parser.add_argument(
+        "--trace_format",
+        type=str,
+        choices=TRACE_FORMATS,
+        default=DEFAULT_TRACE_FORMAT,
+        help="Write the trace as JSON lines or as Chrome trace events",
+    )
+    parser.add_argument(
+        "--trace_summary",
+        type=int,
+        default=DEFAULT_TRACE_SUMMARY,
+        help="Print each job's stage times and a summary every this many jobs, 0 to disable",
+    )
+    parser.add_argument(
+        "--watch_interval",
+        type=int,
+        default=DEFAULT_WATCH_INTERVAL,
+        help="Seconds between checks of the checkpoint and LoRA directories for changes",
+    )
     return parser
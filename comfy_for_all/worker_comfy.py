@@ -1,60 +1,146 @@
 import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
 import uuid
 import json
-import urllib.request
-import urllib.parse
-from PIL import Image
-import io
 import time
 import random
+import threading
+import copy
+import contextvars
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from gpu_nvidia import GPUIdleTimer
-from hashes import hash_directory, hash_to_model_name
+from gpu_nvidia import FakeNvml, GPUIdleTimer, GPUMonitor
+from hashes import HashStore, HashWatcher, hash_to_model_name
+from http_client import HttpClient, get_client
 from models import ImageJob
-from worker_base import get_job, upload_images, BaseWorkerArgs, login, base_parser
+from result_cache import ResultCache, graph_key
+import tracing
+from worker_base import (
+    get_cancelled,
+    get_jobs,
+    release_jobs,
+    upload_images,
+    BaseWorkerArgs,
+    OutputImage,
+    login,
+    base_parser,
+)
+
+
+DEFAULT_IMAGE_FETCH_CONCURRENCY = 4
+DEFAULT_QUEUE_DEPTH = 1
+DEFAULT_RESULT_CACHE_SIZE = 2048  # MiB
+DEFAULT_RESULT_THREADS = 2
 
 
 class ComfyWorkerArgs(BaseWorkerArgs):
     comfy_id: str
     comfy_server: str
+    image_fetch_concurrency: int = DEFAULT_IMAGE_FETCH_CONCURRENCY
+    queue_depth: int = DEFAULT_QUEUE_DEPTH
+    result_cache: str | None = None
+    result_cache_size: int = DEFAULT_RESULT_CACHE_SIZE
+    result_threads: int = DEFAULT_RESULT_THREADS
+    slots: list[str] | None = None
 
-    def __init__(self, comfy_id=uuid.uuid4().hex, comfy_server="", **kwargs):
+    def __init__(
+        self,
+        comfy_id=uuid.uuid4().hex,
+        comfy_server="",
+        image_fetch_concurrency=DEFAULT_IMAGE_FETCH_CONCURRENCY,
+        queue_depth=DEFAULT_QUEUE_DEPTH,
+        result_cache=None,
+        result_cache_size=DEFAULT_RESULT_CACHE_SIZE,
+        result_threads=DEFAULT_RESULT_THREADS,
+        slots=None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.comfy_id = comfy_id
         self.comfy_server = comfy_server
+        self.image_fetch_concurrency = image_fetch_concurrency
+        self.queue_depth = queue_depth
+        self.result_cache = result_cache
+        self.result_cache_size = result_cache_size
+        self.result_threads = result_threads
+        self.slots = slots
+
+
+def comfy_server(args: ComfyWorkerArgs) -> HttpClient:
+    return get_client(
+        "http://{}".format(args.comfy_server),
+        args.http_timeout,
+        args.http_retries,
+        args.http_pool_size,
+    )
 
 
 def queue_prompt(args: ComfyWorkerArgs, prompt):
     p = {"prompt": prompt, "client_id": args.comfy_id}
-    data = json.dumps(p).encode("utf-8")
-    req = urllib.request.Request(
-        "http://{}/prompt".format(args.comfy_server), data=data
-    )
-    return json.loads(urllib.request.urlopen(req).read())
+    with tracing.span("queue_prompt"):
+        response = comfy_server(args).post("/prompt", json=p)
+    response.raise_for_status()
+    return response.json()
 
 
 def get_image(args: ComfyWorkerArgs, filename, subfolder, folder_type):
     data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    complete_url = "http://{}/view?{}".format(args.comfy_server, url_values)
-    print(f"Fetching image from: {complete_url}")
+    print(f"Fetching image {filename} from: {args.comfy_server}")
+
+    with tracing.span("get_image", filename=filename):
+        response = comfy_server(args).get("/view", params=data)
+    response.raise_for_status()
+    return response.content
 
-    with urllib.request.urlopen(complete_url) as response:
-        return response.read()
+
+def interrupt_prompt(args: ComfyWorkerArgs, prompt_id):
+    # Newer ComfyUI only interrupts if this prompt is the one running, older
+    # versions interrupt whatever is running
+    response = comfy_server(args).post("/interrupt", json={"prompt_id": prompt_id})
+    response.raise_for_status()
+
+
+def delete_prompt(args: ComfyWorkerArgs, prompt_id):
+    response = comfy_server(args).post("/queue", json={"delete": [prompt_id]})
+    response.raise_for_status()
 
 
 def get_history(args: ComfyWorkerArgs, prompt_id):
-    with urllib.request.urlopen(
-        "http://{}/history/{}".format(args.comfy_server, prompt_id)
-    ) as response:
-        return json.loads(response.read())
+    with tracing.span("get_history"):
+        response = comfy_server(args).get("/history/{}".format(prompt_id))
+    response.raise_for_status()
+    return response.json()
 
 
-def get_images(args: ComfyWorkerArgs, ws, prompt):
+def get_queue(args: ComfyWorkerArgs) -> set[str]:
+    """IDs of the prompts ComfyUI is running or has queued."""
+    response = comfy_server(args).get("/queue")
+    response.raise_for_status()
+    queue = response.json()
+    # Entries are [number, prompt_id, prompt, extra_data, outputs_to_execute]
+    return {
+        entry[1]
+        for entry in queue.get("queue_running", []) + queue.get("queue_pending", [])
+    }
+
+
+def get_images(args: ComfyWorkerArgs, ws, prompt, cancelled=None):
     prompt_id = queue_prompt(args, prompt)["prompt_id"]
-    output_images = {}
+    if cancelled is not None and args.cancel_interval:
+        # Wake up every so often to ask whether the job was cancelled
+        ws.settimeout(args.cancel_interval)
+
     while True:
-        out = ws.recv()
+        try:
+            out = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            if cancelled():
+                delete_prompt(args, prompt_id)
+                interrupt_prompt(args, prompt_id)
+                raise PromptCancelled(prompt_id)
+            continue
+
         if isinstance(out, str):
             message = json.loads(out)
             if message["type"] == "executing":
@@ -67,21 +153,184 @@ def get_images(args: ComfyWorkerArgs, ws, prompt):
             # preview_image = Image.open(bytesIO) # This is your preview in PIL image format, store it in a global
             continue  # Previews are binary data
 
+    return collect_images(args, prompt_id)
+
+
+def collect_images(args: ComfyWorkerArgs, prompt_id) -> dict[str, list[bytes | None]]:
+    """
+    Images by output node, in output order.
+
+    Every image keeps its position, None where it could not be fetched, so
+    images can be matched to the job they belong to by where they are.
+    """
     history = get_history(args, prompt_id)[prompt_id]
+
+    # Fetch every output image at once, keeping each node's images in order
+    wanted = []
     for node_id in history["outputs"]:
         node_output = history["outputs"][node_id]
-        images_output = []
-        if "images" in node_output:
-            for image in node_output["images"]:
-                image_data = get_image(
-                    args, image["filename"], image["subfolder"], image["type"]
-                )
-                images_output.append(image_data)
-        output_images[node_id] = images_output
+        for image in node_output.get("images", []):
+            wanted.append((node_id, image))
+
+    output_images = {node_id: [] for node_id in history["outputs"]}
+    if not wanted:
+        return output_images
+
+    workers = max(1, min(args.image_fetch_concurrency, len(wanted)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        fetches = [
+            pool.submit(
+                # Keeps the job the spans belong to
+                contextvars.copy_context().run,
+                get_image,
+                args,
+                image["filename"],
+                image["subfolder"],
+                image["type"],
+            )
+            for _, image in wanted
+        ]
+
+    for (node_id, image), fetch in zip(wanted, fetches):
+        try:
+            output_images[node_id].append(fetch.result())
+        except Exception as e:
+            print(f"Failed to fetch image {image['filename']} for node {node_id}: {e}")
+            output_images[node_id].append(None)
 
     return output_images
 
 
+class PromptFailed(Exception):
+    pass
+
+
+class PromptCancelled(PromptFailed):
+    pass
+
+
+class ComfySession:
+    """
+    A long-lived websocket to ComfyUI shared by every prompt the worker queues.
+
+    A reader thread routes execution messages by prompt_id, so several prompts
+    can be outstanding at once and each one resolves its own future.
+    """
+
+    def __init__(self, args: ComfyWorkerArgs):
+        self.args = args
+        self.lock = threading.Lock()
+        self.pending: dict[str, Future] = {}
+        self.running = None  # the prompt ComfyUI is working on, if it is ours
+        self.ws = None
+        self._thread = None
+
+    def connect(self):
+        self.ws = websocket.WebSocket()
+        self.ws.connect(
+            "ws://{}/ws?clientId={}".format(self.args.comfy_server, self.args.comfy_id)
+        )
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read_loop, daemon=True)
+            self._thread.start()
+
+    def outstanding(self) -> int:
+        return len(self.pending)
+
+    def submit(self, prompt) -> tuple[str, Future]:
+        """Queue a prompt and return its ID with a future that resolves when it finishes."""
+        done = Future()
+        # Hold the lock until the future is registered, so the reader cannot
+        # see the prompt finish before anyone is waiting for it
+        with self.lock:
+            prompt_id = queue_prompt(self.args, prompt)["prompt_id"]
+            self.pending[prompt_id] = done
+        return prompt_id, done
+
+    def cancel(self, prompt_id):
+        """Stop a prompt: take it out of the ComfyUI queue, or interrupt it if it is running."""
+        if prompt_id not in self.pending:
+            return
+
+        if self.running != prompt_id:
+            delete_prompt(self.args, prompt_id)
+            if self.running != prompt_id:
+                # A prompt taken out of the queue sends no more messages
+                self._resolve(prompt_id, "cancelled", PromptCancelled)
+                return
+
+        # Resolves when ComfyUI reports the interruption
+        interrupt_prompt(self.args, prompt_id)
+
+    def _resolve(self, prompt_id, error=None, exception=PromptFailed):
+        with self.lock:
+            done = self.pending.pop(prompt_id, None)
+            if self.running == prompt_id:
+                self.running = None
+        if done is None:
+            return  # queued by someone else on this client ID, or cancelled
+
+        if error is None:
+            done.set_result(prompt_id)
+        else:
+            done.set_exception(exception(error))
+
+    def _handle(self, message):
+        data = message.get("data", {})
+        if message["type"] == "execution_start":
+            self.running = data.get("prompt_id")
+        elif message["type"] == "executing":
+            if data.get("node") is None:
+                self._resolve(data.get("prompt_id"))  # Execution is done
+            else:
+                self.running = data.get("prompt_id")
+        elif message["type"] == "execution_error":
+            self._resolve(data.get("prompt_id"), data.get("exception_message"))
+        elif message["type"] == "execution_interrupted":
+            self._resolve(data.get("prompt_id"), "interrupted", PromptCancelled)
+
+    def _reconnect(self):
+        while True:
+            try:
+                self.connect()
+                self._recover()
+                return
+            except Exception as e:
+                print(f"Failed to reconnect to ComfyUI: {e}")
+                time.sleep(5)
+
+    def _recover(self):
+        # Prompts may have finished while we were disconnected, and if ComfyUI
+        # restarted the ones it had queued or was running are gone. Take the
+        # pending prompts before asking for the queue, so a prompt submitted in
+        # between is not mistaken for a lost one.
+        prompt_ids = list(self.pending)
+        queued = get_queue(self.args)
+        for prompt_id in prompt_ids:
+            if prompt_id in get_history(self.args, prompt_id):
+                self._resolve(prompt_id)
+            elif prompt_id not in queued:
+                print(f"Prompt {prompt_id} was lost by ComfyUI")
+                self._resolve(prompt_id, "lost when ComfyUI restarted")
+
+    def _read_loop(self):
+        while True:
+            try:
+                out = self.ws.recv()
+            except Exception as e:
+                print(f"ComfyUI websocket closed: {e}, reconnecting")
+                self._reconnect()
+                continue
+
+            # Binary messages are latent previews, which we do not use
+            if isinstance(out, str):
+                try:
+                    self._handle(json.loads(out))
+                except Exception as e:
+                    # This is the only reader, it must outlive a bad message
+                    print(f"Failed to handle ComfyUI message {out[:200]!r}: {e}")
+
+
 def parse_size(size_str):
     """Parse a size string in the format 'widthxheight'."""
     try:
@@ -91,14 +340,24 @@ def parse_size(size_str):
         raise ValueError("Size must be in the format 'widthxheight', e.g., '512x512'.")
 
 
-def generate_prompt(job: ImageJob, hashes: list[tuple[str, str]]):
+def job_seed(job: ImageJob) -> int:
+    if job.seed is not None:
+        return job.seed
+    return random.randint(0, 2**32 - 1)
+
+
+def generate_prompt(job: ImageJob, hashes: HashStore):
     width, height = parse_size(job.resolution)
-    model_name = hash_to_model_name(job.model, hashes)
-    seed = random.randint(0, 2**32 - 1)
+    model_name = hash_to_model_name(job.model, hashes, job.model_fingerprint)
+    seed = job_seed(job)
     print(
         f"Using model {model_name} for job {job.id} with {job.batch_size} images of size {width}x{height} and seed {seed}."
     )
+    return job_graph(job, model_name, seed)
+
 
+def job_graph(job: ImageJob, model_name: str, seed: int):
+    width, height = parse_size(job.resolution)
     prompt = {
         "3": {
             "class_type": "KSampler",
@@ -155,25 +414,263 @@ def generate_prompt(job: ImageJob, hashes: list[tuple[str, str]]):
     return prompt
 
 
-def run_job(args: ComfyWorkerArgs, job, hashes):
+def cache_key(job: ImageJob) -> str | None:
+    """Result cache key for a job, only jobs with an explicit seed are cached."""
+    if job.seed is None:
+        return None
+
+    # The model hash stands in for the file name, so a checkpoint replaced
+    # under the same name does not serve stale images
+    return graph_key(job_graph(job, job.model, job.seed))
+
+
+def batch_groups(jobs: list[ImageJob]) -> list[list[int]]:
+    """
+    Indexes of the jobs in a coalesced prompt that can share one sampler.
+
+    Core ComfyUI nodes cannot give each latent in a batch its own positive
+    prompt, and KSampler draws the noise for a whole batch from one seed, so
+    only jobs with the same positive prompt and no requested seed are
+    sampled together. Any other job gets a sampler of its own, so its images
+    match a run on its own.
+    """
+    groups = []
+    shared = {}
+    for index, job in enumerate(jobs):
+        if job.seed is not None:
+            groups.append([index])
+        elif job.requested_prompt in shared:
+            shared[job.requested_prompt].append(index)
+        else:
+            shared[job.requested_prompt] = [index]
+            groups.append(shared[job.requested_prompt])
+    return groups
+
+
+def batch_group_node(group: int, offset: int) -> str:
+    # Positive prompt, latent, sampler, decode and save nodes of a group
+    return str(10 + 5 * group + offset)
+
+
+def batch_outputs(jobs: list[ImageJob]) -> list[tuple[str, slice]]:
+    """The save node and slice of its images that hold each job's images in a coalesced prompt."""
+    outputs = [None] * len(jobs)
+    for group, indexes in enumerate(batch_groups(jobs)):
+        for position, index in enumerate(indexes):
+            size = jobs[index].batch_size
+            batch = slice(position * size, (position + 1) * size)
+            outputs[index] = (batch_group_node(group, 4), batch)
+    return outputs
+
+
+def generate_batch_prompt(jobs: list[ImageJob], hashes: HashStore):
+    """
+    Run several compatible jobs in one prompt.
+
+    The checkpoint and negative prompt are shared. Jobs that batch_groups puts
+    together are sampled as one batch of batch_size images per job, the others
+    get a sampler each. batch_outputs says where each job's images end up.
+    """
+    lead = jobs[0]
+    width, height = parse_size(lead.resolution)
+    model_name = hash_to_model_name(lead.model, hashes, lead.model_fingerprint)
+    groups = batch_groups(jobs)
+    print(
+        f"Using model {model_name} for jobs {[job.id for job in jobs]} in {len(groups)} batches with {lead.batch_size} images each of size {width}x{height}."
+    )
+
+    prompt = {
+        "4": {
+            "class_type": "CheckpointLoaderSimple",
+            "inputs": {
+                "ckpt_name": model_name,
+            },
+        },
+        "7": {
+            "class_type": "CLIPTextEncode",
+            "inputs": {
+                "clip": ["4", 1],
+                "text": lead.negative_prompt,
+            },
+        },
+    }
+
+    for group, indexes in enumerate(groups):
+        job = jobs[indexes[0]]
+        positive, latent, sampler, decode, save = (
+            batch_group_node(group, offset) for offset in range(5)
+        )
+        prompt[positive] = {
+            "class_type": "CLIPTextEncode",
+            "inputs": {
+                "clip": ["4", 1],
+                "text": job.requested_prompt,
+            },
+        }
+        prompt[latent] = {
+            "class_type": "EmptyLatentImage",
+            "inputs": {
+                "batch_size": lead.batch_size * len(indexes),
+                "height": height,
+                "width": width,
+            },
+        }
+        prompt[sampler] = {
+            "class_type": "KSampler",
+            "inputs": {
+                "cfg": lead.config_scale,
+                "denoise": 1,
+                "latent_image": [latent, 0],
+                "model": ["4", 0],
+                "negative": ["7", 0],
+                "positive": [positive, 0],
+                "sampler_name": "euler",
+                "scheduler": "normal",
+                "seed": job_seed(job),
+                "steps": lead.steps,
+            },
+        }
+        prompt[decode] = {
+            "class_type": "VAEDecode",
+            "inputs": {"samples": [sampler, 0], "vae": ["4", 2]},
+        }
+        prompt[save] = {
+            "class_type": "SaveImage",
+            "inputs": {"filename_prefix": "ComfyUI", "images": [decode, 0]},
+        }
+
+    return prompt
+
+
+def run_job(args: ComfyWorkerArgs, job, hashes, cancelled=None):
     prompt = generate_prompt(job, hashes)
 
     ws = websocket.WebSocket()
     ws.connect("ws://{}/ws?clientId={}".format(args.comfy_server, args.comfy_id))
-    images = get_images(args, ws, prompt)
+    images = get_images(args, ws, prompt, cancelled)
     ws.close()
 
-    output_images = []
+    return output_images(images)
+
+
+def output_images(images) -> list[OutputImage]:
+    # Keep the PNG bytes ComfyUI sent, they are uploaded as they are
+    outputs = []
     for node_id in images:
         print(
             f"Processing images for node {node_id} with {len(images[node_id])} images."
         )
         for image_data in images[node_id]:
-            image = Image.open(io.BytesIO(image_data))
-            print(f"Image size: {image.size}, mode: {image.mode}")
-            output_images.append(image)
+            if image_data is None:
+                continue  # failed to fetch, already reported
+            outputs.append(OutputImage(image_data))
+
+    return outputs
+
+
+def finish_job(
+    args: ComfyWorkerArgs,
+    client,
+    job: ImageJob,
+    done: Future,
+    cache: ResultCache | None = None,
+):
+    """Collect and upload the results of a finished prompt, runs on a result thread."""
+    try:
+        with tracing.job(job.id):
+            collect_job(args, client, job, done, cache)
+    finally:
+        for member in [job, *job.coalesced]:
+            tracing.finish_job(member.id)
 
-    return output_images
+
+def collect_job(
+    args: ComfyWorkerArgs,
+    client,
+    job: ImageJob,
+    done: Future,
+    cache: ResultCache | None = None,
+):
+    try:
+        prompt_id = done.result()
+        with tracing.span("collect_images"):
+            images = collect_images(args, prompt_id)
+    except PromptCancelled:
+        print(f"Job {job.id} was cancelled")
+        return
+    except Exception as e:
+        print(f"Job {job.id} failed: {e}")
+        return
+
+    if job.coalesced:
+        # Hand each job its own images from the batch it was sampled in
+        members = [job, *job.coalesced]
+        for member, (node_id, batch) in zip(members, batch_outputs(members)):
+            member_images = images.get(node_id, [])[batch]
+            if len(member_images) < member.batch_size or None in member_images:
+                # Never fill the gap with images from the rest of the batch,
+                # they belong to other jobs
+                give_back(args, client, member)
+                continue
+
+            job_images = output_images({node_id: member_images})
+            cache_job(cache, member, job_images)
+            upload_job(args, client, member, job_images)
+        return
+
+    if any(None in node_images for node_images in images.values()):
+        # Part of a result would settle the job for good, and be served from
+        # the cache for every repeat of it
+        give_back(args, client, job)
+        return
+
+    job_images = output_images(images)
+    cache_job(cache, job, job_images)
+    upload_job(args, client, job, job_images)
+
+
+def give_back(args: ComfyWorkerArgs, client, job: ImageJob):
+    """Requeue a job that is missing images, so it runs again rather than upload part of it."""
+    print(f"Job {job.id} is missing images, giving it back to the server")
+    try:
+        release_jobs(args, client, [job.id])
+    except Exception as e:
+        # It is requeued when its lease expires instead
+        print(f"Failed to give back job {job.id}: {e}")
+
+
+def log_failure(result: Future):
+    """Done callback for result thread work, which has nobody else to report to."""
+    error = result.exception()
+    if error is not None:
+        print("Result thread failed:")
+        traceback.print_exception(error)
+
+
+def cache_job(cache: ResultCache | None, job: ImageJob, images: list[OutputImage]):
+    key = cache_key(job) if cache is not None else None
+    if key is not None:
+        cache.put(key, [image.data for image in images])
+
+
+def upload_cached(args: ComfyWorkerArgs, client, job: ImageJob, images: list[bytes]):
+    """Upload results from the cache, runs on a result thread."""
+    try:
+        with tracing.job(job.id):
+            upload_job(args, client, job, [OutputImage(data) for data in images])
+    finally:
+        tracing.finish_job(job.id)
+
+
+def upload_job(
+    args: ComfyWorkerArgs, client, job: ImageJob, images: list[OutputImage]
+):
+    print(f"Job {job.id} completed with {len(images)} images.")
+    if not images:
+        print("No images generated, skipping upload.")
+        return
+
+    upload_images(args, client, images, job)  # Upload images to the server
 
 
 def parse_args() -> ComfyWorkerArgs:
@@ -190,48 +687,418 @@ def parse_args() -> ComfyWorkerArgs:
         default="127.0.0.1:8188",
         help="ComfyUI server address",
     )
-    return parser.parse_args(namespace=ComfyWorkerArgs)
+    parser.add_argument(
+        "--image_fetch_concurrency",
+        type=int,
+        default=DEFAULT_IMAGE_FETCH_CONCURRENCY,
+        help="Number of output images to download from ComfyUI at once",
+    )
+    parser.add_argument(
+        "--queue_depth",
+        type=int,
+        default=DEFAULT_QUEUE_DEPTH,
+        help="Number of prompts to keep queued on ComfyUI at once",
+    )
+    parser.add_argument(
+        "--result_cache",
+        type=str,
+        default=None,
+        help="Folder to cache the images of jobs with an explicit seed in",
+    )
+    parser.add_argument(
+        "--result_cache_size",
+        type=int,
+        default=DEFAULT_RESULT_CACHE_SIZE,
+        help="Most MiB the result cache may use before old entries are evicted",
+    )
+    parser.add_argument(
+        "--result_threads",
+        type=int,
+        default=DEFAULT_RESULT_THREADS,
+        help="Number of threads collecting and uploading finished jobs",
+    )
+    parser.add_argument(
+        "--slots",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Run several GPUs from one worker, as gpu_index=host:port pairs for each ComfyUI instance",
+    )
+    return ComfyWorkerArgs(**vars(parser.parse_args()))
 
 
-def job_loop(args: ComfyWorkerArgs):
-    client = login(args)
+class JobSource:
+    """
+    Jobs claimed from the server, shared by every slot in the worker.
 
-    idle_timer = GPUIdleTimer(
-        gpu_index=args.gpu_index, idle_threshold=args.idle_threshold
-    )
-    idle_timer.load_nvml()  # Initialize NVML for GPU monitoring
+    Whichever slot is free takes the next job. Jobs are prefetched in the
+    background so the next one is ready when a slot frees up.
+    """
 
-    hashes = hash_directory(args.checkpoint_dir)  # Load or hash safetensors files
+    def __init__(self, args: ComfyWorkerArgs, client, hashes, loras):
+        self.args = args
+        self.client = client
+        self.hashes = hashes
+        self.loras = loras
+        self.lock = threading.Lock()
+        self.pending = deque()  # jobs claimed ahead of the ones being run
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.refill = None
+        self.slots = set()  # every slot taking jobs from here
+        self.busy = set()  # slots whose GPU is busy with other work
 
-    while True:
-        # Increment the idle timer and check if the GPU is idle
-        idle_timer.increment_timer()
-        if not idle_timer.has_reached_idle_threshold():
-            print(
-                f"GPU {idle_timer.gpu_index} has only been idle for {idle_timer.idle_time:0.2f} seconds, waiting."
+    def add_slot(self, slot):
+        with self.lock:
+            self.slots.add(slot)
+
+    def _take_refill(self):
+        # Called with the lock held. A failed prefetch is dropped, so the
+        # next call polls the server again instead of raising it forever.
+        refill, self.refill = self.refill, None
+        try:
+            self.pending.extend(refill.result())
+        except Exception as e:
+            print(f"Failed to prefetch jobs: {e}")
+
+    def next_job(self, slot=None) -> tuple[ImageJob | None, bool]:
+        """Return the next job, and whether an empty answer already waited on a long-poll."""
+        args = self.args
+        with self.lock:
+            self.busy.discard(slot)
+
+            # Collect the jobs prefetched while the last job was running
+            if self.refill is not None:
+                self._take_refill()
+
+            if not self.pending:
+                poll_start = time.time()
+                self.pending.extend(
+                    get_jobs(
+                        args,
+                        self.client,
+                        self.hashes,
+                        1 + args.prefetch,
+                        loras=self.loras,
+                    )
+                )
+
+            if not self.pending:
+                # A long-poll that ran its course has already waited
+                waited = bool(args.long_poll) and (
+                    time.time() - poll_start >= args.long_poll / 2
+                )
+                return None, waited
+
+            job = self.pending.popleft()
+
+            # Top up the prefetch buffer in the background while this job
+            # runs, without long-polling so an empty queue does not hold up
+            # the next job
+            if len(self.pending) < args.prefetch:
+                self.refill = self.prefetcher.submit(
+                    get_jobs,
+                    args,
+                    self.client,
+                    self.hashes,
+                    args.prefetch - len(self.pending),
+                    False,
+                    self.loras,
+                )
+
+            return job, False
+
+    def release_pending(self, slot):
+        """
+        Give the prefetched jobs back to the server once every slot is busy.
+
+        Their leases keep running while they wait, so when every GPU is busy
+        with other work they could expire, be handed to another worker and
+        then be rendered twice. As long as one slot can still take jobs, the
+        prefetched ones are kept for it.
+        """
+        with self.lock:
+            self.busy.add(slot)
+            if self.busy < self.slots:
+                return
+
+            if self.refill is not None and self.refill.done():
+                self._take_refill()
+
+            jobs = list(self.pending)
+            self.pending.clear()
+
+        if not jobs:
+            return
+
+        job_ids = [member.id for job in jobs for member in [job, *job.coalesced]]
+        try:
+            released = release_jobs(self.args, self.client, job_ids)
+            print(f"Gave back {released} prefetched jobs while the GPU is busy")
+        except Exception as e:
+            # Their leases expire and they are requeued all the same
+            print(f"Failed to give back prefetched jobs {job_ids}: {e}")
+
+
+class WorkerSlot:
+    """One GPU and the ComfyUI instance running on it."""
+
+    def __init__(
+        self,
+        args: ComfyWorkerArgs,
+        client,
+        monitor: GPUMonitor,
+        jobs: JobSource,
+        results: ThreadPoolExecutor,
+        cache: ResultCache | None = None,
+    ):
+        self.args = args
+        self.client = client
+        self.jobs = jobs
+        jobs.add_slot(self)
+        self.results = results
+        self.cache = cache
+
+        self.idle_timer = GPUIdleTimer(
+            gpu_index=args.gpu_index,
+            idle_threshold=args.idle_threshold,
+            idle_utilization=args.idle_utilization,
+            monitor=monitor,
+        )
+        self.idle_timer.load_nvml()  # Initialize NVML for GPU monitoring
+
+        # Prompts are queued over one websocket, and results are collected and
+        # uploaded in the background while ComfyUI works on the next prompt
+        self.session = ComfySession(args)
+        self.session.connect()
+        self.slots = threading.BoundedSemaphore(args.queue_depth)
+
+        # Prompts in ComfyUI and the jobs in them, checked for cancellation
+        self.lock = threading.Lock()
+        self.in_flight: dict[str, set[str]] = {}
+        if args.cancel_interval > 0:
+            threading.Thread(target=self.watch_cancelled, daemon=True).start()
+
+    def watch_cancelled(self):
+        while True:
+            time.sleep(self.args.cancel_interval)
+            with self.lock:
+                in_flight = dict(self.in_flight)
+            if not in_flight:
+                continue
+
+            try:
+                cancelled = get_cancelled(
+                    self.args, self.client, set().union(*in_flight.values())
+                )
+                # A coalesced prompt keeps running until every job in it is cancelled
+                for prompt_id, job_ids in in_flight.items():
+                    if job_ids <= cancelled:
+                        print(f"Cancelling prompt {prompt_id} for jobs {sorted(job_ids)}")
+                        self.session.cancel(prompt_id)
+            except Exception as e:
+                print(f"Failed to check for cancelled jobs: {e}")
+
+    def on_prompt_done(
+        self, done: Future, job: ImageJob, prompt_id: str, queued_at: float
+    ):
+        with self.lock:
+            self.in_flight.pop(prompt_id, None)
+        tracing.record("comfy_wait", queued_at, time.time(), job.id)
+        self.idle_timer.set_own_work(self.session.outstanding() > 0)
+        self.slots.release()  # ComfyUI has room for another prompt
+        self.results.submit(
+            tracing.profiled(finish_job), self.args, self.client, job, done, self.cache
+        ).add_done_callback(log_failure)
+
+    def serve_cached(self, job: ImageJob) -> ImageJob | None:
+        """Upload any cached results, and return what is left to render, if anything."""
+        remaining = []
+        for member in [job, *job.coalesced]:
+            key = cache_key(member)
+            images = self.cache.get(key) if key is not None else None
+            if images is None:
+                remaining.append(member)
+                continue
+
+            print(f"Serving job {member.id} from the result cache")
+            self.results.submit(
+                upload_cached, self.args, self.client, member, images
+            ).add_done_callback(log_failure)
+
+        if not remaining:
+            return None
+        return remaining[0].model_copy(update={"coalesced": remaining[1:]})
+
+    def drop_cancelled(self, job: ImageJob) -> ImageJob | None:
+        """Leave out jobs cancelled while they waited to start, and return what is left."""
+        members = [job, *job.coalesced]
+        try:
+            cancelled = get_cancelled(
+                self.args, self.client, [member.id for member in members]
             )
-            time.sleep(args.polling_interval)
-            continue
+        except Exception as e:
+            # The watcher still stops the prompt if the server answers later
+            print(f"Failed to check job {job.id} for cancellation: {e}")
+            return job
 
-        # Get the next job from the server
-        print(
-            f"GPU {idle_timer.gpu_index} has been idle for {idle_timer.idle_time:0.2f} seconds, getting next job."
+        remaining = []
+        for member in members:
+            if str(member.id) in cancelled:
+                print(f"Job {member.id} was cancelled before it started")
+                tracing.finish_job(member.id)
+            else:
+                remaining.append(member)
+
+        if not remaining:
+            return None
+        return remaining[0].model_copy(update={"coalesced": remaining[1:]})
+
+    def start_job(self, job: ImageJob):
+        # Prefetched jobs may have been cancelled while they were waiting
+        if self.args.cancel_interval > 0:
+            job = self.drop_cancelled(job)
+            if job is None:
+                self.slots.release()  # Nothing for ComfyUI to do
+                return
+
+        if self.cache is not None:
+            job = self.serve_cached(job)
+            if job is None:
+                self.slots.release()  # Nothing for ComfyUI to do
+                return
+
+        with tracing.job(job.id), tracing.span("generate_prompt"):
+            if job.coalesced:
+                jobs = [job, *job.coalesced]
+                prompt = generate_batch_prompt(jobs, self.jobs.hashes)
+            else:
+                prompt = generate_prompt(job, self.jobs.hashes)
+
+        self.idle_timer.set_own_work(True)
+        with tracing.job(job.id):
+            prompt_id, done = self.session.submit(prompt)
+        print(f"Queued prompt {prompt_id} for job {job.id}")
+
+        with self.lock:
+            if not done.done():
+                self.in_flight[prompt_id] = {
+                    str(member.id) for member in [job, *job.coalesced]
+                }
+        queued_at = time.time()
+        done.add_done_callback(
+            lambda done: self.on_prompt_done(done, job, prompt_id, queued_at)
         )
-        job = get_job(args, client, hashes)
-        if not job:
-            print("No jobs available, waiting...")
-            time.sleep(args.polling_interval)
-            continue
 
-        # Create an ImageJob instance from the job data
-        print(f"Processing job: {job.id} with prompt: {job.requested_prompt}")
-        images = run_job(args, job, hashes)
-        print(f"Job {job.id} completed with {len(images)} images.")
-        if not images:
-            print("No images generated, skipping upload.")
-            continue
+    def run(self):
+        args = self.args
+        idle_timer = self.idle_timer
+        while True:
+            # Wait for room in the ComfyUI queue
+            self.slots.acquire()
+
+            # Check if the GPU is idle. While our own prompts are running the
+            # GPU is busy because of us, so skip the check.
+            if self.session.outstanding() == 0:
+                idle_timer.increment_timer()
+                if not idle_timer.has_reached_idle_threshold():
+                    print(
+                        f"GPU {idle_timer.gpu_index} has only been idle for {idle_timer.idle_time:0.2f} seconds, waiting."
+                    )
+                    self.slots.release()
+                    self.jobs.release_pending(self)
+                    idle_timer.wait_until_idle(args.polling_interval)
+                    continue
+
+                # Get the next job from the server
+                print(
+                    f"GPU {idle_timer.gpu_index} has been idle for {idle_timer.idle_time:0.2f} seconds, getting next job."
+                )
+
+            try:
+                job, waited = self.jobs.next_job(self)
+            except Exception:
+                print("Failed to get the next job:")
+                traceback.print_exc()
+                job, waited = None, False
+
+            if job is None:
+                self.slots.release()
+                if waited:
+                    continue
+
+                print("No jobs available, waiting...")
+                time.sleep(args.polling_interval)
+                continue
+
+            print(
+                f"Processing job: {job.id} on GPU {args.gpu_index} with prompt: {job.requested_prompt}"
+            )
+            try:
+                tracing.profiled(self.start_job)(job)
+            except Exception:
+                # Nothing was queued in ComfyUI, so no callback frees the slot.
+                # The job goes back to the queue when its lease expires.
+                print(f"Failed to start job {job.id}:")
+                traceback.print_exc()
+                self.slots.release()
+
+
+def parse_slots(args: ComfyWorkerArgs) -> list[ComfyWorkerArgs]:
+    """Split --slots into one set of arguments per GPU and ComfyUI instance."""
+    if not args.slots:
+        return [args]
+
+    slots = []
+    for slot in args.slots:
+        gpu_index, _, server = slot.partition("=")
+        if not server:
+            raise ValueError("Slots must be in the format 'gpu_index=host:port'.")
+
+        slot_args = copy.copy(args)
+        slot_args.gpu_index = int(gpu_index)
+        slot_args.comfy_server = server
+        slot_args.comfy_id = f"{args.comfy_id}-{gpu_index}"
+        slots.append(slot_args)
+    return slots
+
+
+def job_loop(args: ComfyWorkerArgs):
+    tracing.configure(args.trace, args.trace_format, args.trace_summary, args.profile)
+    client = login(args)
+
+    # Sample every GPU in the background for the idle timers
+    monitor = GPUMonitor(FakeNvml(count=8) if args.fake_gpu else None)
+
+    # Advertise the models we already know right away, new and changed files
+    # are hashed in the background and the directories are watched for changes
+    checkpoints = HashWatcher(
+        args.checkpoint_dir, "checkpoint_db.json", args.hash_workers, args.watch_interval
+    ).start()
+    loras = HashWatcher(
+        args.lora_dir, "lora_db.json", args.hash_workers, args.watch_interval
+    ).start()
+
+    # The login, hashes, job server connection and result threads are shared
+    # by every slot
+    jobs = JobSource(args, client, checkpoints.hashes, loras.hashes)
+    results = ThreadPoolExecutor(max_workers=args.result_threads)
+    cache = None
+    if args.result_cache:
+        cache = ResultCache(args.result_cache, args.result_cache_size * 2**20).open()
+    slots = [
+        WorkerSlot(slot_args, client, monitor, jobs, results, cache)
+        for slot_args in parse_slots(args)
+    ]
+    if len(slots) == 1:
+        slots[0].run()
+        return
 
-        upload_images(args, client, images, job)  # Upload images to the server
+    print(f"Running {len(slots)} slots: {', '.join(args.slots)}")
+    threads = [threading.Thread(target=slot.run, daemon=True) for slot in slots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == "__main__":
@@ -252,4 +1119,7 @@ if __name__ == "__main__":
         )
         run_job(job)
     else:
-        job_loop(args)
+        try:
+            job_loop(args)
+        finally:
+            tracing.close()
@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+PACKAGE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "comfy_for_all")
+
+# The modules import each other by bare name, like the scripts they are run as
+sys.path.insert(0, PACKAGE)
+
+
+@pytest.fixture(params=["files", "sqlite"])
+def backend(request, tmp_path):
+    """An unopened job backend of each kind, queueing the files in tmp_path/jobs."""
+    from job_backend import FileJobBackend, SqliteJobBackend
+
+    folder = tmp_path / "jobs"
+    folder.mkdir()
+    if request.param == "files":
+        return FileJobBackend(str(folder), str(tmp_path / "leases.jsonl"), 60)
+    return SqliteJobBackend(str(tmp_path / "jobs.sqlite3"), str(folder), 60)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """server_file imported fresh, running from tmp_path/server with the default config."""
+    folder = tmp_path / "server"
+    folder.mkdir()
+    (tmp_path / "jobs").mkdir()
+    # Its paths are relative, so everything ends up in tmp_path
+    shutil.copy(os.path.join(PACKAGE, "config.py"), folder)
+    monkeypatch.chdir(folder)
+    monkeypatch.syspath_prepend(str(folder))
+    for name in ("config", "server_file"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+    import server_file
+
+    yield server_file
+    server_file.backend.lease_table.close()
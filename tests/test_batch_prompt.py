@@ -0,0 +1,34 @@
+from models import ImageJob
+from worker_comfy import batch_groups, batch_outputs
+
+BASE = dict(
+    requested_at="2024-01-01T00:00:00",
+    request_type="txt2img",
+    requested_prompt="a cat",
+    model="ab" * 32,
+    steps=20,
+    channel="a",
+    resolution="512x512",
+    batch_size=2,
+    config_scale=7,
+)
+
+
+def make_jobs(*changes):
+    return [ImageJob(id=index, **(BASE | change)) for index, change in enumerate(changes)]
+
+
+def test_same_prompt_without_seed_share_a_sampler():
+    jobs = make_jobs({}, {"requested_prompt": "a dog"}, {}, {"seed": 5}, {})
+    assert batch_groups(jobs) == [[0, 2, 4], [1], [3]]
+
+
+def test_each_job_gets_its_slice_of_the_batch():
+    jobs = make_jobs({}, {"requested_prompt": "a dog"}, {})
+    first, dog, second = batch_outputs(jobs)
+
+    assert first[0] == second[0] != dog[0]
+    images = list("abcd")
+    assert images[first[1]] == ["a", "b"]
+    assert images[second[1]] == ["c", "d"]
+    assert list("xy")[dog[1]] == ["x", "y"]
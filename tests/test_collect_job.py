@@ -0,0 +1,100 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+import worker_comfy
+from models import ImageJob
+from result_cache import ResultCache
+
+JOB = ImageJob(
+    id=1,
+    requested_at="2024-01-01T00:00:00",
+    request_type="txt2img",
+    requested_prompt="a cat",
+    model="ab" * 32,
+    steps=20,
+    channel="a",
+    resolution="512x512",
+    batch_size=2,
+    config_scale=7,
+    seed=42,
+)
+
+
+@pytest.fixture
+def comfy(monkeypatch):
+    # Serves the images of one save node, fetches fail for the names in broken
+    state = SimpleNamespace(node="9", names=["0.png", "1.png"], broken=set())
+    state.uploads = []
+    state.released = []
+
+    def get_history(args, prompt_id):
+        images = [{"filename": name, "subfolder": "", "type": "output"} for name in state.names]
+        return {prompt_id: {"outputs": {state.node: {"images": images}}}}
+
+    def get_image(args, filename, subfolder, folder_type):
+        if filename in state.broken:
+            raise ConnectionError("connection reset")
+        return filename.encode()
+
+    monkeypatch.setattr(worker_comfy, "get_history", get_history)
+    monkeypatch.setattr(worker_comfy, "get_image", get_image)
+    monkeypatch.setattr(
+        worker_comfy,
+        "upload_job",
+        lambda args, client, job, images: state.uploads.append(
+            (job.id, [image.data for image in images])
+        ),
+    )
+    monkeypatch.setattr(
+        worker_comfy,
+        "release_jobs",
+        lambda args, client, job_ids: state.released.extend(job_ids) or len(job_ids),
+    )
+    return state
+
+
+def collect(job, cache=None):
+    done = Future()
+    done.set_result("p1")
+    args = SimpleNamespace(image_fetch_concurrency=2)
+    worker_comfy.collect_job(args, None, job, done, cache)
+
+
+def test_failed_fetches_keep_their_position(comfy):
+    comfy.broken.add("0.png")
+    images = worker_comfy.collect_images(SimpleNamespace(image_fetch_concurrency=2), "p1")
+    assert images == {"9": [None, b"1.png"]}
+
+
+def test_complete_results_are_cached(tmp_path, comfy):
+    cache = ResultCache(str(tmp_path), 2**20).open()
+    collect(JOB, cache)
+
+    assert comfy.uploads == [(1, [b"0.png", b"1.png"])]
+    assert cache.get(worker_comfy.cache_key(JOB)) == [b"0.png", b"1.png"]
+
+
+def test_incomplete_results_are_given_back(tmp_path, comfy):
+    comfy.broken.add("1.png")
+    cache = ResultCache(str(tmp_path), 2**20).open()
+    collect(JOB, cache)
+
+    # Neither uploaded nor cached, the job runs again
+    assert comfy.uploads == []
+    assert comfy.released == [1]
+    assert cache.get(worker_comfy.cache_key(JOB)) is None
+
+
+def test_coalesced_jobs_never_get_each_others_images(comfy):
+    # Two jobs sampled as one batch of two, the first image is lost
+    alice = JOB.model_copy(update={"id": 1, "channel": "alice", "batch_size": 1, "seed": None})
+    bob = alice.model_copy(update={"id": 2, "channel": "bob"})
+    comfy.node = worker_comfy.batch_outputs([alice, bob])[0][0]
+    comfy.names = ["a0.png", "b0.png"]
+    comfy.broken.add("a0.png")
+    collect(alice.model_copy(update={"coalesced": [bob]}))
+
+    assert comfy.uploads == [(2, [b"b0.png"])]
+    assert comfy.released == [1]
@@ -0,0 +1,114 @@
+from gpu_nvidia import FakeNvml, GPUIdleTimer, GPUMonitor
+
+
+class CountingNvml(FakeNvml):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.handle_calls = 0
+
+    def handle(self, index):
+        self.handle_calls += 1
+        return super().handle(index)
+
+
+def make_monitor(count=2, window=10.0):
+    backend = CountingNvml(count=count)
+    monitor = GPUMonitor(backend, window=window)
+    # Sampled by hand at fixed times, without the background thread
+    assert monitor.load()
+    return backend, monitor
+
+
+def test_stats_over_a_sliding_window():
+    backend, monitor = make_monitor()
+    assert monitor.stats(0) is None
+
+    backend.set_utilization(0, 20)
+    monitor.sample(now=0)
+    backend.set_utilization(0, 100)
+    backend.memory_used[0] = 2**30
+    monitor.sample(now=5)
+    backend.set_utilization(0, 0)
+    backend.memory_used[0] = 0
+    monitor.sample(now=12)  # the sample at 0 falls out of the window
+
+    stats = monitor.stats(0)
+    assert stats["samples"] == 2
+    assert stats["utilization_mean"] == 50
+    assert stats["utilization_max"] == 100
+    assert stats["memory_used_max"] == 2**30
+    assert stats["memory_total"] == backend.memory_total
+
+
+def test_every_gpu_is_sampled_separately():
+    backend, monitor = make_monitor(count=3)
+    backend.set_utilization(2, 80)
+    seen = []
+    monitor.add_listener(lambda index, now, utilization: seen.append((index, utilization)))
+    monitor.sample(now=0)
+
+    assert seen == [(0, 0), (1, 0), (2, 80)]
+    assert [monitor.stats(i)["utilization_max"] for i in range(3)] == [0, 0, 80]
+
+
+def test_handles_are_looked_up_once():
+    backend, monitor = make_monitor(count=2)
+    for now in range(5):
+        monitor.sample(now=now)
+    assert backend.handle_calls == 2
+
+
+def make_timer(monitor, **kwargs):
+    idled = []
+    timer = GPUIdleTimer(
+        gpu_index=1,
+        idle_threshold=10,
+        idle_utilization=10,
+        start_time=0,
+        last_time=0,
+        monitor=monitor,
+        on_idle=idled.append,
+        **kwargs,
+    )
+    monitor.add_listener(timer._on_sample)
+    return timer, idled
+
+
+def test_idle_event_fires_when_the_threshold_is_crossed():
+    backend, monitor = make_monitor()
+    timer, idled = make_timer(monitor)
+
+    monitor.sample(now=5)
+    assert not timer.idle_event.is_set()
+
+    # Other GPUs do not count
+    backend.set_utilization(0, 100)
+    monitor.sample(now=10)
+    assert timer.idle_event.is_set()
+    assert idled == [timer]
+
+    monitor.sample(now=12)
+    assert idled == [timer]  # only when it is crossed
+
+    backend.set_utilization(1, 50)
+    monitor.sample(now=13)
+    assert timer.idle_time == 0
+    assert not timer.idle_event.is_set()
+
+
+def test_own_work_counts_as_idle():
+    backend, monitor = make_monitor()
+    timer, _ = make_timer(monitor)
+    backend.set_utilization(1, 100)
+    timer.set_own_work(True)
+
+    monitor.sample(now=10)
+    assert timer.has_reached_idle_threshold()
+
+
+def test_without_nvml_the_gpu_counts_as_idle():
+    timer = GPUIdleTimer(idle_threshold=10, start_time=0, last_time=0)
+    timer.increment_timer(now=4)
+    assert timer.idle_time == 4
+    timer.increment_timer(now=10)
+    assert timer.idle_event.is_set()
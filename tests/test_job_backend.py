@@ -0,0 +1,113 @@
+import json
+import os
+
+import pytest
+
+from job_backend import FileJobBackend
+
+MODEL = "ab" * 32
+
+
+def write_job(tmp_path, job_id, mtime):
+    path = tmp_path / "jobs" / f"job_{job_id}.json"
+    path.write_text(json.dumps({"job_id": job_id, "model": MODEL, "channel": "a"}))
+    os.utime(path, (mtime, mtime))
+
+
+def test_cancel_reports_the_job_state(backend, tmp_path):
+    for mtime, job_id in enumerate(("done", "running", "waiting"), start=1000):
+        write_job(tmp_path, job_id, mtime)
+    backend.open()
+
+    done, _, _ = backend.claim("worker", [MODEL], 0)
+    assert backend.settle(done, "worker") is not None
+    running, _, _ = backend.claim("worker", [MODEL], 0)
+
+    assert backend.cancel("missing") == (None, None)
+    assert backend.cancel("done") == ("completed", None)
+    assert backend.cancel("running") == ("leased", "worker")
+    assert backend.cancel("waiting") == ("queued", None)
+    assert backend.cancel("waiting") == ("cancelled", None)
+
+    # The cancelled job is never dispatched
+    assert backend.claim("worker", [MODEL], 0) is None
+    assert sorted(backend.cancelled(["done", "running", "waiting"])) == ["running", "waiting"]
+
+
+@pytest.mark.parametrize("backend", ["files"], indirect=True)
+def test_cancel_state_survives_a_restart(backend, tmp_path):
+    write_job(tmp_path, "done", 1000)
+    write_job(tmp_path, "waiting", 1001)
+    backend.open()
+    done, _, _ = backend.claim("worker", [MODEL], 0)
+    backend.settle(done, "worker")
+    backend.lease_table.close()
+
+    restarted = FileJobBackend(
+        str(tmp_path / "jobs"), str(tmp_path / "leases.jsonl"), 60
+    ).open()
+    assert restarted.cancel("done") == ("completed", None)
+    assert restarted.cancel("waiting") == ("queued", None)
+
+
+def test_cancel_finds_jobs_in_the_job_log(tmp_path):
+    (tmp_path / "jobs").mkdir()
+    backend = FileJobBackend(
+        str(tmp_path / "jobs"), str(tmp_path / "leases.jsonl"), 60, str(tmp_path / "jobs.jsonl")
+    ).open()
+    backend.submit([{"job_id": 7, "model": MODEL}])
+    backend.refresh()
+
+    assert backend.cancel("7") == ("queued", None)
+    assert backend.claim("worker", [MODEL], 0) is None
+
+
+def test_released_jobs_are_dispatched_again(backend, tmp_path):
+    write_job(tmp_path, "first", 1000)
+    write_job(tmp_path, "second", 1001)
+    backend.open()
+    first, _, _ = backend.claim("worker", [MODEL], 0)
+    second, _, _ = backend.claim("worker", [MODEL], 0)
+
+    # Only the worker holding a lease can give it back
+    assert backend.release([first], "other") == 0
+    assert backend.release([first, second], "worker") == 2
+    assert backend.release([first], "worker") == 0
+
+    assert backend.claim("other", [MODEL], 0)[0] == "first"
+    assert backend.claim("other", [MODEL], 0)[0] == "second"
+
+
+@pytest.mark.parametrize("backend", ["files"], indirect=True)
+def test_released_leases_survive_a_restart(backend, tmp_path):
+    write_job(tmp_path, "first", 1000)
+    backend.open()
+    first, _, _ = backend.claim("worker", [MODEL], 0)
+    backend.release([first], "worker")
+    backend.lease_table.close()
+
+    restarted = FileJobBackend(
+        str(tmp_path / "jobs"), str(tmp_path / "leases.jsonl"), 60
+    ).open()
+    assert restarted.claim("other", [MODEL], 0)[0] == "first"
+
+
+@pytest.mark.parametrize("backend", ["files"], indirect=True)
+def test_claim_skips_unreadable_jobs(backend, tmp_path):
+    write_job(tmp_path, "torn", 1000)
+    write_job(tmp_path, "gone", 1001)
+    write_job(tmp_path, "fine", 1002)
+    backend.open()
+
+    # Changed between being indexed and being claimed
+    torn = tmp_path / "jobs" / "job_torn.json"
+    torn.write_text('{"job_id": "torn"')
+    os.utime(torn, (1000, 1000))
+    os.remove(tmp_path / "jobs" / "job_gone.json")
+
+    assert backend.claim("worker", [MODEL], 0)[0] == "fine"
+
+    # The partly written job is claimed once it is complete
+    write_job(tmp_path, "torn", 1000)
+    assert backend.claim("worker", [MODEL], 0)[0] == "torn"
+    assert backend.claim("worker", [MODEL], 0) is None
@@ -0,0 +1,101 @@
+import json
+import os
+
+from job_queue import JobQueue
+
+MODEL = "ab" * 32
+
+
+def write_jobs(folder, channel, count, start=0, priority=0, steps=20):
+    for i in range(start, start + count):
+        path = os.path.join(folder, f"{channel}_{i:04d}.json")
+        job = {"job_id": f"{channel}{i}", "model": MODEL, "channel": channel, "steps": steps}
+        if priority:
+            job["priority"] = priority
+        with open(path, "w") as f:
+            json.dump(job, f)
+        os.utime(path, (1000 + i, 1000 + i))
+
+
+def pop_all(queue, count):
+    return [queue.pop().split("_")[0] for _ in range(count)]
+
+
+def test_channels_take_turns(tmp_path):
+    write_jobs(tmp_path, "a", 6)
+    write_jobs(tmp_path, "b", 3, start=100)
+    queue = JobQueue(str(tmp_path))
+    queue.refresh(force=True)
+
+    # b's jobs are newer, but it does not wait for a's backlog
+    assert pop_all(queue, 9) == ["a", "b", "a", "b", "a", "b", "a", "a", "a"]
+    assert queue.pop() is None
+
+
+def test_channel_weights(tmp_path):
+    write_jobs(tmp_path, "bulk", 6)
+    write_jobs(tmp_path, "user", 6, start=100)
+    queue = JobQueue(str(tmp_path), weights={"bulk": 0.25})
+    queue.refresh(force=True)
+
+    assert pop_all(queue, 7) == ["bulk", "user", "user", "user", "user", "bulk", "user"]
+
+
+def test_higher_priority_first(tmp_path):
+    write_jobs(tmp_path, "a", 3)
+    write_jobs(tmp_path, "b", 1, start=100, priority=5)
+    queue = JobQueue(str(tmp_path))
+    queue.refresh(force=True)
+
+    assert pop_all(queue, 4) == ["b", "a", "a", "a"]
+
+
+def test_idle_channel_gets_no_credit(tmp_path):
+    write_jobs(tmp_path, "a", 6)
+    queue = JobQueue(str(tmp_path))
+    queue.refresh(force=True)
+    assert pop_all(queue, 4) == ["a"] * 4
+
+    # b joins at a's pass, so the two alternate rather than b catching up
+    write_jobs(tmp_path, "b", 4, start=100)
+    queue.refresh(force=True)
+    assert pop_all(queue, 4) == ["a", "b", "a", "b"]
+
+
+def test_coalescing_scan_keeps_channels_fair(backend, tmp_path):
+    folder = tmp_path / "jobs"
+    # Every job has different steps, so none of them can be coalesced
+    for channel, start in (("a", 0), ("b", 100)):
+        for i in range(start, start + 10):
+            write_jobs(folder, channel, 1, start=i, steps=i)
+    backend.open()
+
+    order = []
+    for _ in range(6):
+        job_id, job_data, _ = backend.claim("worker", [MODEL], 0)
+        order.append(job_id)
+        steps = job_data["steps"]
+        assert backend.claim_matching(
+            "worker", MODEL, lambda other: other["steps"] == steps, 3, 32
+        ) == []
+
+    assert order == ["a0", "b100", "a1", "b101", "a2", "b102"]
+
+
+def test_coalesced_jobs_count_against_their_channel(backend, tmp_path):
+    folder = tmp_path / "jobs"
+    write_jobs(folder, "a", 4)
+    write_jobs(folder, "b", 4, start=100)
+    backend.open()
+
+    lead = backend.claim("worker", [MODEL], 0)
+    coalesced = backend.claim_matching("worker", MODEL, lambda job: job["channel"] == "a", 2, 32)
+    assert [lead[0]] + [claim[0] for claim in coalesced] == ["a0", "a1", "a2"]
+
+    # a has had three jobs, so b gets the next three
+    assert [backend.claim("worker", [MODEL], 0)[0] for _ in range(4)] == [
+        "b100",
+        "b101",
+        "b102",
+        "a3",
+    ]
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+import worker_comfy
+from models import ImageJob
+from worker_comfy import JobSource
+
+
+def make_job(job_id):
+    return ImageJob(
+        id=job_id,
+        requested_at="2024-01-01T00:00:00",
+        request_type="txt2img",
+        requested_prompt="a cat",
+        model="ab" * 32,
+        steps=20,
+        channel="a",
+        resolution="512x512",
+        batch_size=1,
+        config_scale=7,
+    )
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Answers get_jobs from a list of job lists and exceptions, in order
+    answers = []
+
+    def get_jobs(args, client, hashes, max_jobs=1, long_poll=True, loras=()):
+        answer = answers.pop(0) if answers else []
+        if isinstance(answer, Exception):
+            raise answer
+        return answer[:max_jobs]
+
+    monkeypatch.setattr(worker_comfy, "get_jobs", get_jobs)
+    return answers
+
+
+def make_source():
+    args = SimpleNamespace(prefetch=1, long_poll=0)
+    return JobSource(args, SimpleNamespace(worker_id="worker"), {}, {})
+
+
+def test_failed_refill_is_dropped(server):
+    server.extend([[make_job(1)], ConnectionError("server down"), [make_job(2)]])
+    source = make_source()
+
+    assert source.next_job()[0].id == 1
+    source.refill.exception()  # let the background refill fail
+
+    # The failure is logged once, then the server is polled again
+    assert source.next_job()[0].id == 2
+    assert source.refill is not None
+
+
+def test_prefetched_jobs_kept_while_a_slot_is_free(server, monkeypatch):
+    released = []
+    monkeypatch.setattr(
+        worker_comfy,
+        "release_jobs",
+        lambda args, client, job_ids: released.extend(job_ids) or len(job_ids),
+    )
+    server.extend([[make_job(1), make_job(2)]])
+    source = make_source()
+    busy, free = object(), object()
+    source.add_slot(busy)
+    source.add_slot(free)
+
+    assert source.next_job(free)[0].id == 1
+
+    # One GPU is busy with other work, the other can still run job 2
+    source.release_pending(busy)
+    assert released == []
+
+    source.release_pending(free)
+    assert released == [2]
+    assert not source.pending
@@ -0,0 +1,46 @@
+from leases import LeaseTable
+
+
+def reload(path, timeout=60):
+    table = LeaseTable(str(path), timeout)
+    table.load()
+    return table
+
+
+def test_journal_replay(tmp_path):
+    path = tmp_path / "leases.jsonl"
+    table = reload(path)
+    table.grant("one.json", "1", "worker_a")
+    table.grant("two.json", "2", "worker_a")
+    table.grant("three.json", "3", "worker_b", now=0)  # already past its deadline
+    table.grant("four.json", "4", "worker_b")
+    assert table.settle("1", "worker_a") == "one.json"
+    assert [lease.job_id for lease in table.expire()] == ["3"]
+    assert table.cancel("4").worker_id == "worker_b"
+    table.close()
+
+    replayed = reload(path)
+    assert set(replayed.leases) == {"2"}
+    assert replayed.leases["2"].worker_id == "worker_a"
+    assert replayed.completed == {"one.json", "four.json"}
+    assert replayed.released == {"3": "three.json"}
+    assert replayed.is_cancelled("4")
+    assert replayed.held() == {"one.json", "two.json", "four.json"}
+
+    # A late upload for the expired lease still settles it
+    assert replayed.settle("3", "worker_b") == "three.json"
+    replayed.close()
+    assert reload(path).is_completed("three.json")
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    path = tmp_path / "leases.jsonl"
+    table = reload(path)
+    table.grant("one.json", "1", "worker_a")
+    table.close()
+    with open(path, "a") as f:
+        f.write('{"event": "settle", "job_id": "1"')
+
+    replayed = reload(path)
+    assert set(replayed.leases) == {"1"}
+    assert not replayed.completed
@@ -0,0 +1,28 @@
+import io
+
+
+def test_metrics_after_upload_without_worker_id(server):
+    client = server.app.test_client()
+    # Older workers sent neither a job nor a worker ID
+    response = client.post(
+        "/api/upload", data={"images": [(io.BytesIO(b"png"), "0.png")]}
+    )
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'cfa_upload_bytes_total{worker=""} 3' in response.get_data(as_text=True)
+
+
+def test_get_job_rejects_bad_numbers(server):
+    client = server.app.test_client()
+    for field, value in (("max_jobs", "lots"), ("coalesce", [2]), ("wait", "forever")):
+        response = client.get("/api/get-job", json={"worker_id": "worker", field: value})
+        assert response.status_code == 400, field
+        assert "error" in response.get_json()
+
+
+def test_get_job_does_not_wait_a_negative_time(server):
+    client = server.app.test_client()
+    response = client.get("/api/get-job", json={"worker_id": "worker", "wait": -5})
+    assert response.status_code == 404
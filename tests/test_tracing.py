@@ -0,0 +1,32 @@
+import threading
+
+from tracing import Profiler
+
+
+def test_overlapping_calls_run_unprofiled(tmp_path):
+    profiler = Profiler(str(tmp_path / "profile.prof"))
+    inside = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        inside.set()
+        release.wait(5)
+        return "slow"
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(profiler.wrap(slow)()))
+    thread.start()
+    assert inside.wait(5)
+
+    # A second profiler cannot be enabled on Python 3.12+, this one runs without
+    assert profiler.wrap(lambda: "fast")() == "fast"
+    release.set()
+    thread.join(5)
+
+    assert results == ["slow"]
+    assert profiler.skipped == 1
+    assert profiler.wrap(lambda: "again")() == "again"
+    assert profiler.skipped == 1
+
+    profiler.dump()
+    assert (tmp_path / "profile.prof").exists()